@@ -268,6 +268,12 @@ class StoredConfig:
             else:
                 output.write("\nADJACENCY = False\n")
 
+            cfg = self.data.xpath('//Adjacencies[@store]')
+            if len(cfg) > 0:
+                output.write("ADJACENCY_STORE = '%s'\n" % cfg[0].get('store'))
+            else:
+                output.write("ADJACENCY_STORE = ''\n")
+
             # Specific Settings for Convex Hull Choropleth - This choropleth
             # can only be displayed if convex hull is added to a list of score
             # functions
@@ -377,6 +383,13 @@ class StoredConfig:
                 cfg = cfg[0]
                 maxranked = cfg.get('maxranked') or 10
             output.write("\nLEADERBOARD_MAX_RANKED = %d\n" % int(maxranked))
+
+            # Validation
+            threads = 1
+            cfg = self.data.xpath('//Validation[@threads]')
+            if len(cfg) > 0:
+                threads = cfg[0].get('threads')
+            output.write("\nVALIDATION_THREADS = %d\n" % int(threads))
        
             output.close()
 
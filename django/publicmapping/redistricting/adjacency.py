@@ -0,0 +1,354 @@
+"""
+Define the stores of travel costs used by the Adjacency calculator.
+
+The classes in redistricting.adjacency look up the cost (distance,
+travel time, etc.) between pairs of base geounits. The costs are loaded
+from the adjacency files in the configuration, either into the key
+value store (redis), or into a sparse matrix saved on disk.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+Author:
+    Andrew Jennings, David Zwarg, Kenny Shepard
+"""
+
+from django.conf import settings
+from django.utils import simplejson as json
+from redisutils import key_gen
+import os, csv, itertools, logging
+import numpy
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class CostStore(object):
+    """
+    The base class for all cost stores. A cost store sums the costs
+    between every pair of geounits in a set of geounits.
+    """
+
+    def pair_sum(self, portable_ids):
+        """
+        Sum the costs between all distinct pairs of geounits.
+
+        @param portable_ids: A list of portable ids of base geounits.
+        @return: A tuple of the total cost and the number of pairs.
+            Pairs without a cost are counted, but add nothing to the total.
+        """
+        raise NotImplementedError()
+
+    def cross_sum(self, first, second):
+        """
+        Sum the costs between each geounit in one set of geounits and
+        each geounit in another. The sets should not overlap.
+
+        @param first: A list of portable ids of base geounits.
+        @param second: A list of portable ids of base geounits.
+        @return: The total cost.
+        """
+        raise NotImplementedError()
+
+    def region_cost(self, region):
+        """
+        Get the average cost between the geounits in a region.
+
+        @param region: The name of the region.
+        @return: The average cost, or None if the region has no costs.
+        """
+        raise NotImplementedError()
+
+
+class RedisCostStore(CostStore):
+    """
+    A cost store that looks up each pair of geounits in redis. The keys
+    are created with L{key_gen}.
+    """
+
+    # The number of keys to fetch in each request
+    chunk_size = 10000
+
+    def __init__(self, host=None, port=None, db=None):
+        """
+        Connect to redis. Any connection parameter that is not provided
+        is read from the KEY_VALUE_STORE setting.
+        """
+        redis_settings = settings.KEY_VALUE_STORE
+        host = host if host is not None else redis_settings['HOST']
+        port = int(port if port is not None else redis_settings['PORT'])
+        db = int(db if db is not None else redis_settings['DB'])
+        self.r = redis.StrictRedis(host=host, port=port, db=db)
+
+    def _sum_keys(self, keys):
+        """
+        Sum the costs stored in a sequence of keys, fetching them in 
+        chunks. Missing keys add nothing to the total.
+        """
+        def sum_query(query):
+            return sum(map(lambda x: float(x) if x else 0, self.r.mget(query)))
+
+        redis_query = []
+        total = 0
+        for key in keys:
+            redis_query.append(key)
+            if len(redis_query) == self.chunk_size:
+                total += sum_query(redis_query)
+                redis_query = []
+
+        if len(redis_query) > 0:
+            total += sum_query(redis_query)
+
+        return total
+
+    def pair_sum(self, portable_ids):
+        geounit_ids = sorted(set(portable_ids))
+        num = len(geounit_ids)
+        keys = itertools.imap(lambda ids: key_gen(**{'geounit1': ids[0], 'geounit2': ids[1]}),
+            itertools.combinations(geounit_ids, 2))
+
+        return (self._sum_keys(keys), num * (num - 1) / 2,)
+
+    def cross_sum(self, first, second):
+        # The keys are generated with the lower portable id first
+        keys = itertools.imap(lambda ids: key_gen(**{'geounit1': min(ids), 'geounit2': max(ids)}),
+            itertools.product(set(first), set(second)))
+
+        return self._sum_keys(keys)
+
+    def region_cost(self, region):
+        value = self.r.get(key_gen(**{'region': region}))
+        return float(value) if value is not None else None
+
+
+class SparseCostStore(CostStore):
+    """
+    A cost store that keeps the costs in memory, in a compressed sparse
+    row matrix. Each pair of geounits is stored once, in the row of the
+    geounit whose portable id sorts first.
+
+    The matrix is saved in a directory as numpy arrays, which are memory
+    mapped when loaded, so processes on the same host share the pages.
+    """
+
+    def __init__(self, ids, indptr, indices, data, regions):
+        """
+        Create a sparse cost store from its arrays.
+
+        @param ids: The portable ids of the geounits, in row order.
+        @param indptr: The offsets of each row in indices and data.
+        @param indices: The column of each cost.
+        @param data: The costs.
+        @param regions: A dict of the average cost in each region.
+        """
+        self.ids = ids
+        self.index = dict((pid, i,) for (i, pid,) in enumerate(ids))
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.regions = regions
+
+    def rows(self, portable_ids):
+        """
+        Get the rows of a set of geounits. Geounits that have no costs
+        are left out.
+
+        @param portable_ids: A list of portable ids of base geounits.
+        @return: A numpy array of row numbers.
+        """
+        rows = [self.index[pid] for pid in set(portable_ids) if pid in self.index]
+        return numpy.array(rows, dtype=numpy.int64)
+
+    def submatrix_sum(self, rows, columns):
+        """
+        Sum the costs in a set of rows, and a set of columns.
+
+        @param rows: A numpy array of row numbers.
+        @param columns: A numpy array of column numbers.
+        @return: The total cost.
+        """
+        if len(rows) == 0 or len(columns) == 0:
+            return 0.0
+
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        total_length = lengths.sum()
+        if total_length == 0:
+            return 0.0
+
+        # The positions of every cost in the rows, without a python loop
+        offsets = numpy.cumsum(lengths) - lengths
+        positions = numpy.repeat(starts - offsets, lengths) + numpy.arange(total_length)
+
+        member = numpy.zeros(len(self.ids), dtype=bool)
+        member[columns] = True
+
+        selected = member[self.indices[positions]]
+        return float(self.data[positions][selected].sum())
+
+    def pair_sum(self, portable_ids):
+        num = len(set(portable_ids))
+        rows = self.rows(portable_ids)
+        return (self.submatrix_sum(rows, rows), num * (num - 1) / 2,)
+
+    def cross_sum(self, first, second):
+        # Each pair is stored once, so look in the rows of both sets
+        first = self.rows(first)
+        second = self.rows(second)
+        return self.submatrix_sum(first, second) + self.submatrix_sum(second, first)
+
+    def region_cost(self, region):
+        return self.regions.get(region)
+
+    @staticmethod
+    def build(adjacencies):
+        """
+        Build a sparse cost store from adjacency files.
+
+        Each file is tab delimited, with the portable id of the first
+        geounit, the portable id of the second geounit, and the cost
+        between them, without a header row. Costs are symmetric; if a
+        pair is listed more than once, the last cost is used.
+
+        @param adjacencies: A list of tuples of the path to an adjacency
+            file, and the name of the region it covers.
+        @return: A new SparseCostStore.
+        """
+        ids = {}
+        firsts = []
+        seconds = []
+        costs = []
+        regions = {}
+
+        def get_id(pid):
+            if not pid in ids:
+                ids[pid] = len(ids)
+            return ids[pid]
+
+        for (path, region,) in adjacencies:
+            region_sum = 0
+            region_count = 0
+            f = open(path, 'r')
+            for row in csv.reader(f, delimiter='\t'):
+                firsts.append(get_id(row[0]))
+                seconds.append(get_id(row[1]))
+                costs.append(float(row[2]))
+                region_sum += float(row[2])
+                region_count += 1
+            f.close()
+
+            if region is not None and region_count > 0:
+                regions[region] = region_sum / float(region_count)
+
+        # Number the geounits in the order of their portable ids
+        ordered = sorted(ids.keys())
+        renumber = numpy.zeros(len(ordered), dtype=numpy.int64)
+        for (i, pid,) in enumerate(ordered):
+            renumber[ids[pid]] = i
+
+        firsts = renumber[numpy.array(firsts, dtype=numpy.int64)]
+        seconds = renumber[numpy.array(seconds, dtype=numpy.int64)]
+        costs = numpy.array(costs, dtype=numpy.float64)
+
+        # Store each pair in the row of the lower geounit
+        rows = numpy.minimum(firsts, seconds)
+        columns = numpy.maximum(firsts, seconds)
+        keep = rows != columns
+        rows = rows[keep]
+        columns = columns[keep]
+        costs = costs[keep]
+
+        # Sort by pair, keeping the last cost of any duplicate pairs
+        keys = rows * len(ordered) + columns
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        last = numpy.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        order = order[last]
+
+        rows = rows[order]
+        indices = columns[order]
+        data = costs[order]
+
+        indptr = numpy.zeros(len(ordered) + 1, dtype=numpy.int64)
+        if len(rows) > 0:
+            indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=len(ordered)))
+
+        return SparseCostStore(ordered, indptr, indices, data, regions)
+
+    def save(self, directory):
+        """
+        Save this cost store to a directory.
+
+        @param directory: The directory to write the arrays into. It is
+            created if it does not exist.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        numpy.save(os.path.join(directory, 'indptr.npy'), self.indptr)
+        numpy.save(os.path.join(directory, 'indices.npy'), self.indices)
+        numpy.save(os.path.join(directory, 'data.npy'), self.data)
+
+        f = open(os.path.join(directory, 'index.json'), 'w')
+        f.write(json.dumps({ 'ids': self.ids, 'regions': self.regions }))
+        f.close()
+
+    @staticmethod
+    def load(directory):
+        """
+        Load a cost store that was saved to a directory. The arrays are
+        memory mapped, not read into memory.
+
+        @param directory: The directory the arrays were saved in.
+        @return: A SparseCostStore.
+        """
+        def load_array(name):
+            return numpy.load(os.path.join(directory, name), mmap_mode='r')
+
+        f = open(os.path.join(directory, 'index.json'), 'r')
+        index = json.loads(f.read())
+        f.close()
+
+        return SparseCostStore(index['ids'], load_array('indptr.npy'),
+            load_array('indices.npy'), load_array('data.npy'), index['regions'])
+
+
+# The sparse cost stores that have been loaded in this process
+_sparse_stores = {}
+
+def get_cost_store(**kwargs):
+    """
+    Get the cost store for the Adjacency calculator.
+
+    If the ADJACENCY_STORE setting names a directory containing a saved
+    sparse cost store, that store is used, and kept in memory for the
+    life of the process. Otherwise, the costs are looked up in redis.
+
+    @keyword host: Optional. The host to connect to redis.
+    @keyword port: Optional. The port to connect to redis.
+    @keyword db: Optional. The redis database number to connect to.
+    @return: A L{CostStore}.
+    """
+    directory = getattr(settings, 'ADJACENCY_STORE', '')
+    if directory and os.path.exists(os.path.join(directory, 'index.json')):
+        if not directory in _sparse_stores:
+            _sparse_stores[directory] = SparseCostStore.load(directory)
+        return _sparse_stores[directory]
+
+    return RedisCostStore(host=kwargs.get('host'), port=kwargs.get('port'), db=kwargs.get('db'))
@@ -461,6 +461,9 @@ class ValidationCriteriaAdmin(admin.ModelAdmin):
     """
     fields = ('name','legislative_body','function',)
 
+    # When browsing the criteria, show how long each one takes.
+    list_display = ('name','legislative_body','function','duration','checks',)
+
 
 # Register these classes with the admin interface.
 admin.site.register(Geounit, GeounitAdmin)
@@ -28,23 +28,135 @@ Author:
     Andrew Jennings, David Zwarg, Kenny Shepard
 """
 
-from math import sqrt, pi
+from math import sqrt, pi, hypot
 from django.contrib.gis.geos import Point, LineString
 from django.contrib.humanize.templatetags.humanize import intcomma
 from django.utils import simplejson as json
 from django.utils.translation import ugettext as _
 from django.template import Template, Context
+from django.template.defaultfilters import floatformat
+from django.utils.encoding import force_unicode
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
 from decimal import Decimal
 from copy import copy
 import random
 
 from django.db.models import Q
 import operator
-import itertools
-import redis
-from django.conf import settings
-from redisutils import key_gen
-redis_settings = settings.KEY_VALUE_STORE
+from redistricting.adjacency import get_cost_store
+
+def enclosing_circle(coords):
+    """
+    Find the minimum enclosing circle of a set of coordinates.
+
+    This is an iterative form of the randomized incremental algorithm
+    described by E. Welzl, "Smallest enclosing disks (balls and 
+    ellipsoids)", 1991. It works on plain float tuples, and does not 
+    create any GEOS geometries.
+
+    @param coords: A sequence of (x,y) coordinates, such as the 
+        coordinates of a convex hull.
+    @return: A tuple of the center x, center y, and radius of the circle.
+        If there are no coordinates, None is returned.
+    """
+    pts = [(float(c[0]), float(c[1]),) for c in coords]
+    if len(pts) == 0:
+        return None
+
+    random.shuffle(pts)
+
+    circle = (pts[0][0], pts[0][1], 0.0,)
+    for i in xrange(1, len(pts)):
+        p = pts[i]
+        if _circle_contains(circle, p):
+            continue
+
+        # p lies on the boundary of the enclosing circle of pts[0:i+1]
+        circle = (p[0], p[1], 0.0,)
+        for j in xrange(i):
+            q = pts[j]
+            if _circle_contains(circle, q):
+                continue
+
+            # p and q both lie on the boundary
+            circle = _circle_from_2(p, q)
+            for k in xrange(j):
+                if not _circle_contains(circle, pts[k]):
+                    circle = _circle_from_3(p, q, pts[k])
+
+    return circle
+
+def _circle_contains(circle, pt):
+    """
+    Test if a point lies within a circle, allowing for rounding error.
+    """
+    return hypot(pt[0] - circle[0], pt[1] - circle[1]) <= circle[2] * (1 + 1e-12)
+
+def _circle_from_2(p1, p2):
+    """
+    Create the circle whose diameter is the segment between two points.
+    """
+    return ((p1[0] + p2[0]) / 2.0, (p1[1] + p2[1]) / 2.0, 
+        hypot(p1[0] - p2[0], p1[1] - p2[1]) / 2.0,)
+
+def _circle_from_3(p1, p2, p3):
+    """
+    Create the circle that passes through three points. If the points are
+    colinear, the circle between the two farthest points is used.
+    """
+    # Work relative to p1 to keep the determinant well conditioned for
+    # projected coordinates
+    bx = p2[0] - p1[0]
+    by = p2[1] - p1[1]
+    cx = p3[0] - p1[0]
+    cy = p3[1] - p1[1]
+    d = 2.0 * (bx * cy - by * cx)
+    if d == 0:
+        return max(_circle_from_2(p1, p2), _circle_from_2(p1, p3), 
+            _circle_from_2(p2, p3), key=lambda c: c[2])
+
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    ux = (cy * b2 - by * c2) / d
+    uy = (bx * c2 - cx * b2) / d
+
+    return (p1[0] + ux, p1[1] + uy, hypot(ux, uy),)
+
+
+# The compiled templates used by calculators, keyed on the template string
+_templates = {}
+
+def get_template(template):
+    """
+    Get a compiled template. Each template string is compiled once, and
+    reused by every calculator that renders it.
+
+    @param template: A string that may use django template tags
+    @return: A django Template
+    """
+    compiled = _templates.get(template)
+    if compiled is None:
+        compiled = Template(template)
+        _templates[template] = compiled
+    return compiled
+
+def render_value(value, decimal_places=None):
+    """
+    Render a value the way a template variable would, without rendering
+    a template. The value is localized, and escaped if it is not safe.
+
+    @param value: The value to render.
+    @param decimal_places: Optional. If provided, the value is formatted 
+        like the 'floatformat' filter, with this argument.
+    @return: A safe string, identical to the rendering of 
+        "{{ value }}" or "{{ value|floatformat:decimal_places }}"
+    """
+    if decimal_places is None:
+        return conditional_escape(force_unicode(localize(value)))
+    return conditional_escape(floatformat(value, decimal_places))
+
 
 class CalculatorBase(object):
     """
@@ -63,6 +175,10 @@ class CalculatorBase(object):
     #
     arg_dict = {}
 
+    # Whether this calculator can compute a plan result from inputs that
+    # each depend on a single district. See district_input.
+    district_inputs = False
+
     def __init__(self):
         """
         Initialize the result and argument dictionary.
@@ -77,6 +193,46 @@ class CalculatorBase(object):
         """
         pass
 
+    def compute_districts(self, districts):
+        """
+        Compute the results for a list of districts. The base class 
+        computes each district in turn; calculators that can compute 
+        many districts at once may override this.
+
+        @param districts: A list of L{District}s.
+        @return: A list of the results, in the same order as districts.
+        """
+        results = []
+        for district in districts:
+            self.result = None
+            self.compute(district=district)
+            results.append(self.result)
+        return results
+
+    def district_input(self, district):
+        """
+        Compute the part of a plan result that depends on a single 
+        district. Since a district version never changes, these inputs
+        may be cached, and only the districts changed by an edit need to 
+        be evaluated again. Calculators that set district_inputs must
+        implement this and compute_inputs.
+
+        @param district: A L{District}, including its geometry.
+        @return: A value that can be serialized to JSON.
+        """
+        raise NotImplementedError()
+
+    def compute_inputs(self, plan, districts, inputs):
+        """
+        Compute the result for a plan from the inputs of its districts.
+
+        @param plan: The L{Plan} being computed.
+        @param districts: The L{District}s of the plan version.
+        @param inputs: The result of district_input for each district,
+            in the same order as districts.
+        """
+        raise NotImplementedError()
+
     def sortkey(self):
         """
         Generate a key used to sort this calculator relative to all other
@@ -102,7 +258,7 @@ class CalculatorBase(object):
         @return: An HTML SPAN element, formatted similar to: "<span>n/a</span>".
         """
         if not self.result is None and 'value' in self.result:
-            return self.template('<span>{{ result.value }}</span>');
+            return mark_safe('<span>%s</span>' % render_value(self.result['value']))
 
         if not self.result is None and 'raw' in self.result:
             return self.result['raw']
@@ -145,7 +301,7 @@ class CalculatorBase(object):
 
         @return: A string representing the rendering template and context
         """
-        t = Template(template)
+        t = get_template(template)
         c = Context({'result': self.result})
         if context is not None:
             c.update(context)
@@ -158,12 +314,10 @@ class CalculatorBase(object):
 
         @return: A string representing the result as a percentage
         """
+        percentage = render_value(self.result['value'] * 100, 2)
         if span:
-            t = Template('<span>{{ percentage|floatformat:2 }}%</span>')
-        else:
-            t = Template('{{ percentage|floatformat:2 }}%')
-        c = Context({'percentage': self.result['value'] * 100})
-        return t.render(c)
+            return mark_safe('<span>%s%%</span>' % percentage)
+        return mark_safe('%s%%' % percentage)
 
     def get_value(self, argument, district=None):
         """
@@ -260,15 +414,16 @@ class Schwartzberg(CalculatorBase):
             if district.district_id == 0:
                 continue
 
-            if district.geom.empty:
+            metrics = district.get_metrics()
+            if metrics.empty:
                 continue
 
-            if district.geom.length == 0:
+            if metrics.perimeter == 0:
                 continue
         
-            r = sqrt(district.geom.area / pi)
+            r = sqrt(metrics.area / pi)
             circumference = 2 * pi * r
-            compactness += circumference / district.geom.length
+            compactness += circumference / metrics.perimeter
             num += 1
 
         self.result = { 'value': (compactness / num) if num > 0 else 0 }
@@ -332,16 +487,13 @@ class Roeck(CalculatorBase):
             if district.district_id == 0:
                 continue
 
-            if district.geom.empty:
+            metrics = district.get_metrics()
+            if metrics.empty:
                 continue
 
-            # Convert the coordinates in the convex hull to a list of GEOS Points
-            hull = map(lambda x: Point(x[0],x[1]), list(district.geom.convex_hull.coords[0]))
-            disk = self.minidisk(hull)
+            cir_area = pi * metrics.circle_r * metrics.circle_r
 
-            cir_area = pi * disk.r * disk.r
-
-            compactness += district.geom.area / cir_area
+            compactness += metrics.area / cir_area
             num += 1
 
         try:
@@ -512,6 +664,10 @@ class Roeck(CalculatorBase):
         This code borrows some patterns from the applet source here:
         http://www.sunshine2k.de/stuff/Java/Welzl/Welzl.html
 
+        District metrics use L{enclosing_circle} instead, which is much
+        faster on large hulls. The first point is skipped, as it is the
+        same as the last point of a closed ring.
+
         @param points: An array of points, from a GEOSGeometry.
         @return: A L{Roeck.Circle} minimum enclosing disk for the points.
         """
@@ -612,15 +768,12 @@ class PolsbyPopper(CalculatorBase):
             if district.district_id == 0:
                 continue
 
-            if district.geom.empty:
+            metrics = district.get_metrics()
+            if metrics.empty:
                 continue
 
-            perimeter = 0
-            for poly in district.geom:
-                for linestring in poly:
-                    perimeter += linestring.length
-
-            compactness += 4 * pi * district.geom.area / perimeter / perimeter
+            perimeter = metrics.perimeter
+            compactness += 4 * pi * metrics.area / perimeter / perimeter
             num += 1
 
         self.result = { 'value': compactness / num }
@@ -681,10 +834,11 @@ class LengthWidthCompactness(CalculatorBase):
             if district.district_id == 0:
                 continue
 
-            if district.geom.empty:
+            metrics = district.get_metrics()
+            if metrics.empty:
                 continue
 
-            bbox = district.geom.extent
+            bbox = metrics.extent
             lw = (bbox[3] - bbox[1]) / (bbox[2] - bbox[0])
             if lw > 1:
                 lw = 1 / lw
@@ -780,8 +934,7 @@ class SumValues(CalculatorBase):
         @return: The result wrapped in an HTML SPAN element: "<span>1</span>".
         """
         if not self.result is None and 'value' in self.result:
-            return self.template(
-                '<span>{{ result.value|floatformat:0 }}</span>')
+            return mark_safe('<span>%s</span>' % render_value(self.result['value'], 0))
         return self.empty_html_result
 
 class Percent(CalculatorBase):
@@ -1027,6 +1180,9 @@ class Contiguity(CalculatorBase):
     If this calculator is called with a plan, it will tally up the number
     of districts that are contiguous.
 
+    If the number of contiguous parts of a district is known, it is 
+    included in the result as 'components'. The parts are found with the
+    neighbor graph of the base geounits, when it has been computed.
     """
     def compute(self, **kwargs):
         """
@@ -1058,66 +1214,15 @@ class Contiguity(CalculatorBase):
             allow_single = False
 
         count = 0
+        components = None
         for district in districts:
-            if len(district.geom) == 1 and district.district_id != 0:
+            # for plan summations of contiguity, ignore the unassigned in the tally
+            if district.district_id == 0 and 'plan' in kwargs:
+                continue
+
+            (contiguous, components,) = self.district_contiguity(district, allow_single)
+            if contiguous:
                 count += 1
-            else:
-                if district.district_id == 0:
-                    # for plan summations of contiguity, ignore the unassigned in the tally
-                    if 'plan' in kwargs:
-                        continue
-                    elif len(district.geom) == 1:
-                        count += 1
-                        continue
-
-                # if the district has no geometry, i.e. an empty unassigned district,
-                # treat it as contiguous
-                if len(district.geom) == 0:
-                    count += 1
-                    continue
-                    
-                # obtain the contiguity overrides that need to be applied
-                overrides = district.get_contiguity_overrides()
-
-                if allow_single or len(overrides) > 0:
-                    # create a running union of of polygons that are linked, seeded with the first.
-                    # loop through remaining polygons and add any that either touch the union,
-                    # or do so virtually with a contiguity override. repeat until either:
-                    #   - the remaining list is empty: contiguous
-                    #   - no matches were found in a pass: discontiguous
-                    union = district.geom[0]
-                    remaining = district.geom[1:]
-                    contiguous = True
-    
-                    while (len(remaining) > 0):
-                        if len(district.geom) == 0:
-                            continue
-
-                        match_in_pass = False
-                        for geom in remaining:
-                            linked = False
-                            if allow_single and geom.touches(union):
-                                linked = True
-                            else:
-                                for override in overrides:
-                                    o = override.override_geounit.geom
-                                    c = override.connect_to_geounit.geom
-                                    if (geom.contains(o) and union.contains(c)) or (geom.contains(c) and union.contains(o)):
-                                        linked = True
-                                        overrides.remove(override)
-                                        break
-
-                            if linked:
-                                remaining.remove(geom)
-                                union = geom.union(union)
-                                match_in_pass = True
-                                    
-                        if not match_in_pass:
-                            contiguous = False
-                            break
-    
-                    if contiguous:
-                        count += 1
 
         self.result = { 'value': count }
         try:
@@ -1127,6 +1232,83 @@ class Contiguity(CalculatorBase):
         except:
             pass
 
+        # The number of contiguous parts only describes a single district
+        if 'district' in kwargs and components is not None:
+            self.result['components'] = components
+
+    def district_contiguity(self, district, allow_single):
+        """
+        Determine if a single district is contiguous.
+
+        If the neighbors of the base geounits have been computed, the
+        parts of the district are found by connecting neighboring base
+        geounits and the geounits of any ContiguityOverrides. Otherwise,
+        the polygons of the district are linked together with geometric
+        tests.
+
+        @param district: The L{District} to evaluate.
+        @param allow_single: Consider polygons that touch at a single
+            point to be connected.
+        @return: A tuple of a boolean contiguity flag, and the number of
+            contiguous parts in the district, or None if the number of
+            parts is not known.
+        """
+        # if the district has no geometry, i.e. an empty unassigned district,
+        # treat it as contiguous
+        if len(district.geom) <= 1:
+            return (True, len(district.geom),)
+
+        # obtain the contiguity overrides that need to be applied
+        overrides = []
+        if not allow_single:
+            overrides = district.get_contiguity_overrides()
+            if len(overrides) == 0:
+                # Each polygon is a separate part
+                return (False, len(district.geom),)
+
+        if district.district_id != 0:
+            components = district.count_components(allow_single_point=allow_single)
+            if components is not None:
+                return (components <= 1, components,)
+
+        if allow_single:
+            overrides = district.get_contiguity_overrides()
+
+        # create a running union of of polygons that are linked, seeded with the first.
+        # loop through remaining polygons and add any that either touch the union,
+        # or do so virtually with a contiguity override. repeat until either:
+        #   - the remaining list is empty: contiguous
+        #   - no matches were found in a pass: discontiguous
+        union = district.geom[0]
+        remaining = district.geom[1:]
+        contiguous = True
+
+        while (len(remaining) > 0):
+            match_in_pass = False
+            for geom in remaining:
+                linked = False
+                if allow_single and geom.touches(union):
+                    linked = True
+                else:
+                    for override in overrides:
+                        o = override.override_geounit.geom
+                        c = override.connect_to_geounit.geom
+                        if (geom.contains(o) and union.contains(c)) or (geom.contains(c) and union.contains(o)):
+                            linked = True
+                            overrides.remove(override)
+                            break
+
+                if linked:
+                    remaining.remove(geom)
+                    union = geom.union(union)
+                    match_in_pass = True
+                        
+            if not match_in_pass:
+                contiguous = False
+                break
+
+        return (contiguous, None,)
+
     def html(self):
         """
         Generate an HTML representation of the contiguity score. This
@@ -1178,6 +1360,31 @@ class AllContiguous(CalculatorBase):
 
         self.result = { 'value': (len(districts) - 1) == calc.result['value'] }
 
+    # The contiguity of each district can be cached
+    district_inputs = True
+
+    def district_input(self, district):
+        """
+        Determine if a single district is contiguous.
+
+        @param district: A L{District}, including its geometry.
+        @return: True if the district is contiguous, or None for the
+            unassigned district.
+        """
+        if district.district_id == 0:
+            return None
+
+        (contiguous, components,) = Contiguity().district_contiguity(district, False)
+        return contiguous
+
+    def compute_inputs(self, plan, districts, inputs):
+        """
+        Determine if all the districts in a plan are contiguous, from the
+        contiguity of each district. The unassigned district is ignored.
+        """
+        contiguous = [value for (district, value,) in zip(districts, inputs) if district.district_id != 0]
+        self.result = { 'value': all(contiguous) }
+
 
 class NonContiguous(CalculatorBase):
     """
@@ -1336,10 +1543,8 @@ class Interval(CalculatorBase):
             if 'index' in self.result and 'subject' in self.result:
                 interval = self.result['index']
                 interval_class = "interval_%d" % interval if interval >= 0 else 'no_interval'
-                t = '<span class="{{ class }} {{ result.subject }}">' \
-                    '{{ result.value|floatformat:0 }}</span>'
-                c = {'class': interval_class}
-                return self.template(t, c)
+                return mark_safe('<span class="%s %s">%s</span>' % (interval_class, 
+                    render_value(self.result['subject']), render_value(self.result['value'], 0)))
         return self.empty_html_result
 
 
@@ -1407,7 +1612,7 @@ class Equivalence(CalculatorBase):
         @return: A string in the format of "1,000" or "n/a" if no result.
         """
         if not self.result is None and 'value' in self.result:
-            return self.template('{{ result.value|floatformat:0 }}')
+            return render_value(self.result['value'], 0)
         
         return _('n/a')
 
@@ -2097,8 +2302,6 @@ class CommunityTypeCompatible(CalculatorBase):
         else:
             cversion = None
 
-        districts = plan.get_districts_at_version(pversion, include_geom=True)
-
         if not 'community_map_id' in kwargs:
             self.result = { 'value': 'n/a' }
             return
@@ -2108,18 +2311,18 @@ class CommunityTypeCompatible(CalculatorBase):
             ctype = 'type=' + ctype
 
         community_id = kwargs['community_map_id']
-        alltypes = None
-        for district in districts:
-            if district.is_unassigned:
-                continue
-
-            tmpset = district.get_community_type_union(community_id, version=cversion)
+        unions = plan.get_community_type_unions(community_id, version=pversion, community_version=cversion)
 
+        alltypes = None
+        for tmpset in unions.values():
             if alltypes is None:
                 alltypes = tmpset
             else:
                 alltypes = alltypes & tmpset
 
+        if alltypes is None:
+            alltypes = set()
+
         # simplify all the matching tags to strings, not Tag objects
         alltypes = map(lambda x:str(x.name), alltypes)
         self.result = { 'value': (ctype in alltypes) }
@@ -2248,6 +2451,36 @@ class DistrictSplitCounter(CalculatorBase):
         
         self.result = { 'value': num_splits }
 
+    def compute_districts(self, districts):
+        """
+        Calculate splits between many districts and a target geolevel, 
+        with one query for the districts of each plan.
+
+        @param districts: A list of L{District}s.
+        @return: A list of the results, in the same order as districts.
+        """
+        geolevel_id = self.get_value('geolevel_id')
+
+        plans = {}
+        for district in districts:
+            if not district.geom.empty:
+                plans.setdefault(district.plan_id, []).append(district)
+
+        counts = {}
+        for plan_districts in plans.values():
+            plan = plan_districts[0].plan
+            counts.update(plan.count_district_splits(geolevel_id, districts=plan_districts))
+
+        results = []
+        for district in districts:
+            if district.id in counts:
+                results.append({ 'value': counts[district.id] })
+            else:
+                results.append(None)
+
+        self.result = results[-1] if len(results) > 0 else None
+        return results
+
 class ConvexHullRatio(CalculatorBase):
     """
     Calculate the ratio of the area of a district to the area of its convex hull.
@@ -2283,10 +2516,14 @@ class ConvexHullRatio(CalculatorBase):
         num = 0
         ratios = 0.0
         for district in districts:
-            if district.geom.empty or district.geom.length == 0 or district.district_id == 0:
+            if district.district_id == 0:
                 continue
 
-            ratios += district.geom.area / district.geom.convex_hull.area
+            metrics = district.get_metrics()
+            if metrics.empty or metrics.perimeter == 0:
+                continue
+
+            ratios += metrics.area / metrics.hull_area
             num += 1
 
         self.result = { 'value': (ratios / num) if num > 0 else 0 }
@@ -2311,30 +2548,8 @@ class Adjacency(CalculatorBase):
     """
 
     def _district_calculator(self, district):
-        def sum_query(query):
-            return sum(map(lambda x: float(x) if x else 0, self.r.mget(query)))
-        
-        geounit_ids = [geo[1] for geo in district.get_base_geounits()]
-        geounit_ids.sort()
-        geounit_id_combos = itertools.combinations(geounit_ids, 2)
-        redis_query = []
-        total = 0
-        num_queries = 0
-        for count, ids in enumerate(geounit_id_combos):
-            num_queries += 1
-            if count % 10000 == 0 and count > 0:
-                total += sum_query(redis_query)
-                redis_query = []
-            
-            redis_query.append(key_gen(**{'geounit1': ids[0], 'geounit2': ids[1]}))
-
-        total += sum_query(redis_query)
-
-        # return 0 to prevent a divide-by-zero error
-        if num_queries == 0:
-            return 0
-
-        return total / num_queries
+        # The average is 0 if there are no pairs
+        return district.get_adjacency(self.store).value
 
     def compute(self, **kwargs):
         """
@@ -2344,6 +2559,11 @@ class Adjacency(CalculatorBase):
 
         The score for a plan is a normalized sum of costs for districts within the plan.
 
+        The costs are read from the sparse cost store named by the 
+        ADJACENCY_STORE setting, if it exists, or from redis. The sums
+        of the costs in each district are stored, and updated with only
+        the geounits that moved when the district is edited.
+
         @keyword district: A L{District} whose cost ratio should be calculated
 
         @keyword plan: A L{Plan} whose total cost ratio should be calculated
@@ -2355,13 +2575,9 @@ class Adjacency(CalculatorBase):
 
         @keyword port: Optional. The port to connect to redis, defaults to value in settings.
 
-        @keyword redis_db: Optional. The redis database number to connect to, defaults to value in settings.
+        @keyword db: Optional. The redis database number to connect to, defaults to value in settings.
         """
-        # Get Redis Connection - might as well re-use it
-        redis_host = kwargs.get('host', redis_settings['HOST'])
-        redis_port = int(kwargs.get('port', redis_settings['PORT']))
-        redis_db = int(kwargs.get('db', redis_settings['DB']))
-        self.r = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+        self.store = get_cost_store(**kwargs)
         
         districts = []
         if 'district' in kwargs:
@@ -2388,9 +2604,7 @@ class Adjacency(CalculatorBase):
                 district_scores.append(district_score)
 
             region = districts[0].plan.legislative_body.region.name
-
-            region_key = key_gen(**{'region': region})
-            region_score = float(self.r.get(region_key))
+            region_score = self.store.region_cost(region)
             num_districts = len(district_scores)
 
             for district in district_scores:
@@ -2408,9 +2622,7 @@ class Adjacency(CalculatorBase):
         @return: A number formatted similar to "10.01"
         """
         if not self.result is None and 'value' in self.result:
-            t = Template('{{ result_value|floatformat:2 }}')
-            c = Context({'result_value': self.result['value']})
-            return t.render(c)
+            return render_value(self.result['value'], 2)
         else:
             return _('n/a')
         
@@ -829,6 +829,9 @@ class ConfigImporter:
         """
         # Remove previous contiguity overrides
         ContiguityOverride.objects.all().delete()
+
+        # The contiguity of districts used for validation depends on the overrides
+        ValidationInput.objects.all().delete()
             
         if not self.store.has_contiguity_overrides():
             logger.debug('ContiguityOverrides not configured')
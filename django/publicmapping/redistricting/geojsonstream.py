@@ -0,0 +1,220 @@
+"""
+Write GeoJSON feature collections as a stream of strings.
+
+The geometries are written from their well known binary, without
+parsing GeoJSON back into dicts, and each feature is written as it is
+produced, so a whole feature collection is never held in memory as
+python objects. Coordinates may be rounded, to shorten the response
+when the map is zoomed out.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+Author:
+    Andrew Jennings, David Zwarg, Kenny Shepard
+"""
+
+from django.utils import simplejson as json
+import binascii, math, struct
+import numpy
+
+# The GeoJSON names of the well known binary geometry types
+GEOMETRY_TYPES = {
+    1: 'Point',
+    2: 'LineString',
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+    7: 'GeometryCollection'
+}
+
+# The flags of extended well known binary
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+
+def precision_for_resolution(resolution):
+    """
+    Get the number of decimal places that keeps coordinates within a
+    tenth of a pixel at a map resolution.
+
+    @param resolution: The size of a pixel, in map units.
+    @return: The number of decimal places; negative numbers round to
+        tens, hundreds, etc.
+    """
+    return int(math.floor(-math.log10(resolution))) + 1
+
+
+class WKBReader(object):
+    """
+    Write the GeoJSON geometry of well known binary, or extended well
+    known binary.
+    """
+
+    def __init__(self, precision=None):
+        """
+        Create a reader.
+
+        @keyword precision: Optional. The number of decimal places to
+            round coordinates to.
+        """
+        self.precision = precision
+
+    def geometry(self, wkb):
+        """
+        Get the GeoJSON of a geometry.
+
+        @param wkb: The well known binary, as a string or buffer, or as
+            a hex encoded string.
+        @return: The GeoJSON geometry, as a string.
+        """
+        wkb = str(wkb)
+        if wkb[:2] in ('00', '01',):
+            wkb = binascii.unhexlify(wkb)
+
+        (geojson, offset,) = self._read(wkb, 0)
+        return geojson
+
+    def _read(self, wkb, offset):
+        """
+        Read one geometry, and any geometries inside it.
+
+        @return: A tuple of the GeoJSON, and the offset after the
+            geometry.
+        """
+        order = '<' if wkb[offset] == '\x01' else '>'
+        (kind,) = struct.unpack_from(order + 'I', wkb, offset + 1)
+        offset += 5
+
+        dims = 2
+        if kind & EWKB_Z:
+            dims += 1
+        if kind & EWKB_M:
+            dims += 1
+        if kind & EWKB_SRID:
+            offset += 4
+        kind = kind & 0xffff
+
+        # ISO well known binary adds 1000 for z, 2000 for m
+        if kind > 1000:
+            dims += (kind / 1000 + 1) / 2
+            kind = kind % 1000
+
+        if kind == 1:
+            (points, offset,) = self._points(wkb, offset, order, dims, 1)
+            coords = points[1:-1]
+        elif kind == 2:
+            (coords, offset,) = self._line(wkb, offset, order, dims)
+        elif kind == 3:
+            (coords, offset,) = self._polygon(wkb, offset, order, dims)
+        else:
+            (count,) = struct.unpack_from(order + 'I', wkb, offset)
+            offset += 4
+            parts = []
+            for i in range(count):
+                (part, offset,) = self._read(wkb, offset)
+                parts.append(part)
+
+            if kind == 7:
+                return ('{"type":"GeometryCollection","geometries":[%s]}' % ','.join(parts), offset,)
+
+            # The parts of a multi geometry are written whole; keep only
+            # their coordinates
+            coords = '[%s]' % ','.join(part[part.index('"coordinates":') + 14:-1] for part in parts)
+
+        return ('{"type":"%s","coordinates":%s}' % (GEOMETRY_TYPES[kind], coords,), offset,)
+
+    def _points(self, wkb, offset, order, dims, count, ring=False):
+        """
+        Read a sequence of points.
+
+        @return: A tuple of the coordinates as a GeoJSON array, and the
+            offset after the points.
+        """
+        coords = numpy.frombuffer(wkb, dtype=order + 'f8', count=count * dims, offset=offset)
+        coords = coords.reshape((count, dims))[:, 0:2]
+        offset += count * dims * 8
+
+        if self.precision is not None:
+            coords = numpy.round(coords, self.precision)
+
+            # Remove points that were rounded onto the previous point, as
+            # long as a ring remains a ring
+            if count > 2:
+                keep = numpy.ones(count, dtype=bool)
+                keep[1:] = numpy.any(coords[1:] != coords[:-1], axis=1)
+                if ring:
+                    keep[-1] = True
+                if keep.sum() >= (4 if ring else 2):
+                    coords = coords[keep]
+
+        # Whole numbers are written without a fraction
+        point = '[%d,%d]' if self.precision is not None and self.precision <= 0 else '[%r,%r]'
+        return ('[%s]' % ','.join(point % (x, y,) for (x, y,) in coords.tolist()), offset,)
+
+    def _line(self, wkb, offset, order, dims, ring=False):
+        """
+        Read a line string or ring.
+        """
+        (count,) = struct.unpack_from(order + 'I', wkb, offset)
+        return self._points(wkb, offset + 4, order, dims, count, ring)
+
+    def _polygon(self, wkb, offset, order, dims):
+        """
+        Read the rings of a polygon.
+        """
+        (count,) = struct.unpack_from(order + 'I', wkb, offset)
+        offset += 4
+        rings = []
+        for i in range(count):
+            (ring, offset,) = self._line(wkb, offset, order, dims, ring=True)
+            rings.append(ring)
+        return ('[%s]' % ','.join(rings), offset,)
+
+
+def stream_features(features, members=None, precision=None):
+    """
+    Write a GeoJSON feature collection, one feature at a time.
+
+    @param features: An iterable of tuples of the id of each feature, its
+        geometry as (hex encoded) well known binary, and a dict of its
+        properties. Features without a geometry are written with a null
+        geometry.
+    @keyword members: Optional. A dict of other members of the feature
+        collection.
+    @keyword precision: Optional. The number of decimal places to round
+        coordinates to.
+    @return: A generator of strings of GeoJSON.
+    """
+    reader = WKBReader(precision)
+
+    head = '{"type":"FeatureCollection",'
+    for (key, value,) in (members or {}).items():
+        head += '%s:%s,' % (json.dumps(key), json.dumps(value),)
+    yield head + '"features":['
+
+    separator = ''
+    for (fid, wkb, properties,) in features:
+        geometry = 'null' if wkb is None else reader.geometry(wkb)
+        yield '%s{"type":"Feature","id":%s,"properties":%s,"geometry":%s}' % (separator,
+            json.dumps(fid), json.dumps(properties), geometry,)
+        separator = ','
+
+    yield ']}'
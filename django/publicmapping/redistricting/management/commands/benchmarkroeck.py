@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+Benchmark the minimum enclosing circle used by the Roeck calculator.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Author:
+        Andrew Jennings, David Zwarg
+"""
+
+from django.core.management.base import BaseCommand
+from django.contrib.gis.geos import Point
+from optparse import make_option
+from redistricting.models import *
+from redistricting.calculators import Roeck, enclosing_circle
+import time
+
+class Command(BaseCommand):
+    """
+    This command compares the GEOS based minidisk of the Roeck calculator
+    with the float based enclosing_circle, using district convex hulls.
+    """
+    args = None
+    help = 'Compare the speed and results of the Roeck enclosing circle implementations on district hulls'
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--plan', dest='plan_id', default=None, action='store', help='Only use the districts in this plan'),
+        make_option('-n', '--number', dest='number', default='50', action='store', help='Number of districts to use'),
+        make_option('-r', '--repeat', dest='repeat', default='3', action='store', help='Number of times to compute each circle'),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Time both enclosing circle implementations
+        """
+        number = int(options.get('number'))
+        repeat = int(options.get('repeat'))
+
+        districts = District.objects.exclude(district_id=0)
+        if options.get('plan_id'):
+            districts = districts.filter(plan__id=int(options.get('plan_id')))
+
+        hulls = []
+        for district in districts.order_by('-id')[0:number]:
+            if district.geom is None or district.geom.empty:
+                continue
+            hulls.append(list(district.geom.convex_hull.coords[0]))
+
+        if len(hulls) == 0:
+            self.stdout.write('No district geometries to benchmark\n')
+            return
+
+        npts = sum(map(len, hulls))
+        self.stdout.write('Benchmarking %d district hulls (%d coordinates), %d repetitions\n' % (len(hulls), npts, repeat))
+
+        calc = Roeck()
+        geos_radii = []
+        start = time.time()
+        for i in range(repeat):
+            for hull in hulls:
+                disk = calc.minidisk(map(lambda x: Point(x[0],x[1]), hull))
+                if i == 0:
+                    geos_radii.append(disk.r)
+        geos_time = time.time() - start
+
+        float_radii = []
+        start = time.time()
+        for i in range(repeat):
+            for hull in hulls:
+                circle = enclosing_circle(hull[1:])
+                if i == 0:
+                    float_radii.append(circle[2])
+        float_time = time.time() - start
+
+        maxdiff = max(map(lambda r: abs(r[0] - r[1]) / r[0] if r[0] > 0 else abs(r[1]), zip(geos_radii, float_radii)))
+
+        self.stdout.write('minidisk:         %0.4f seconds\n' % geos_time)
+        self.stdout.write('enclosing_circle: %0.4f seconds\n' % float_time)
+        if float_time > 0:
+            self.stdout.write('Speedup: %0.1fx\n' % (geos_time / float_time))
+        self.stdout.write('Maximum relative radius difference: %g\n' % maxdiff)
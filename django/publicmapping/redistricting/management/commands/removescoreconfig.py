@@ -45,6 +45,9 @@ class Command(BaseCommand):
         if verbosity > 0:
             self.stdout.write('Deleting all score configuration\n')
 
+        # The cached scores refer to the score functions
+        ScoreCache.clear()
+
         for m in [ValidationCriteria, ScorePanel, ScoreDisplay, ScoreArgument, ScoreFunction]:
             m.objects.all().delete()
 
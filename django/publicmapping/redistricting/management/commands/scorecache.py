@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""
+Report on and evict the cached scores of the DistrictBuilder application.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Author:
+        Andrew Jennings, David Zwarg
+"""
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from redistricting.models import *
+
+class Command(BaseCommand):
+    """
+    This command prints the size and hit rate of the score caches, and
+    optionally evicts the cached scores that are no longer needed.
+    """
+    args = None
+    help = 'Print the size and hit rate of the score caches, and optionally evict old scores'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--days', dest='days', default='7', action='store', help='Number of days of hits and misses to report'),
+        make_option('-e', '--evict', dest='evict', default=False, action='store_true', help='Evict the cached scores that are no longer needed'),
+        make_option('-a', '--max-age', dest='max_age', default=None, action='store', help='Number of days a score is kept after it was last read'),
+        make_option('-c', '--checkpoints', dest='checkpoints', default=None, action='store', help='Number of latest versions of each plan whose scores are kept'),
+        make_option('-r', '--max-rows', dest='max_rows', default=None, action='store', help='Maximum number of scores in each table, or 0 for no limit'),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Print the score cache report, evicting scores first if requested
+        """
+        verbosity = int(options.get('verbosity'))
+
+        if options.get('evict'):
+            def option(name, setting, default):
+                value = options.get(name)
+                return int(value) if value is not None else getattr(settings, setting, default)
+
+            removed = ScoreCache.evict(timedelta(days=option('max_age', 'SCORE_CACHE_MAX_AGE', 30)),
+                checkpoints=option('checkpoints', 'SCORE_CACHE_CHECKPOINTS', 5),
+                max_rows=option('max_rows', 'SCORE_CACHE_MAX_ROWS', 0))
+            if verbosity > 0:
+                for (table, count,) in removed.items():
+                    self.stdout.write('Removed %d cached scores from %s\n' % (count, table))
+
+        days = int(options.get('days'))
+        for row in ScoreCache.report(days):
+            lookups = row['hits'] + row['misses']
+            rate = 100.0 * row['hits'] / lookups if lookups > 0 else 0.0
+            self.stdout.write('%s: %d rows, %.1f MB; %d hits, %d misses (%.1f%%) over the last %d day(s)\n' % 
+                (row['table'], row['rows'], row['bytes'] / 1048576.0, row['hits'], row['misses'], rate, days))
@@ -50,6 +50,7 @@ import traceback, logging
 
 import redis
 from redisutils import key_gen
+from redistricting.adjacency import SparseCostStore
 from django.db.models import Q
 import subprocess
 
@@ -86,6 +87,8 @@ class Command(BaseCommand):
             action="store_true", help="Create system templates based on district index files.", default=False),
         make_option('-a', '--adjacency', dest="adjacency",
                     help="Import adjacency data", default=False, action='store_true'),
+        make_option('-N', '--neighbors', dest="neighbors",
+            action='store_true', help="Compute the neighbors of the base geounits, for contiguity.", default=False),
         make_option('-b', '--bard', dest="bard",
             action='store_true', help="Create a BARD map based on the imported spatial data.", default=False),
         make_option('-s', '--static', dest="static",
@@ -251,6 +254,14 @@ file and try again.
 
         if options.get("adjacency"):
             self.import_adjacency(store.data)
+
+        if options.get("neighbors"):
+            try:
+                self.build_neighbors()
+            except:
+                logger.info('ERROR computing geounit neighbors.')
+                logger.debug(traceback.format_exc())
+                all_ok = False
             
         if options.get("bard_templates"):
             try:
@@ -659,15 +670,20 @@ ERROR:
         adjacencies = config.xpath('//DistrictBuilder/Adjacencies/*')
 
         # Instantiate redis connection with settings from XML config
-        redis_config = config.xpath('//DistrictBuilder/Project/KeyValueStore')[0]
-        redis_connection = redis.StrictRedis(host=redis_config.get('host'),
-                                             port=int(redis_config.get('port')))
-        
+        redis_config = config.xpath('//DistrictBuilder/Project/KeyValueStore')
+        if len(redis_config) > 0:
+            redis_connection = redis.StrictRedis(host=redis_config[0].get('host'),
+                                                 port=int(redis_config[0].get('port')))
+        else:
+            redis_connection = None
 
         # Read and load data into redis #
         data_dict = {}
         file_numbers = len(adjacencies)
         for counter, adjacency in enumerate(adjacencies):
+            if redis_connection is None:
+                break
+
             path = adjacency.get('path')
             logger.info('Processing file %s of %s (%s)' %(counter + 1, file_numbers, path))
             region = adjacency.get('regionref') # Grab region id to cache avg. cost for region
@@ -687,13 +703,38 @@ ERROR:
 
             # Need to send left over data < 10000 to redis
             redis_connection.mset(data_dict)
+            data_dict = {}
 
             # Cache region totals in redis
             region_cost = region_sum/float(c)
             key = key_gen(**{'region': region})
             redis_connection.set(key, region_cost)
 
-        logger.info('Finished processing files and loading data into key value store')
+        if redis_connection is not None:
+            logger.info('Finished processing files and loading data into key value store')
+
+        # Build the sparse cost store, if one is configured
+        store_directory = getattr(settings, 'ADJACENCY_STORE', '')
+        if store_directory:
+            logger.info('Building sparse cost store in %s', store_directory)
+            store = SparseCostStore.build([(a.get('path'), a.get('regionref'),) for a in adjacencies])
+            store.save(store_directory)
+            logger.info('Finished building sparse cost store')
+
+        # The stored adjacency sums were computed with the old costs
+        DistrictAdjacency.objects.all().delete()
+
+    def build_neighbors(self):
+        """
+        Compute the neighbors of the geounits in the base geolevel of
+        each legislative body. The Contiguity calculator uses these
+        neighbors to count the contiguous parts of a district.
+        """
+        base_ids = set([body.get_base_geolevel() for body in LegislativeBody.objects.all()])
+        for geolevel in Geolevel.objects.filter(id__in=base_ids):
+            logger.info('Computing neighbors of geolevel "%s"', geolevel.name)
+            count = GeounitNeighbor.build(geolevel)
+            logger.info('Found %d neighboring pairs of geounits', count)
 
     def create_report_templates(self, config):
         """
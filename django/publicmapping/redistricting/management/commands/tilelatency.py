@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Measure the time the map server's tile queries take on the choropleth views.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Author:
+        Andrew Jennings, David Zwarg
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from optparse import make_option
+from redistricting.models import *
+from redistricting import vectortile
+import math, random, time
+
+class Command(BaseCommand):
+    """
+    This command runs the bounding box queries that the map server makes
+    for each map tile against the choropleth views of each geolevel and
+    subject, and reports how long they take. The tiles are chosen with a
+    fixed seed, so the same tiles are queried each time the command is
+    run; run it before and after changing the CHOROPLETH_TABLES setting
+    and configuring the views to compare them.
+    """
+    args = None
+    help = 'Time the map tile queries of the choropleth views'
+    option_list = BaseCommand.option_list + (
+        make_option('-g', '--geolevel', dest='geolevel', default=None, action='store', help='Only query the views of this geolevel'),
+        make_option('-s', '--subject', dest='subject', default=None, action='store', help='Only query the views of this subject'),
+        make_option('-z', '--zoom', dest='zoom', default='8,10,12', action='store', help='A comma separated list of zoom levels'),
+        make_option('-n', '--number', dest='number', default='20', action='store', help='Number of tiles to query at each zoom level'),
+        make_option('-S', '--seed', dest='seed', default='0', action='store', help='The seed used to choose the tiles'),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Time the tile queries
+        """
+        zooms = map(int, options.get('zoom').split(','))
+        number = int(options.get('number'))
+        seed = int(options.get('seed'))
+
+        geolevels = Geolevel.objects.all()
+        if options.get('geolevel'):
+            geolevels = geolevels.filter(name=options.get('geolevel'))
+        subjects = Subject.objects.all()
+        if options.get('subject'):
+            subjects = subjects.filter(name=options.get('subject'))
+
+        cursor = connection.cursor()
+
+        for geolevel in geolevels:
+            if geolevel.legislativelevel_set.all().count() == 0:
+                continue
+
+            extent = Geounit.objects.filter(geolevel=geolevel).extent(field_name='simple')
+            if extent is None:
+                continue
+
+            for subject in subjects:
+                name = get_featuretype_name(geolevel.name, subject.name)
+                kind = get_relation_kind(cursor, name)
+                if kind is None:
+                    self.stdout.write('%s does not exist\n' % name)
+                    continue
+
+                self.stdout.write('%s (%s)\n' % (name, 'table' if kind == 'r' else 'view'))
+
+                # The same tiles are chosen for every view
+                chooser = random.Random(seed)
+                for z in zooms:
+                    tiles = self.get_tiles(chooser, extent, z, number)
+                    timings = []
+                    rows = 0
+                    for (x, y,) in tiles:
+                        bounds = vectortile.tile_bounds(z, x, y)
+                        start = time.time()
+                        cursor.execute("SELECT id, number, percentage, st_asbinary(geom) FROM " + name +
+                            " WHERE geom && st_setsrid(st_makebox2d(st_point(%s, %s), st_point(%s, %s)), 3785);", bounds)
+                        rows += len(cursor.fetchall())
+                        timings.append((time.time() - start) * 1000)
+
+                    if len(timings) == 0:
+                        continue
+
+                    timings.sort()
+                    self.stdout.write('  zoom %2d: %d tiles, %d features, mean %0.1f ms, median %0.1f ms, max %0.1f ms\n' % (
+                        z, len(timings), rows, sum(timings) / len(timings), timings[len(timings) / 2], timings[-1]))
+
+    def get_tiles(self, chooser, extent, z, number):
+        """
+        Choose tiles that cover some part of an extent.
+
+        @param chooser: The random number generator.
+        @param extent: The extent, as (xmin, ymin, xmax, ymax).
+        @param z: The zoom level of the tiles.
+        @param number: The number of tiles to choose.
+        @return: A list of (x, y) tile addresses.
+        """
+        size = 2 * vectortile.ORIGIN_SHIFT / 2 ** z
+        last = 2 ** z - 1
+        xmin = max(0, int(math.floor((extent[0] + vectortile.ORIGIN_SHIFT) / size)))
+        xmax = min(last, int(math.floor((extent[2] + vectortile.ORIGIN_SHIFT) / size)))
+        ymin = max(0, int(math.floor((vectortile.ORIGIN_SHIFT - extent[3]) / size)))
+        ymax = min(last, int(math.floor((vectortile.ORIGIN_SHIFT - extent[1]) / size)))
+
+        return [(chooser.randint(xmin, xmax), chooser.randint(ymin, ymax),) for i in range(number)]
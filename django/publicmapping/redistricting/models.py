@@ -34,9 +34,9 @@ from django.contrib.gis.db import models
 from django.contrib.gis.geos import MultiPolygon,Polygon,GEOSGeometry,GEOSException,GeometryCollection,Point
 from django.contrib.gis.db.models.query import GeoQuerySet
 from django.contrib.auth.models import User
-from django.db.models import Sum, Max, Q, Count
-from django.db.models.signals import pre_save, post_save, m2m_changed
-from django.db import connection, transaction
+from django.db.models import Sum, Min, Max, Q, Count, F
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.db import IntegrityError, connection, transaction
 from django.forms import ModelForm
 from django.conf import settings
 from django.utils import simplejson as json
@@ -46,15 +46,19 @@ from django.template.loader import render_to_string
 from django.contrib.comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
 from django.template.defaultfilters import title
-from redistricting.calculators import Schwartzberg, Contiguity, SumValues
-from tagging.models import TaggedItem, Tag
-from datetime import datetime
+from redistricting.calculators import Schwartzberg, Contiguity, SumValues, enclosing_circle
+from redistricting.adjacency import get_cost_store
+from redistricting import vectortile
+from tagging.models import TaggedItem
+from datetime import datetime, timedelta
 from copy import copy
 from decimal import *
 from operator import attrgetter
 from rosetta import polib
 from traceback import format_exc
-import os, sys, cPickle, types, tagging, re, logging
+from multiprocessing.pool import ThreadPool
+import os, sys, types, tagging, re, logging, time, threading
+import numpy
 
 logger = logging.getLogger(__name__)
 
@@ -533,6 +537,59 @@ class Geolevel(BaseModel):
         logger.debug("Geounits modified: (geometry: %d, data values: %d)", geomods, nummods)
 
         return True
+
+    def get_base_assignments(self, base_geolevel_id):
+        """
+        Get the geounit in this geolevel that contains each base geounit.
+        Geounits are followed up through their 'child' geounits, which
+        are linked when the geolevels are nested, so no spatial queries
+        are needed.
+
+        Parameters:
+            base_geolevel_id -- The ID of the base geolevel.
+
+        Returns:
+            A tuple of a dict of the portable id of the containing
+            geounit, keyed on the base Geounit ID, and a dict of the
+            names of the geounits in this geolevel, keyed on portable id.
+            None is returned if a base geounit is not linked to a
+            geounit in this geolevel.
+        """
+        units = list(self.geounit_set.values_list('id', 'portable_id', 'name'))
+        base = list(Geounit.objects.filter(geolevel__id=base_geolevel_id).values_list('id', flat=True))
+        links = list(Geounit.objects.filter(child__isnull=False).values_list('id', 'child'))
+        if len(units) == 0 or len(base) == 0:
+            return None
+
+        size = max([max(base), max([u[0] for u in units])] + [max(l) for l in links]) + 1
+
+        # The next larger geounit of each geounit, indexed by Geounit ID
+        up = numpy.zeros(size, dtype=numpy.int64) - 1
+        if len(links) > 0:
+            links = numpy.array(links, dtype=numpy.int64)
+            up[links[:,0]] = links[:,1]
+
+        in_level = numpy.zeros(size, dtype=bool)
+        in_level[[u[0] for u in units]] = True
+
+        # Climb from every base geounit at once, one geolevel at a time
+        current = numpy.array(base, dtype=numpy.int64)
+        for i in range(Geolevel.objects.count()):
+            pending = ~in_level[current]
+            if not pending.any():
+                break
+            current[pending] = up[current[pending]]
+            if (current < 0).any():
+                return None
+
+        if not in_level[current].all():
+            return None
+
+        portable_ids = dict((u[0], u[1],) for u in units)
+        assignments = dict(zip(base, [portable_ids[c] for c in current.tolist()]))
+        names = dict((u[1], u[2],) for u in units)
+
+        return (assignments, names,)
         
 
 
@@ -1045,10 +1102,17 @@ class Plan(models.Model):
 
             # get the IDs of all the offenders
             deleteme = self.district_set.filter(allQ)
+
+            # The earlier versions no longer have all their districts
+            self.planextent_set.filter(version__lt=before).delete()
         else:
             # Purge any districts between the version provided
             # and the latest version
             deleteme = self.district_set.filter(version__gt=after)
+            self.planextent_set.filter(version__gt=after).delete()
+
+            # The version numbers will be reused
+            vectortile.clear_tiles(self.id, after + 1)
 
         # since comments are loosely bound, manually remove them, too
         pks = deleteme.values_list('id',flat=True)
@@ -1097,6 +1161,9 @@ class Plan(models.Model):
 
         # Clone the characteristics, comments and tags to this new version
         district_copy.clone_relations_from(district)
+
+        # The shape is the same, so the adjacency sums are too
+        DistrictAdjacency.carry(district_copy, district.id, district.geom, [])
                 
     @transaction.commit_on_success
     def add_geounits(self, districtinfo, geounit_ids, geolevel, version, keep_old_versions=False):
@@ -1155,6 +1222,9 @@ class Plan(models.Model):
         locked = safe_union(District.objects.filter(id__in=[d.id for d in districts if d.is_locked]))
         incremental = incremental if locked is None else incremental.difference(locked)
 
+        # The base geounits that are moving, to update the adjacency sums
+        moved = self.get_base_geounits_in_geom(incremental) if settings.ADJACENCY else []
+
         self.purge(after=version)
 
         target = None
@@ -1185,6 +1255,7 @@ class Plan(models.Model):
                     # Clone the characteristics, comments, and tags to this 
                     # new version
                     district_copy.clone_relations_from(district)
+                    DistrictAdjacency.carry(district_copy, district.id, district.geom, [])
 
                     fixed = True
 
@@ -1209,6 +1280,7 @@ class Plan(models.Model):
                 raise ex
 
             # Make sure the geom is a multi-polygon.
+            previous_geom = district.geom
             district.geom = enforce_multi(geom)
 
             # Clone the district to a new version, with a different shape
@@ -1225,6 +1297,7 @@ class Plan(models.Model):
 
             # Update the district stats
             district_copy.delta_stats(geounits,False)
+            DistrictAdjacency.carry(district_copy, district.id, previous_geom, moved)
 
         new_target = False
         if target is None:
@@ -1251,6 +1324,8 @@ class Plan(models.Model):
         if len(geounits) > 0:
             fixed = True
 
+        previous_geom = target.geom
+
         # If there exists geometry in the target district
         if target.geom:
             # Combine the incremental (changing) geometry with the existing
@@ -1281,6 +1356,7 @@ class Plan(models.Model):
 
         # Update the district stats
         target_copy.delta_stats(geounits,True)
+        DistrictAdjacency.carry(target_copy, target.id, previous_geom, moved)
 
         # invalidate the plan, since it has been modified
         self.is_valid = False
@@ -1410,6 +1486,7 @@ class Plan(models.Model):
             pasted.long_label = self.legislative_body.get_label() % {'district_id':pasted.district_id}
             pasted.save();
         pasted.clone_relations_from(district)
+        DistrictAdjacency.carry(pasted, district.id, district.geom, [])
         
         # For the remaning districts in the plan,
         for existing in others:
@@ -1436,11 +1513,15 @@ class Plan(models.Model):
                         pasted.delete()
                         return None
                     else:
+                        previous_geom = pasted.geom
                         pasted.geom = enforce_multi(difference)
                         pasted.simplify()
                     geounit_ids = map(str, biggest_geolevel.geounit_set.filter(geom__bboverlaps=enforce_multi(intersection)).values_list('id', flat=True))
                     geounits = Geounit.get_mixed_geounits(geounit_ids, self.legislative_body, biggest_geolevel.id, intersection, True)
                     pasted.delta_stats(geounits, False)
+                    if settings.ADJACENCY:
+                        moved = self.get_base_geounits_in_geom(intersection)
+                        DistrictAdjacency.carry(pasted, pasted.id, previous_geom, moved)
                 else:
                     # We'll be updating the existing district and incrementing the version
                     difference = enforce_multi(existing.geom.difference(pasted.geom))
@@ -1451,6 +1532,7 @@ class Plan(models.Model):
                         new_district.clone_relations_from(existing)
                     else:
                         new_district = existing
+                    previous_geom = existing.geom
                     new_district.geom = difference
                     new_district.version = new_version
                     new_district.simplify()
@@ -1470,30 +1552,104 @@ class Plan(models.Model):
                         new_district.computedcharacteristic_set.all().delete()
                     else:
                         new_district.delta_stats(geounits, False)
+                        if settings.ADJACENCY:
+                            moved = self.get_base_geounits_in_geom(intersection)
+                            DistrictAdjacency.carry(new_district, existing.id, previous_geom, moved)
         return (pasted.id, edited_districts)
 
-    def get_wfs_districts(self,version,subject_id,extents,geolevel, district_ids=None):
+    def get_sidebar_displays(self):
         """
-        Get the districts in this plan as a GeoJSON WFS response.
-        
-        This method behaves much like a WFS service, returning the GeoJSON 
-        for each district. This manual view exists because the limitations
-        of filtering and the complexity of the version query -- it is 
-        impossible to use the WFS layer in Geoserver automatically.
+        Get the ScoreDisplays that may be shown in the sidebar for this
+        plan: the default displays of the legislative body, and the 
+        displays of the plan's owner.
+
+        Returns:
+            A queryset of ScoreDisplays.
+        """
+        body = self.legislative_body
+        names = ['%s_sidebar_demo' % body.name]
+        if body.is_community:
+            names.append('%s_sidebar_comments' % body.name)
+        else:
+            names.append('%s_sidebar_basic' % body.name)
+
+        return ScoreDisplay.objects.filter(Q(owner__is_superuser=True, name__in=names) | Q(owner=self.owner),
+            legislative_body=body, is_page=False)
+
+    def get_choropleth_functions(self):
+        """
+        Get the district ScoreFunctions that are displayed as choropleths
+        on the map of districts. See get_district_features.
+
+        Returns:
+            A list of ScoreFunctions.
+        """
+        names = ['district_schwartzberg', 'district_contiguous']
+        if settings.CONVEX_CHOROPLETH:
+            names.append('district_convex')
+        if settings.ADJACENCY:
+            names.append('district_adjacency')
+
+        return list(ScoreFunction.objects.filter(name__in=names))
+
+    def warm_scores(self, version=None):
+        """
+        Compute and cache the scores in the sidebar displays and the
+        choropleths of a version of this plan, so they are not computed
+        while a page waits for them. District scores are computed for all
+        the districts at once.
+
+        Parameters:
+            version -- Optional; the version of the plan to score.
+
+        Returns:
+            The number of score functions computed.
+        """
+        version = version if version is not None else self.version
+
+        district_functions = dict((f.id, f,) for f in self.get_choropleth_functions())
+        plan_functions = {}
+        for display in self.get_sidebar_displays():
+            for panel in display.scorepanel_set.all():
+                if panel.type == 'district':
+                    functions, is_planscore = district_functions, False
+                else:
+                    functions, is_planscore = plan_functions, True
+                for function in panel.score_functions.filter(is_planscore=is_planscore):
+                    functions[function.id] = function
+
+        districts = list(self.get_districts_at_version(version, include_geom=True))
+        for function in district_functions.values():
+            ComputedDistrictScore.compute_all(function, districts)
+
+        for function in plan_functions.values():
+            ComputedPlanScore.compute(function, self, version=version)
+
+        return len(district_functions) + len(plan_functions)
+
+    def get_district_features(self, version, subject_id, extents, geolevel, district_ids=None):
+        """
+        Get the districts in this plan that are within the map extents,
+        with the attributes displayed on the map.
+
+        Each district has a 'chop' attribute, which is its simplified 
+        geometry at the geolevel, clipped to the map extents.
 
         Parameters:
             version -- The Plan version.
             subject_id -- The Subject attributes to attach to the district.
             extent -- The map extents.
+            geolevel -- The index of the simplified geometry to use.
             district_ids -- Optional array of district_ids to filter by.
 
         Returns:
-            GeoJSON describing the Plan.
+            A generator of tuples of each District and a dict of its 
+            attributes.
         """
 
         # If explicitly asked for no district ids, return no features
         if district_ids == []:
-            return []
+            return
        
         qset = self.get_district_ids_at_version(version)
 
@@ -1501,7 +1657,11 @@ class Plan(models.Model):
         bounds.srid = 3785
 
         qset = self.district_set.filter(id__in=qset)
-        qset = qset.extra(select={'chop':"st_intersection(st_geometryn(simple,%d),st_geomfromewkt('%s'))" % (geolevel,bounds.ewkt)},where=["st_intersects(st_geometryn(simple,%d),st_geomfromewkt('%s'))" % (geolevel, bounds.ewkt)])
+        qset = qset.extra(tables=['redistricting_simpledistrict'],
+            select={'chop':"st_intersection(redistricting_simpledistrict.geom,st_geomfromewkt('%s'))" % bounds.ewkt},
+            where=['redistricting_simpledistrict.district_id = redistricting_district.id',
+                'redistricting_simpledistrict.geolevel_id = %d' % int(geolevel),
+                "st_intersects(redistricting_simpledistrict.geom,st_geomfromewkt('%s'))" % bounds.ewkt])
         qset = qset.defer('simple')
 
         exclude_unassigned = True
@@ -1517,8 +1677,6 @@ class Plan(models.Model):
         if exclude_unassigned:
             qset = qset.filter( ~Q(district_id=0) )
 
-        features = []
-
         subj = Subject.objects.get(id=int(subject_id))
 
         # Grab ScoreFunctions so we can use cached scores for districts if they exist
@@ -1531,7 +1689,7 @@ class Plan(models.Model):
         convex_function = ScoreFunction.objects.filter(name='district_convex')
         adjacency_function = ScoreFunction.objects.filter(name='district_adjacency')
 
-        for district in qset:
+        for district in qset.iterator():
             computed_compactness = computed_district_score.compute(schwartzberg_function, district=district)
             computed_contiguity = computed_district_score.compute(contiguity_function, district=district)
 
@@ -1547,30 +1705,120 @@ class Plan(models.Model):
                 format = self.legislative_body.multi_district_label_format
                 label = format.format(name=label, num_members=district.num_members)
 
-            features_dict = { 
-                'id': district.id,
-                'properties': {
-                    'district_id': district.district_id,
-                    'name': district.long_label,
-                    'label': label,
-                    'is_locked': district.is_locked,
-                    'version': district.version,
-                    'number': str(district.computedcharacteristic_set.get(subject=subj).number),
-                    'contiguous': computed_contiguity['value'],
-                    'compactness': computed_compactness['value'],
-                    'num_members': district.num_members
-                },
-                'geometry': json.loads(GEOSGeometry(district.chop).geojson)
+            properties = {
+                'district_id': district.district_id,
+                'name': district.long_label,
+                'label': label,
+                'is_locked': district.is_locked,
+                'version': district.version,
+                'number': str(district.computedcharacteristic_set.get(subject=subj).number),
+                'contiguous': computed_contiguity['value'],
+                'compactness': computed_compactness['value'],
+                'num_members': district.num_members
             }
 
             if settings.ADJACENCY:
-                features_dict['properties']['adjacency'] = computed_adjacency['value']
+                properties['adjacency'] = computed_adjacency['value']
             if settings.CONVEX_CHOROPLETH:
-                features_dict['properties']['convexhull'] = computed_convex['value']
-            features.append(features_dict)
+                properties['convexhull'] = computed_convex['value']
+            yield (district, properties,)
+
+    def get_vector_tile(self, version, subject_id, geolevel, z, x, y):
+        """
+        Get the districts in this plan as a Mapbox Vector Tile.
+
+        The districts have the same attributes as the GeoJSON WFS 
+        response. Tiles are cached on disk, since the districts of a
+        version do not change; see redistricting.vectortile.
+
+        Parameters:
+            version -- The Plan version.
+            subject_id -- The Subject attributes to attach to the district.
+            geolevel -- The index of the simplified geometry to use.
+            z -- The zoom level of the tile.
+            x -- The column of the tile.
+            y -- The row of the tile.
+
+        Returns:
+            The encoded tile, or None if the tile is not in the world.
+        """
+        bounds = vectortile.tile_bounds(z, x, y)
+        if bounds is None:
+            return None
+
+        path = vectortile.tile_path(self.id, version, geolevel, subject_id, z, x, y)
+        tile = vectortile.read_tile(path)
+        if tile is not None:
+            return tile
+
+        extents = vectortile.tile_bounds(z, x, y, buffer=vectortile.BUFFER)
+        plan_extent = self.get_extent(version)
+        if plan_extent is None or plan_extent[0] > extents[2] or plan_extent[2] < extents[0] or \
+            plan_extent[1] > extents[3] or plan_extent[3] < extents[1]:
+            # No district reaches into this tile
+            features = []
+        else:
+            features = self.get_district_features(version, subject_id, extents, geolevel)
+
+        encoder = vectortile.TileEncoder(bounds)
+        encoder.add_layer('districts', [(district.id, GEOSGeometry(district.chop), properties,) for (district, properties,) in features])
+        tile = encoder.tile
+
+        vectortile.write_tile(path, tile)
+        return tile
+
+    def get_unlocked_geounits(self, version, geolevel_id, selection):
+        """
+        Get the simplified geometries of the geounits in a geolevel that
+        intersect a selection, without the parts that are in locked 
+        districts. Geounits that are entirely locked are left out.
+
+        The locked areas are removed in a single query, so the geounits 
+        are found with the spatial index, and are never loaded as models.
+
+        Parameters:
+            version -- The Plan version.
+            geolevel_id -- The ID of the Geolevel of the geounits.
+            selection -- A GEOSGeometry of the selection, in the srid of
+                the geounits.
+
+        Returns:
+            A generator of tuples of the ID, name, and well known binary
+            of the simplified geometry of each geounit.
+        """
+        locked = [d.id for d in self.get_districts_at_version(version, include_geom=False) if d.is_locked]
 
-        # Return a python dict, which gets serialized into geojson
-        return features
+        cursor = connection.cursor()
+        if len(locked) == 0:
+            cursor.execute("""SELECT g.id, g.name, st_asbinary(g.simple)
+FROM redistricting_geounit AS g
+JOIN redistricting_geounit_geolevel AS gl ON gl.geounit_id = g.id
+WHERE gl.geolevel_id = %s AND st_intersects(g.geom, st_geomfromtext(%s, %s))""", [geolevel_id, selection.wkt, selection.srid or 3785])
+        else:
+            # The simplified locked boundary is a fast, but not completely
+            # accurate lookup; geounits partially split with a locked 
+            # district lose only their locked sections, which are taken 
+            # from the simplified geometries since they are just for display
+            cursor.execute("""WITH locked AS (
+    SELECT st_collect(geom) AS geom FROM redistricting_district WHERE id = ANY(%s)
+), buffered AS (
+    SELECT geom, st_buffer(st_simplifypreservetopology(geom, 100), 100) AS buffered FROM locked
+)
+SELECT g.id, g.name, CASE
+    WHEN st_intersects(g.simple, b.buffered) AND st_overlaps(g.geom, b.geom) THEN st_asbinary(st_difference(g.simple, b.buffered))
+    ELSE st_asbinary(g.simple) END
+FROM redistricting_geounit AS g
+JOIN redistricting_geounit_geolevel AS gl ON gl.geounit_id = g.id
+CROSS JOIN buffered AS b
+WHERE gl.geolevel_id = %s AND st_intersects(g.geom, st_geomfromtext(%s, %s))
+AND NOT (st_intersects(g.simple, b.buffered) AND st_within(g.geom, b.geom))""", [locked, geolevel_id, selection.wkt, selection.srid or 3785])
+
+        while True:
+            rows = cursor.fetchmany(500)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
 
     def get_district_ids_at_version(self, version):
         """
@@ -1588,6 +1836,19 @@ class Plan(models.Model):
         qset = qset.annotate(latest=Max('version'),max_id=Max('id'))
         return qset.values_list('max_id',flat=True)
 
+    def get_extent(self, version):
+        """
+        Get the bounding box of the districts in this plan at a version.
+
+        Parameters:
+            version -- The version of the Districts.
+
+        Returns:
+            The extent of the districts, ordered like a GEOS extent, or
+            None if all the districts are empty.
+        """
+        return PlanExtent.get(self, version)
+
     def get_districts_at_version(self, version, include_geom=False, filter_empty=True):
         """
         Get Plan Districts at a specified version.
@@ -1613,7 +1874,8 @@ class Plan(models.Model):
 
         if filter_empty:
             # Don't return any districts that are empty (asside from the Unassigned district)
-            return filter(lambda x: x.district_id == 0 or x.simple[simplest_level.id-1].num_coords > 0, districts)
+            nonempty = SimpleDistrict.get_nonempty_ids([d.id for d in districts], simplest_level)
+            return filter(lambda x: x.district_id == 0 or x.id in nonempty, districts)
         else:
             return districts
 
@@ -1746,6 +2008,32 @@ class Plan(models.Model):
         
         return geounits
 
+    def get_base_assignments(self, version=None, threshold=100):
+        """
+        Get the district of each assigned base geounit in this plan.
+
+        Parameters:
+            version -- The version of the Plan.
+            threshold - distance threshold used for buffer in/out optimization
+
+        Returns:
+            A tuple of a dict of district ids keyed on base Geounit ID,
+            and a dict of district names keyed on district id. 
+            Unassigned geounits are not included.
+        """
+        if version == None:
+           version = self.version
+
+        assignments = {}
+        names = {}
+        for district in self.get_districts_at_version(version, include_geom=True):
+            if district.district_id > 0:
+                names[district.district_id] = district.long_label
+                for (gid, pid) in district.get_base_geounits(threshold):
+                    assignments[gid] = district.district_id
+
+        return (assignments, names,)
+
     def get_unassigned_geounits(self, threshold=100, version=None):
         """
         Get a list of the geounit ids of the geounits that do not belong to
@@ -1911,6 +2199,7 @@ class Plan(models.Model):
                 for dist in self.district_set.filter(version__in=range(self.version - num_adds + 1, self.version)):
                     dist.version = self.version
                     dist.save()
+                self.planextent_set.filter(version__in=range(self.version - num_adds + 1, self.version)).delete()
 
             # Return status message
             num_fixed = len(to_add)
@@ -2134,6 +2423,97 @@ CROSS JOIN (
         cursor.execute(query)
         return cursor.fetchall()
 
+    def count_district_splits(self, geolevel_id, districts=None, version=None):
+        """
+        Count how many times a geolevel is split by each district, in
+        one query. Only the geounits whose bounding boxes overlap a 
+        district are related to it.
+
+        Parameters:
+            geolevel_id -- ID of the geolevel to perform the split
+                comparison on.
+            districts -- Optional; the Districts of this plan to count.
+                Defaults to all the districts at the version.
+            version -- Optional; the version of the plan, if districts
+                are not provided. Defaults to the most recent version.
+
+        Returns:
+            A dict of the number of splits, keyed on District ID.
+        """
+        if districts is None:
+            version = version if not version is None else self.version
+            districts = self.get_districts_at_version(version, include_geom=False)
+
+        counts = dict((d.id, 0,) for d in districts)
+        if len(counts) == 0:
+            return counts
+
+        query = "SELECT d.id, COUNT(1) FROM redistricting_district d JOIN redistricting_geounit g ON d.geom && g.geom JOIN redistricting_geounit_geolevel l ON l.geounit_id = g.id WHERE d.id IN (%s) AND l.geolevel_id = %d AND ST_Relate(d.geom, g.geom, '***T*****') GROUP BY d.id;" % (','.join([str(id) for id in counts.keys()]), int(geolevel_id))
+
+        cursor = connection.cursor()
+        cursor.execute(query)
+        for (district_id, count,) in cursor.fetchall():
+            counts[district_id] = count
+
+        return counts
+
+    @staticmethod
+    def find_assignment_splits(above, below):
+        """
+        Finds all splits between two layers from the base geounits
+        assigned to each unit of the layers, without comparing geometries.
+
+        A unit in the below layer is split when its base geounits are
+        assigned to more than one unit in the above layer, or are only
+        partly assigned in the above layer.
+
+        Parameters:
+            above -- The layer that is 'above' hierarchically, as a tuple
+                of a dict of unit ids keyed on base Geounit ID, and a
+                dict of unit names keyed on unit id.
+            below -- The layer that is 'below' hierarchically, in the
+                same form as above.
+
+        Returns:
+            An array of splits, given as tuples, in the same form as
+            find_relationships.
+        """
+        (above_units, above_names,) = above
+        (below_units, below_names,) = below
+        if len(below_units) == 0:
+            return []
+
+        above_keys = sorted(above_names.keys())
+        below_keys = sorted(below_names.keys())
+        above_index = dict((key, i,) for (i, key,) in enumerate(above_keys))
+        below_index = dict((key, i,) for (i, key,) in enumerate(below_keys))
+
+        # Base geounits that are not in the above layer get their own index
+        outside = len(above_keys)
+        base_ids = below_units.keys()
+        a = numpy.array([above_index.get(above_units.get(gid), outside) for gid in base_ids], dtype=numpy.int64)
+        b = numpy.array([below_index[below_units[gid]] for gid in base_ids], dtype=numpy.int64)
+
+        # Each distinct pair of units that share a base geounit
+        pairs = numpy.unique(b * (outside + 1) + a)
+        pair_a = pairs % (outside + 1)
+        pair_b = pairs // (outside + 1)
+
+        # Below units that share base geounits with more than one above unit
+        overlaps = numpy.bincount(pair_b, minlength=len(below_keys))
+        split = (overlaps[pair_b] > 1) & (pair_a != outside)
+
+        pair_a = pair_a[split]
+        pair_b = pair_b[split]
+        order = numpy.lexsort((pair_b, pair_a,))
+
+        splits = []
+        for i in order.tolist():
+            above_key = above_keys[pair_a[i]]
+            below_key = below_keys[pair_b[i]]
+            splits.append((above_key, below_key, above_names[above_key], below_names[below_key],))
+        return splits
+
     def find_plan_relationships(self, other_plan, version=None, other_version=None, inverse=False, de_9im='T********'):
         """
         Finds all relationships between this plan and the below one.
@@ -2182,8 +2562,24 @@ CROSS JOIN (
     def find_plan_splits(self, other_plan, version=None, other_version=None, inverse=False):
         """
         Helper method that finds plan splits. See find_plan_relationships for parameter details.
+        Splits are found from the base geounits of both plans, unless the plans have
+        different base geolevels.
         """
-        return self.find_plan_relationships(other_plan, version, other_version, inverse, '***T*****')
+        if not other_plan:
+            raise Exception('Other plan must be specified for use in finding relationships.')
+
+        if self.legislative_body.get_base_geolevel() != other_plan.legislative_body.get_base_geolevel():
+            return self.find_plan_relationships(other_plan, version, other_version, inverse, '***T*****')
+
+        version = version if not version is None else self.version
+        other_version = other_version if not other_version is None else other_plan.version
+
+        mine = self.get_base_assignments(version)
+        others = other_plan.get_base_assignments(other_version)
+
+        if inverse:
+            return Plan.find_assignment_splits(others, mine)
+        return Plan.find_assignment_splits(mine, others)
 
     def find_plan_components(self, other_plan, version=None, other_version=None, inverse=False):
         """
@@ -2240,8 +2636,22 @@ CROSS JOIN (
     def find_geolevel_splits(self, geolevelid, version=None, inverse=False):
         """
         Helper method that finds geolevel splits. See find_plan_relationships for parameter details.
+        Splits are found from the base geounits of the plan and the geolevel, unless the
+        geounits of the geolevel are not linked to the base geounits.
         """
-        return self.find_geolevel_relationships(geolevelid, version, inverse, '***T*****')
+        if not geolevelid:
+            raise Exception('geolevelid must be specified for use in finding splits.')
+
+        geolevel = Geolevel.objects.get(id=geolevelid)
+        units = geolevel.get_base_assignments(self.legislative_body.get_base_geolevel())
+        if units is None:
+            return self.find_geolevel_relationships(geolevelid, version, inverse, '***T*****')
+
+        districts = self.get_base_assignments(version)
+
+        if inverse:
+            return Plan.find_assignment_splits(units, districts)
+        return Plan.find_assignment_splits(districts, units)
 
     def find_geolevel_components(self, geolevelid, version=None, inverse=False):
         """
@@ -2270,27 +2680,47 @@ CROSS JOIN (
                 community_types[d.district_id] = typetags
         return community_types
 
+    def get_community_type_unions(self, community_map_id, version=None, community_version=None):
+        """
+        Get the union of the types of the communities in each district
+        of this plan. The community map is indexed once for all the 
+        districts.
+
+        Parameters:
+            community_map_id -- A L{Plan} ID linked to the 
+                community-mapping L{LegislativeBody}.
+            version -- Optional; the version of this plan. Defaults to 
+                the current plan version.
+            community_version -- Optional; the version of the community
+                map. Defaults to the current community map version.
+
+        Returns:
+            A dictionary of sets of community type Tags, keyed on 
+            district_id. The unassigned district is not included.
+        """
+        version = version if not version is None else self.version
+        index = CommunityIndex.get(community_map_id, community_version)
+
+        unions = {}
+        for district in self.get_districts_at_version(version, include_geom=True):
+            if not district.is_unassigned:
+                unions[district.district_id] = index.get_type_union(district.geom)
+        return unions
+
     def count_community_types(self, version=None):
         """
         Given a plan, return a list of dictionaries, with each community type
         as the value for the 'type' key and the number of times it appears
         in the plan as the value for the 'number' key
         """
-        districts = self.get_districts_at_version(version)
-        items = TaggedItem.objects.filter(object_id__in=[d.id for d in districts])
-        types = {}
-        for i in items:
-            name = i.tag.name
-            if name.startswith('type='):
-                name = name[5:]
-            else:
-                continue
+        if version is None:
+            version = self.version
 
-            if name in types:
-                types[name] += 1
-            else:
-                types[name] = 1
-        return [ {'type': key, 'number': value} for key, value in types.items() ]
+        ct = ContentType.objects.get_for_model(District)
+        ids = list(self.get_district_ids_at_version(version))
+        items = TaggedItem.objects.filter(content_type=ct, object_id__in=ids,
+            tag__name__startswith='type=').values('tag__name').annotate(number=Count('id'))
+        return [ {'type': i['tag__name'][5:], 'number': i['number']} for i in items ]
 
     @staticmethod
     def tag_plan_names(names, types):
@@ -2708,8 +3138,8 @@ class District(models.Model):
 
     def clone_relations_from(self, origin):
         """
-        Copy the computed characteristics, comments, and tags from one 
-        district to another.
+        Copy the computed characteristics, comments, tags, and simplified
+        geometries from one district to another.
 
         Cloning District Characteristics, Comments and Tags are required when 
         cloning, copying, or instantiating a template district.
@@ -2736,6 +3166,8 @@ class District(models.Model):
             item.object_id = self.id
             item.save()
 
+        SimpleDistrict.copy(origin, self)
+
 
     def get_base_geounits(self, threshold=100):
         """
@@ -2768,6 +3200,53 @@ class District(models.Model):
         filter = filter & Q(connect_to_geounit__geom__within=self.geom)
         return list(ContiguityOverride.objects.filter(filter))
     
+    def count_components(self, allow_single_point=False, threshold=100):
+        """
+        Count the number of contiguous parts of this district, using the
+        neighbor graph of the base geounits.
+
+        Geounits are connected if they share a boundary segment, or if
+        allow_single_point is set, if they share a point. ContiguityOverrides
+        that apply to this district connect their geounits as well.
+
+        Parameters:
+            allow_single_point -- Optional; connect geounits that only
+                touch at a point.
+            threshold -- distance threshold used for buffer in/out optimization
+
+        Returns:
+            The number of contiguous parts, or None if the neighbors of
+            the base geolevel have not been computed.
+        """
+        base_id = self.plan.legislative_body.get_base_geolevel()
+        if not GeounitNeighbor.is_built(base_id):
+            return None
+
+        ids = [gid for (gid, pid) in self.get_base_geounits(threshold)]
+        if len(ids) < 2:
+            return len(ids)
+
+        neighbors = GeounitNeighbor.objects.filter(geolevel__id=base_id, geounit__in=ids, neighbor__in=ids)
+        if not allow_single_point:
+            neighbors = neighbors.filter(rook=True)
+        edges = list(neighbors.values_list('geounit_id', 'neighbor_id'))
+
+        # Overrides may reference geounits above the base geolevel, so
+        # connect a base geounit within each of them
+        idset = set(ids)
+        for override in self.get_contiguity_overrides():
+            pair = []
+            for geounit in (override.override_geounit, override.connect_to_geounit,):
+                if geounit.id in idset:
+                    pair.append(geounit.id)
+                else:
+                    inside = Geounit.objects.filter(id__in=ids, center__within=geounit.geom).values_list('id', flat=True)[0:1]
+                    pair.extend(inside)
+            if len(pair) == 2:
+                edges.append(tuple(pair))
+
+        return count_components(ids, edges)
+
     def simplify(self, attempts_allowed=5, attempt_step=.80):
         """
         Simplify the geometry into a geometry collection in the simple 
@@ -2827,6 +3306,39 @@ class District(models.Model):
         self.simple = GeometryCollection(tuple(simples),srid=self.geom.srid)
         self.save()
 
+        # Store each geolevel's geometry on its own, for drawing the map
+        SimpleDistrict.store(self, dict((level.id, simples[level.id - 1],) for level in levels))
+
+        # The geometry has changed, so the geometric metrics are stale
+        DistrictMetrics.objects.filter(district=self).delete()
+
+        # and so may the extent of the plan
+        PlanExtent.update(plan, self.version)
+
+    def get_metrics(self):
+        """
+        Get the geometric metrics of this district. The metrics are 
+        computed and stored the first time they are requested.
+
+        Returns:
+            The L{DistrictMetrics} of this district.
+        """
+        return DistrictMetrics.compute(self)
+
+    def get_adjacency(self, store=None):
+        """
+        Get the sums of the costs between the base geounits of this
+        district. The sums are computed and stored the first time they
+        are requested, and carried forward as the district is edited.
+
+        Parameters:
+            store -- Optional. The CostStore of the costs.
+
+        Returns:
+            The L{DistrictAdjacency} of this district.
+        """
+        return DistrictAdjacency.compute(self, store)
+
     def count_community_type_union(self, community_map_id, version=None):
         """
         Count the number of distinct types of communities in the provided
@@ -2854,22 +3366,7 @@ class District(models.Model):
             Defaults to the current plan version.
         @return: The set of all community types in this district.
         """
-        community_map = Plan.objects.get(id=community_map_id)
-
-        if version is None:
-            version = community_map.version
-
-        # Filters - first get all districts
-        communities = community_map.get_districts_at_version(version, include_geom=True)
-        # Filter quickly by envelope
-        communities = filter(lambda z: True if self.geom.envelope.intersects(z.geom.envelope) else False, communities)
-        # Filter by relation - must have interior intersection
-        communities = filter(lambda z: True if self.geom.relate_pattern(z.geom, 'T********') else False, communities)
-
-        types = set()
-        for community in communities:
-            types = types | set(Tag.objects.get_for_object(community).filter(name__startswith='type='))
-        return types
+        return CommunityIndex.get(community_map_id, version).get_type_union(self.geom)
 
     def reaggregate(self, geounit_ids=None):
         """
@@ -2906,6 +3403,9 @@ class District(models.Model):
                 if not cc.number:
                     cc.number = '00000000.0000'
                 cc.save()
+
+            # The cached tiles of the district show the old numbers
+            vectortile.clear_tiles(self.plan_id, self.version)
             return True
         except Exception as ex:
             logger.info('Unable to reaggreagate district "%s"', self.long_label)
@@ -2920,11 +3420,7 @@ class District(models.Model):
             comparison on.
         @return: The number of times the geolevel is split by the district.
         """
-        query = "SELECT COUNT(1) FROM redistricting_district d, redistricting_geounit_geolevel l JOIN redistricting_geounit g on l.geounit_id = g.id WHERE d.id = %d AND l.geolevel_id = %d AND ST_Relate(d.geom, g.geom, '***T*****');" % (self.id, geolevel_id)
-
-        cursor = connection.cursor()
-        cursor.execute(query)
-        return cursor.fetchone()[0]
+        return self.plan.count_district_splits(geolevel_id, districts=[self])[self.id]
         
 
 # Enable tagging of districts by registering them with the tagging module
@@ -2959,972 +3455,2714 @@ class ComputedCharacteristic(models.Model):
         """
         ordering = ['subject']
 
-class Profile(models.Model):
+class DistrictMetrics(models.Model):
     """
-    Extra user information that doesn't fit in Django's default user
-    table.
+    DistrictMetrics are cached geometric measurements of a District.
 
-    Profiles for The Public Mapping Project include a password hint,
-    and an organization name.
+    The compactness calculators all measure the same properties of a
+    district's geometry: the area, perimeter, convex hull, bounding box,
+    and minimum enclosing circle. These are computed together, once per
+    district version, and stored here.
     """
-    user = models.OneToOneField(User)
 
-    # A user's organization
-    organization = models.CharField(max_length=256)
+    # The district that was measured
+    district = models.OneToOneField(District)
 
-    # A user's password hint.
-    pass_hint = models.CharField(max_length=256)
+    # The area of the district
+    area = models.FloatField()
+
+    # The length of all the rings of the district
+    perimeter = models.FloatField()
+
+    # The area of the convex hull of the district
+    hull_area = models.FloatField()
+
+    # The coordinates of the convex hull ring, as a JSON list
+    hull = models.TextField()
+
+    # The bounding box of the district
+    minx = models.FloatField()
+    miny = models.FloatField()
+    maxx = models.FloatField()
+    maxy = models.FloatField()
+
+    # The minimum enclosing circle of the district
+    circle_x = models.FloatField(null=True, blank=True)
+    circle_y = models.FloatField(null=True, blank=True)
+    circle_r = models.FloatField(null=True, blank=True)
 
     def __unicode__(self):
+        return 'Metrics for %s' % self.district
+
+    @property
+    def empty(self):
         """
-        Represent the Profile as a unicode string. This is the a string
-        with the User's name.
+        Was the district geometry empty when it was measured?
         """
-        return "%s's profile" % self.user.username
+        return self.perimeter == 0 and self.area == 0
 
+    @property
+    def extent(self):
+        """
+        The bounding box of the district, ordered like a GEOS extent.
+        """
+        return (self.minx, self.miny, self.maxx, self.maxy,)
 
-def update_profile(sender, **kwargs):
-    """
-    A trigger that creates profiles when a user is saved.
-    """
-    created = kwargs['created']
-    user = kwargs['instance']
-    if created:
-        profile = Profile(user=user, organization='', pass_hint='')
-        profile.save()
+    def get_hull(self):
+        """
+        Get the coordinates of the convex hull ring.
 
-def set_district_id(sender, **kwargs):
-    """
-    Incremented the district_id (NOT the primary key id) when a district
-    is saved. The district_id is unique to the plan/version.  The 
-    district_id may already be set, but this method ensures that it is set
-    when saved.
-    """
-    district = kwargs['instance']
-    if district.district_id is None:
-        districts = district.plan.get_districts_at_version(district.version, include_geom=False)
-        ids_in_use = map(lambda d: d.district_id, districts)
-        max_districts = district.plan.legislative_body.max_districts + 1
-        if len(ids_in_use) >= max_districts:
-            raise ValidationError("Plan is at maximum district capacity of %d" % max_districts)
-        else:
-            # Find one not in use - 0 is unassigned
-            # TODO - update this if unassigned is not district_id 0
-            for i in range(1, max_districts+1):
-                if i not in ids_in_use:
-                    district.district_id = i
-                    return
+        Returns:
+            A list of (x,y) coordinates.
+        """
+        return json.loads(self.hull)
 
-def update_plan_edited_time(sender, **kwargs):
-    """
-    Update the time that the plan was edited whenever the plan is saved.
-    """
-    district = kwargs['instance']
-    plan = district.plan;
-    plan.edited = datetime.now()
-    plan.save()
+    @staticmethod
+    def measure(district):
+        """
+        Measure the geometry of a district in one pass. The returned 
+        metrics are not saved.
 
-def create_unassigned_district(sender, **kwargs):
-    """
-    When a new plan is saved, all geounits must be inserted into the 
-    Unassigned districts.
-    """
-    plan = kwargs['instance']
-    created = kwargs['created']
+        Parameters:
+            district -- The District to measure.
 
-    if created and plan.create_unassigned:
-        plan.create_unassigned = False
+        Returns:
+            A new, unsaved DistrictMetrics.
+        """
+        metrics = DistrictMetrics(district=district, area=0, perimeter=0, 
+            hull_area=0, hull='[]', minx=0, miny=0, maxx=0, maxy=0)
+
+        geom = district.geom
+        if geom is None or geom.empty:
+            return metrics
+
+        metrics.area = geom.area
+        metrics.perimeter = geom.length
+        (metrics.minx, metrics.miny, metrics.maxx, metrics.maxy,) = geom.extent
+
+        hull = geom.convex_hull
+        metrics.hull_area = hull.area
+        if hull.geom_type == 'Polygon':
+            coords = list(hull.coords[0])
+            # The first and last coordinates of the ring are the same
+            circle = enclosing_circle(coords[1:])
+        elif hull.geom_type == 'Point':
+            coords = [hull.coords]
+            circle = enclosing_circle(coords)
+        else:
+            coords = list(hull.coords)
+            circle = enclosing_circle(coords)
+        metrics.hull = json.dumps(coords)
 
-        unassigned = District(short_label=u"\u0398",long_label=_("Unassigned"), version=0, plan=plan, district_id=0)
+        if not circle is None:
+            (metrics.circle_x, metrics.circle_y, metrics.circle_r,) = circle
 
-        biggest_geolevel = plan.get_biggest_geolevel()
-        all_geom = biggest_geolevel.geounit_set.collect().buffer(0)
-        if all_geom.geom_type == 'MultiPolygon':
-            all_geom = all_geom.cascaded_union
+        return metrics
 
-        if plan.district_set.count() > 0:
-            taken = plan.district_set.all().unionagg()
-            unassigned.geom =  enforce_multi(all_geom.difference(taken))
-            unassigned.simplify() # implicit save
-            geounit_ids = map(str, biggest_geolevel.geounit_set.filter(geom__bboverlaps=unassigned.geom).values_list('id', flat=True))
-            geounits = Geounit.get_mixed_geounits(geounit_ids, plan.legislative_body, biggest_geolevel.id, unassigned.geom, True)
-        else:
-            unassigned.geom = enforce_multi(all_geom)
-            unassigned.simplify() #implicit save
-            geounits = biggest_geolevel.geounit_set.all()
+    @staticmethod
+    def compute(district):
+        """
+        Get the metrics of a district. This method will leverage the 
+        cache when it is available, or it will populate the cache if it
+        is not.
 
-        unassigned.delta_stats(geounits, True)
+        Parameters:
+            district -- The District to measure.
 
-        
-# Connect the post_save signal from a User object to the update_profile
-# helper method
-post_save.connect(update_profile, sender=User, dispatch_uid="publicmapping.redistricting.User")
-# Connect the pre_save signal to the set_district_id helper method
-pre_save.connect(set_district_id, sender=District)
-# Connect the post_save signal to the update_plan_edited_time helper method
-post_save.connect(update_plan_edited_time, sender=District)
-# Connect the post_save signal from a Plan object to the 
-# create_unassigned_district helper method (don't remove the dispatch_uid or 
-# this signal is sent twice)
-post_save.connect(create_unassigned_district, sender=Plan, dispatch_uid="publicmapping.redistricting.Plan")
+        Returns:
+            The DistrictMetrics for the district.
+        """
+        try:
+            return DistrictMetrics.objects.get(district=district)
+        except DistrictMetrics.DoesNotExist:
+            pass
 
-def can_edit(user, plan):
-    """
-    Can a user edit a plan?
-    
-    In order to edit a plan, Users must own it or be a staff member.  
-    Templates cannot be edited, only copied.
+        metrics = DistrictMetrics.measure(district)
+        if district.id is None:
+            return metrics
 
-    Parameters:
-        user -- A User
-        plan -- A Plan
+        # A savepoint keeps the transaction usable if the insert fails
+        sid = transaction.savepoint()
+        try:
+            metrics.save()
+            transaction.savepoint_commit(sid)
+        except IntegrityError as ex:
+            # Another process may have stored these metrics already
+            transaction.savepoint_rollback(sid)
+            logger.info('Could not store metrics for district %d.', district.id)
+            logger.debug('Reason: %s', ex)
 
-    Returns:
-        True if the User has permissions to edit the Plan.
+        return metrics
 
-    """
-    return (plan.owner == user or user.is_staff) and not plan.is_template and not plan.is_shared
 
-def can_view(user, plan):
+class SimpleDistrict(models.Model):
     """
-    Can a user view a plan?
-
-    In order to view a plan, the plan must have the shared flag set.
-
-    Parameters:
-        user -- A User
-        plan -- A Plan
+    SimpleDistrict is the simplified geometry of a District at one
+    Geolevel.
 
-    Returns:
-        True if the User has permissions to view the Plan.
+    The simple field of a District holds the simplified geometries of all
+    geolevels in one collection, which is read whole even when only one
+    geolevel is drawn. These rows hold the same geometries one geolevel
+    at a time, with a spatial index, so the map reads only the geometry
+    of the geolevel it shows. They are written when the district is
+    simplified, and copied with the district.
     """
-    return plan.owner == user or plan.is_shared or plan.is_template
 
+    # The district that was simplified
+    district = models.ForeignKey(District)
 
-def can_copy(user, plan):
-    """
-    Can a user copy a plan?
+    # The geolevel whose tolerance simplified the district
+    geolevel = models.ForeignKey(Geolevel)
 
-    In order to copy a plan, the user must be the owner, or a staff 
-    member to copy a plan they own.  Any registered user can copy a 
-    template.
+    # The simplified geometry
+    geom = models.MultiPolygonField(srid=3785)
 
-    Parameters:
-        user -- A User
-        plan -- A Plan
+    # The number of coordinates in the simplified geometry
+    num_coords = models.IntegerField()
 
-    Returns:
-        True if the User has permission to copy the Plan.
-    """
-    return plan.is_template or plan.is_shared or plan.owner == user or user.is_staff
+    # The bounding box of the simplified geometry
+    minx = models.FloatField()
+    miny = models.FloatField()
+    maxx = models.FloatField()
+    maxy = models.FloatField()
 
-def empty_geom(srid):
-    """
-    Create an empty MultiPolygon.
+    objects = models.GeoManager()
 
-    Parameters:
-        srid -- The spatial reference for this empty geometry.
+    class Meta:
+        unique_together = ('district','geolevel',)
 
-    Returns:
-        An empty geometry.
-    """
-    return MultiPolygon([], srid=srid)
+    def __unicode__(self):
+        return 'Simplified %s at %s' % (self.district, self.geolevel)
 
-def enforce_multi(geom, collapse=False):
-    """
-    Make a geometry a multi-polygon geometry.
+    @property
+    def extent(self):
+        """
+        The bounding box of the geometry, ordered like a GEOS extent.
+        """
+        return (self.minx, self.miny, self.maxx, self.maxy,)
 
-    This method wraps Polygons in MultiPolygons. If geometry exists, but is
-    neither polygon or multipolygon, an empty geometry is returned. If no
-    geometry is provided, no geometry (None) is returned.
+    @staticmethod
+    def store(district, simples):
+        """
+        Replace the simplified geometries of a district.
 
-    Parameters:
-        geom -- The geometry to check/enforce.
-        collapse -- A flag indicating that this method should collapse 
-                    the resulting multipolygon via cascaded_union. With
-                    this flag, the method still returns a multipolygon.
-    Returns:
-        A multi-polygon from any geometry type.
-    """
-    mpoly = MultiPolygon([])
-    if not geom is None:
-        mpoly.srid = geom.srid
+        Parameters:
+            district -- The District that was simplified.
+            simples -- A dict of the simplified geometry at each Geolevel
+                id.
+        """
+        SimpleDistrict.objects.filter(district=district).delete()
+        for (geolevel_id, geom,) in simples.items():
+            geom = enforce_multi(geom)
+            simple = SimpleDistrict(district=district, geolevel_id=geolevel_id,
+                geom=geom, num_coords=geom.num_coords, minx=0, miny=0, maxx=0, maxy=0)
+            if not geom.empty:
+                (simple.minx, simple.miny, simple.maxx, simple.maxy,) = geom.extent
+            simple.save()
 
-    if geom.empty:
-        pass
-    elif geom.geom_type == 'MultiPolygon':
-        if collapse:
-            mpoly = enforce_multi( geom.cascaded_union )
-        else:
-            mpoly = geom
-    elif geom.geom_type == 'Polygon':
-        # Collapse has no meaning if this is a single polygon
-        mpoly.append(geom)
-    elif geom.geom_type == 'GeometryCollection':
-        components = []
-        for item in geom:
-            for component in enforce_multi(item):
-                mpoly.append(component)
+    @staticmethod
+    def copy(origin, district):
+        """
+        Copy the simplified geometries of one district to another district
+        with the same geometry. Nothing is copied if the district was 
+        already simplified.
 
-        if collapse:
-            # Collapse the multipolygon group
-            mpoly = enforce_multi( mpoly, collapse )
+        Parameters:
+            origin -- The source District.
+            district -- The District that receives the copies.
+        """
+        if SimpleDistrict.objects.filter(district=district).exists():
+            return
 
-    return mpoly
+        for simple in SimpleDistrict.objects.filter(district=origin):
+            simple.id = None
+            simple.district = district
+            simple.save()
 
-def safe_union(collection):
-    """
-    Attempt to safely union a set of geometries. Sometimes, the default
-    union() method on a geometry collection and/or geoqueryset results
-    in a TopologyException. This method attempts to create a safe union
-    of geometries by buffering the collection to 0, then performing a
-    cascaded union on the remainder (if the result of the buffer is a
-    multipolygon).
-    """
-    if isinstance(collection, GeoQuerySet):
-        # collection is a GeoQuerySet
-        thegeom = collection.collect()
-        if collection.count() == 0:
-            return thegeom
-    elif isinstance(collection, GeometryCollection):
-        # collection is a GeometryCollection
-        thegeom = collection
+    @staticmethod
+    def get_nonempty_ids(district_ids, geolevel):
+        """
+        Get the districts that have any area at a geolevel.
 
-    thegeom = thegeom.buffer(0)
+        Parameters:
+            district_ids -- The ids of the Districts to check.
+            geolevel -- The Geolevel of the simplified geometries.
 
-    if thegeom.geom_type == 'MultiPolygon':
-        thegeom = thegeom.cascaded_union
+        Returns:
+            A set of the ids of the districts that are not empty.
+        """
+        qset = SimpleDistrict.objects.filter(district__in=district_ids,
+            geolevel=geolevel, num_coords__gt=0)
+        return set(qset.values_list('district_id', flat=True))
 
-    return thegeom
 
-class ScoreFunction(BaseModel):
+class PlanExtent(models.Model):
     """
-    Score calculation definition
+    PlanExtent is the bounding box of the simplified geometries of the
+    districts in one version of a Plan.
+
+    The extent is stored when a district of the version is simplified,
+    so the map doesn't aggregate the geometries of every district in the
+    plan's history when it needs the bounds of the plan.
     """
 
-    # Namepace of the calculator module to use for scoring
-    calculator = models.CharField(max_length=500)
+    # The plan that was measured
+    plan = models.ForeignKey(Plan)
 
-    # Name of this score function
-    name = models.CharField(max_length=50)
+    # The version of the plan
+    version = models.PositiveIntegerField()
 
-    # Whether or not this score function is for a plan
-    is_planscore = models.BooleanField(default=False)
+    # The bounding box of the districts at the version
+    minx = models.FloatField()
+    miny = models.FloatField()
+    maxx = models.FloatField()
+    maxy = models.FloatField()
 
-    # Whether a user can select this function for use in a 
-    # statistics set, per legislative levelqq
-    selectable_bodies = models.ManyToManyField(LegislativeBody)
-    
     class Meta:
-        """
-        Additional information about the Subject model.
-        """
+        unique_together = ('plan','version',)
 
-        # The default method of sorting Subjects should be by 'sort_key'
-        ordering = ['name']
+    def __unicode__(self):
+        return 'Extent of %s v%d' % (self.plan, self.version)
 
-        # A unique constraint on the name
-        unique_together = ('name',)
+    @property
+    def extent(self):
+        """
+        The bounding box of the plan, ordered like a GEOS extent.
+        """
+        return (self.minx, self.miny, self.maxx, self.maxy,)
 
-    def get_calculator(self):
+    @staticmethod
+    def update(plan, version):
         """
-        Retrieve a calculator instance by name.
+        Measure and store the extent of a plan version.
 
         Parameters:
-            name -- The fully qualified name of the calculator class.
+            plan -- The Plan to measure.
+            version -- The version of the plan.
 
         Returns:
-            An instance of the requested calculator.
+            The extent of the plan version, ordered like a GEOS extent, or
+            None if all the districts at the version are empty.
         """
-        parts = self.calculator.split('.')
-        module = ".".join(parts[:-1])
-        m = __import__( module )
-        for comp in parts[1:]:
-            m = getattr(m, comp)            
-        return m()
+        district_ids = plan.get_district_ids_at_version(version)
+        bounds = SimpleDistrict.objects.filter(district__in=district_ids,
+            num_coords__gt=0).aggregate(Min('minx'), Min('miny'), Max('maxx'), Max('maxy'))
+        extent = (bounds['minx__min'], bounds['miny__min'], bounds['maxx__max'], bounds['maxy__max'],)
 
-    def score(self, districts_or_plans, format='raw', version=None, score_arguments=None):
+        if extent[0] is None:
+            PlanExtent.objects.filter(plan=plan, version=version).delete()
+            return None
+
+        (stored, created,) = PlanExtent.objects.get_or_create(plan=plan, version=version,
+            defaults=dict(zip(('minx','miny','maxx','maxy',), extent)))
+        if not created and stored.extent != extent:
+            (stored.minx, stored.miny, stored.maxx, stored.maxy,) = extent
+            stored.save()
+
+        return extent
+
+    @staticmethod
+    def get(plan, version):
         """
-        Calculate the score for the object or list of objects passed in.
+        Get the extent of a plan version. The extent is measured and
+        stored if it has not been stored yet.
 
         Parameters:
-            districts_or_plans -- Either a single district, a single plan,
-                a list of districts, or a list of plans. Whether or not 
-                this deals with districts or plans must be in sync with 
-                the value of is_planscore.
-            format -- One of 'raw', 'html', or 'json'.
-                Determines how the results should be returned.
-            score_arguments -- a list of ScoreArguments to override the entries
-                linked through the database
+            plan -- The Plan.
+            version -- The version of the plan.
 
         Returns:
-            A score for each district or plan contained within 
-            districts_or_plans. If districts_or_plans is a single 
-            district or plan, a single result will be returned. If it 
-            is a list, a list of results in the same order as
-            districts_or_plans will be returned.
+            The extent of the plan version, ordered like a GEOS extent, or
+            None if all the districts at the version are empty.
         """
-        # Raises an ImportError if there is no calculator with the given name
-        calc = self.get_calculator()
+        try:
+            return PlanExtent.objects.get(plan=plan, version=version).extent
+        except PlanExtent.DoesNotExist:
+            return PlanExtent.update(plan, version)
 
-        # Is districts_or_plans a list, or a single district/plan?
-        is_list = isinstance(districts_or_plans, list)
 
-        # Calculate results for every item in the list
-        results = []
-        for dp in (districts_or_plans if is_list else [districts_or_plans]):
-            # Add all arguments that are defined for this score function
-            if score_arguments is not None:
-                args = score_arguments
-            else:
-                args = ScoreArgument.objects.filter(function=self)
-            arg_lst = []
-            for arg in args:
-                # For 'score' types, calculate the score, and then pass the result on
-                if (arg.type != 'score'):
-                    calc.arg_dict[arg.argument] = (arg.type, arg.value)
-                else:
-                    score_fn = ScoreFunction.objects.get(name=arg.value)
-
-                    # If this is a plan score and the argument is a 
-                    # district score, extract the districts from the 
-                    # plan, score each individually, # and pass into the 
-                    # score function as a list
-                    if not (self.is_planscore and not score_fn.is_planscore):
-                        calc.arg_dict[arg.argument] = ('literal', score_fn.score(dp, format=format, version=version))
-                    else:
-                        version = dp.version if version is None else version
-                        for d in dp.get_districts_at_version(version):
-                            res = score_fn.score(d, format=format, version=version)
-                            if isinstance(res,dict) and 'value' in res:
-                                res = res['value']
-                            arg_lst.append(res)
+class DistrictAdjacency(models.Model):
+    """
+    DistrictAdjacency is the running sum of the costs between every pair
+    of base geounits in a District, used by the Adjacency calculator.
 
-            # Build the keyword arguments based on whether this is for districts, plans, or list
-            if len(arg_lst) > 0:
-                kwargs = { 'list': arg_lst }
-            elif self.is_planscore:
-                kwargs = { 'plan': dp, 'version': version if version is not None else dp.version }
-            else:
-                kwargs = { 'district': dp }
+    The sum is computed in full the first time it is needed. When a
+    district is edited, the sum of the new version is derived from the
+    sum of the previous version, using only the costs between the
+    geounits that moved and the rest of the district.
+    """
 
-            # Ask the calculator instance to compute the result
-            calc.compute(**kwargs)
+    # The district whose costs are summed
+    district = models.OneToOneField(District)
 
-            # Format the result
-            fl = format.lower()
-            r = calc.html() if fl == 'html' else (calc.json() if fl == 'json' else calc.result)
-            results.append(r)
+    # The sum of the costs between each pair of base geounits
+    cost_sum = models.FloatField()
 
-        return results if is_list else results[0]
+    # The number of pairs of base geounits
+    pair_count = models.BigIntegerField()
 
     def __unicode__(self):
+        return 'Adjacency for %s' % self.district
+
+    @property
+    def value(self):
         """
-        Get a unicode representation of this object. This is the 
-        ScoreFunction's name.
+        The average cost between the pairs of base geounits.
         """
-        return self.get_label()
+        if self.pair_count == 0:
+            return 0
+        return self.cost_sum / self.pair_count
 
+    def store(self):
+        """
+        Save these sums, logging instead of failing if another process
+        saved them already.
+        """
+        # A savepoint keeps the transaction usable if the insert fails
+        sid = transaction.savepoint()
+        try:
+            self.save()
+            transaction.savepoint_commit(sid)
+        except IntegrityError as ex:
+            # Another process may have stored these sums already
+            transaction.savepoint_rollback(sid)
+            logger.info('Could not store adjacency for district %d.', self.district.id)
+            logger.debug('Reason: %s', ex)
 
-class ScoreArgument(models.Model):
-    """
-    Defines the arguments passed into a score function
-    """
+    @staticmethod
+    def compute(district, store=None):
+        """
+        Get the adjacency sums of a district. This method will leverage
+        the cache when it is available, or it will sum every pair of 
+        base geounits and populate the cache if it is not.
 
-    # The score function this argument is for
-    function = models.ForeignKey(ScoreFunction)
+        Parameters:
+            district -- The District to sum.
+            store -- Optional. The CostStore of the costs.
 
-    # The name of the argument of the score function
-    argument = models.CharField(max_length=50)
+        Returns:
+            The DistrictAdjacency for the district.
+        """
+        try:
+            return DistrictAdjacency.objects.get(district=district)
+        except DistrictAdjacency.DoesNotExist:
+            pass
 
-    # The value of the argument to be passed
-    value = models.CharField(max_length=50)
+        if store is None:
+            store = get_cost_store()
 
-    # The type of the argument (literal, score, subject)
-    type = models.CharField(max_length=10)
+        portable_ids = [pid for (gid, pid) in district.get_base_geounits()]
+        (total, count,) = store.pair_sum(portable_ids)
+        adjacency = DistrictAdjacency(district=district, cost_sum=total, pair_count=count)
+        if not district.id is None:
+            adjacency.store()
 
-    def __unicode__(self):
-        """
-        Get a unicode representation of this object. This is the Argument's
-        arg/value/type.
+        return adjacency
+
+    @staticmethod
+    def carry(district, previous, previous_geom, moved):
         """
-        return "%s / %s / %s" % (self.argument, self.type, self.value)
+        Derive the adjacency sums of an edited district from the sums
+        of the version it was edited from. Nothing is stored if the 
+        previous version was never summed; the sums will be computed in 
+        full when they are first needed.
 
-class ScoreDisplay(BaseModel):
-    """
-    Container for displaying score panels
-    """
+        Parameters:
+            district -- The new version of the District.
+            previous -- The id of the District it was edited from.
+            previous_geom -- The geometry of the District it was 
+                edited from.
+            moved -- A list of tuples of the Geounit IDs and portable ids
+                of the base geounits that may have entered or left the 
+                district. The sums are carried over unchanged if it is 
+                empty.
+        """
+        if not settings.ADJACENCY or district.id is None:
+            return
 
-    # The name of the score display
-    name = models.CharField(max_length=50)
+        try:
+            prior = DistrictAdjacency.objects.get(district__id=previous)
+        except DistrictAdjacency.DoesNotExist:
+            return
 
-    # The title of the score display, user-specifiable
-    title = models.CharField(max_length=50)
+        if district.id == previous:
+            adjacency = prior
+        else:
+            adjacency = DistrictAdjacency(district=district, 
+                cost_sum=prior.cost_sum, pair_count=prior.pair_count)
+
+        if len(moved) > 0:
+            members = set([pid for (gid, pid) in district.get_base_geounits()])
+
+            # Select the previous members the same way as the current
+            # ones, so units near the border are not counted as moved
+            before = set()
+            if previous_geom and not previous_geom.empty:
+                before = set([pid for (gid, pid) in district.plan.get_base_geounits_in_geom(previous_geom)])
+            added = list(members - before)
+            removed = list(before - members)
+
+            if len(added) > 0 or len(removed) > 0:
+                rest = members - set(added)
+
+                try:
+                    store = get_cost_store()
+                    total = adjacency.cost_sum
+                    if len(removed) > 0:
+                        total -= store.cross_sum(removed, rest)
+                        total -= store.pair_sum(removed)[0]
+                    if len(added) > 0:
+                        total += store.cross_sum(added, rest)
+                        total += store.pair_sum(added)[0]
+                except Exception as ex:
+                    logger.info('Could not update adjacency for district %d.', district.id)
+                    logger.debug('Reason: %s', ex)
+                    if district.id == previous:
+                        prior.delete()
+                    return
 
-    # The legislative body that this score display is for
-    legislative_body = models.ForeignKey(LegislativeBody)
+                num = len(members)
+                adjacency.cost_sum = total
+                adjacency.pair_count = num * (num - 1) / 2
 
-    # Whether or not this score display belongs on the leaderboard page
-    is_page = models.BooleanField(default=False)
+        adjacency.store()
 
-    # The style to be assigned to this score display
-    cssclass = models.CharField(max_length=50, blank=True)
 
-    # The owner of this ScoreDisplay
-    owner = models.ForeignKey(User)
+class CommunityIndex(object):
+    """
+    An index of the communities in a community map at one version.
+
+    The envelopes of the communities are kept in an array, so the 
+    communities that may intersect a district are found without a 
+    query, and their geometries are prepared for the intersection tests.
+    Indexes are kept for the life of the process, and are rebuilt when 
+    the districts of the community map change. The community types are
+    read in one query each time an index is requested, since tags may 
+    change without a new version.
+    """
 
-    class Meta:
-        """
-        Define a unique constraint on 2 fields of this model.
-        """
-        unique_together = ('name','title','owner','legislative_body')
+    # The indexes that have been loaded in this process, keyed on the
+    # community map ID and version
+    _indexes = {}
 
-    def __unicode__(self):
-        """
-        Get a unicode representation of this object. This is the Display's
-        title.
+    # The most indexes to keep in this process
+    max_indexes = 20
+
+    def __init__(self, ids, communities):
         """
-        if not self.title is None and self.title != '':
-            return self.title
-        else:
-            return self.get_short_label()
+        Index the communities of a community map.
 
-    def copy_from(self, display=None, functions=[], owner=None, title=None):
-        """ 
-        Given a scoredisplay and a list of functions, this method
-        will copy the display and assign the copy to the new owner
-        
         Parameters:
-            display -- a ScoreDisplay to copy - the current 
-               Demographics display 
-            functions -- a list of ScoreFunctions or the primary
-                keys of ScoreFunctions to replace in the display's
-                first "district" ScorePanel
-            owner -- the owner of the new ScoreDisplay - only set if we're not copying self
-            title -- the title of the new scorefunction - only set if we're not copying self
-        
-        Returns:
-            The new ScoreDisplay
+            ids -- The IDs of all the Districts of the community map 
+                at the version.
+            communities -- The Districts of the community map at the
+                version, with their geometries.
         """
-        
-        if display == None:
-            return
-
-        if self != display:
-            self = copy(display)
-            self.id = None
-            self.name = ''
-
-            self.owner = owner if owner != None else display.owner
+        self.ids = ids
+        self.members = [c.id for c in communities]
+        self.communities = [c for c in communities if c.geom and not c.geom.empty]
+        self.prepared = [c.geom.prepared for c in self.communities]
 
-            # We can't have duplicate titles per owner so append "copy" if we must
-            if self.owner == display.owner:
-                self.title = title if not title is None else "%s copy" % display.__unicode__()
-            else:
-                self.title = title if not title is None else display.__unicode__()
+        extents = [c.geom.extent for c in self.communities]
+        self.extents = numpy.array(extents, dtype=numpy.float64).reshape((len(extents), 4,))
 
-            self.save()
-            self.scorepanel_set = display.scorepanel_set.all()
+        self.types = {}
 
-        else:
-            self = display
+    @staticmethod
+    def get(community_map_id, version=None):
+        """
+        Get the index of a community map, with its current community types.
 
+        Parameters:
+            community_map_id -- A L{Plan} ID linked to the 
+                community-mapping L{LegislativeBody}.
+            version -- Optional; the version of the community map. 
+                Defaults to the current plan version.
 
-        try:
-            public_demo = self.scorepanel_set.get(type='district')
-            if self != display:
-                self.scorepanel_set.remove(public_demo)
-                demo_panel = copy(public_demo)
-                demo_panel.id = None
-                demo_panel.name = '%(display_title)s Demographics' % {'display_title':self.title}
-                demo_panel.save()
-                self.scorepanel_set.add(demo_panel)
-            else:
-                demo_panel = public_demo
+        Returns:
+            A CommunityIndex.
+        """
+        community_map = Plan.objects.get(id=community_map_id)
+        if version is None:
+            version = community_map.version
 
-            demo_panel.score_functions.clear()
-            if len(functions) == 0:
-                return self
-            for function in functions:
-                if isinstance(function, types.IntType):
-                    function = ScoreFunction.objects.get(pk=function) 
-                if isinstance(function, types.StringTypes):
-                    function = ScoreFunction.objects.get(pk=int(function))
-                if type(function) == ScoreFunction:
-                    demo_panel.score_functions.add(function)
-            demo_panel.save()
-            self.scorepanel_set.add(demo_panel)
-            self.save()
-        except Exception, ex:
-            logger.info('Failed to copy ScoreDisplay %s to %s', display.__unicode__(), self.__unicode__())
-            logger.debug('Reason: %s', ex)
+        key = (community_map.id, version,)
+        ids = tuple(sorted(community_map.get_district_ids_at_version(version)))
+        index = CommunityIndex._indexes.get(key)
+        if index is None or index.ids != ids:
+            if len(CommunityIndex._indexes) >= CommunityIndex.max_indexes:
+                CommunityIndex._indexes.clear()
+            communities = community_map.get_districts_at_version(version, include_geom=True)
+            index = CommunityIndex(ids, communities)
+            CommunityIndex._indexes[key] = index
 
-        return self
+        index.load_types()
+        return index
 
-    def render(self, dorp, context=None, version=None, components=None, function_ids=None):
+    def load_types(self):
         """
-        Generate the markup for all the panels attached to this display.
+        Read the community type tags of all the communities in one query.
+        """
+        ct = ContentType.objects.get_for_model(District)
+        items = TaggedItem.objects.filter(content_type=ct, object_id__in=self.members, 
+            tag__name__startswith='type=').select_related('tag')
 
-        If the is_page property is set, render expects to receive a list
-        of valid plans.
+        types = {}
+        for item in items:
+            types.setdefault(item.object_id, set()).add(item.tag)
+        self.types = types
 
-        If the is_page property is not set, render expects to receive a
-        single plan, or a list of districts.
+    def find(self, geom):
+        """
+        Find the communities whose interiors intersect a geometry.
 
         Parameters:
-            dorp -- A list of districts, plan, or list of plans.
-            context -- Optional object that can be used for advanced rendering
-            components -- Optional list of tuples that can be used to recompose
-                the elements of a ScoreDisplay at runtime.  Each tuple should 
-                consist of a ScorePanel at index 0, followed by any number of 
-                ScoreFunctions tuples - a ScoreFunction followed by its arguments.
-            version -- Optional; the version of the plan or district to render.
-            function_ids -- Optional list of ScoreFunction ids in which to restrict rendering
+            geom -- The geometry to compare, usually a district.
 
         Returns:
-            The markup for this display.
+            A list of the community Districts.
         """
-        is_list = isinstance(dorp, list)
+        if geom is None or geom.empty or len(self.communities) == 0:
+            return []
 
-        if self.is_page and \
-            (is_list and \
-                any(not isinstance(item,Plan) for item in dorp)):
-            # If this display is a page, it should receive a list of plans
-            return ''
-        elif not self.is_page:
-            if is_list and \
-                any(not isinstance(item,District) for item in dorp):
-                # If this display is not a page, the list should be a set
-                # of districts.
-                return ''
-            elif not is_list and \
-                not isinstance(dorp,Plan):
-                # If this display is not a page, the item should be a plan.
-                return ''
+        # Filter quickly by envelope
+        (minx, miny, maxx, maxy,) = geom.extent
+        e = self.extents
+        candidates = numpy.nonzero((e[:,0] <= maxx) & (e[:,2] >= minx) & (e[:,1] <= maxy) & (e[:,3] >= miny))[0]
 
-        markup = ''
-        if components is not None:
-            for component in components:
-                panel = component[0]
-                if len(component) > 1:
-                    markup += panel.render(dorp, context=context, version=version, components=list(component[1:]), function_ids=function_ids)
-                else:
-                    markup += panel.render(dorp, context=context, version=version, function_ids=function_ids)
-        else:
-            panels = self.scorepanel_set.all().order_by('position')
+        # Filter by relation - must have interior intersection
+        found = []
+        for i in candidates.tolist():
+            community = self.communities[i]
+            if self.prepared[i].intersects(geom) and geom.relate_pattern(community.geom, 'T********'):
+                found.append(community)
+        return found
 
-            for panel in panels:
-                markup += panel.render(dorp, context=context, version=version, function_ids=function_ids)
+    def get_type_union(self, geom):
+        """
+        Get the union of the types of the communities whose interiors
+        intersect a geometry.
 
-        return markup
+        Parameters:
+            geom -- The geometry to compare, usually a district.
+
+        Returns:
+            The set of community type Tags.
+        """
+        types = set()
+        for community in self.find(geom):
+            types = types | self.types.get(community.id, set())
+        return types
 
 
-class ScorePanel(BaseModel):
+class Profile(models.Model):
     """
-    Container for displaying multiple scores of a given type
+    Extra user information that doesn't fit in Django's default user
+    table.
+
+    Profiles for The Public Mapping Project include a password hint,
+    and an organization name.
     """
+    user = models.OneToOneField(User)
 
-    # The name of this score panel
-    name = models.CharField(max_length=50)
+    # A user's organization
+    organization = models.CharField(max_length=256)
 
-    # The title of this score panel - possibly user-specified
-    title = models.CharField(max_length=50)
+    # A user's password hint.
+    pass_hint = models.CharField(max_length=256)
 
-    # The type of the score display (plan, plan summary, district)
-    type = models.CharField(max_length=20)
+    def __unicode__(self):
+        """
+        Represent the Profile as a unicode string. This is the a string
+        with the User's name.
+        """
+        return "%s's profile" % self.user.username
 
-    # The score display this panel belongs to
-    displays = models.ManyToManyField(ScoreDisplay)
 
-    # Where this panel belongs within a score display
+def update_profile(sender, **kwargs):
+    """
+    A trigger that creates profiles when a user is saved.
+    """
+    created = kwargs['created']
+    user = kwargs['instance']
+    if created:
+        profile = Profile(user=user, organization='', pass_hint='')
+        profile.save()
+
+def set_district_id(sender, **kwargs):
+    """
+    Incremented the district_id (NOT the primary key id) when a district
+    is saved. The district_id is unique to the plan/version.  The 
+    district_id may already be set, but this method ensures that it is set
+    when saved.
+    """
+    district = kwargs['instance']
+    if district.district_id is None:
+        districts = district.plan.get_districts_at_version(district.version, include_geom=False)
+        ids_in_use = map(lambda d: d.district_id, districts)
+        max_districts = district.plan.legislative_body.max_districts + 1
+        if len(ids_in_use) >= max_districts:
+            raise ValidationError("Plan is at maximum district capacity of %d" % max_districts)
+        else:
+            # Find one not in use - 0 is unassigned
+            # TODO - update this if unassigned is not district_id 0
+            for i in range(1, max_districts+1):
+                if i not in ids_in_use:
+                    district.district_id = i
+                    return
+
+def update_plan_edited_time(sender, **kwargs):
+    """
+    Update the time that the plan was edited whenever the plan is saved.
+    """
+    district = kwargs['instance']
+    plan = district.plan;
+    plan.edited = datetime.now()
+    plan.save()
+
+def clear_district_tiles(sender, **kwargs):
+    """
+    Remove the cached vector tiles that may show a district, when the
+    district is saved. These are the tiles of the district version, and
+    of any later versions.
+    """
+    district = kwargs['instance']
+    vectortile.clear_tiles(district.plan_id, district.version)
+
+def clear_plan_tiles(sender, **kwargs):
+    """
+    Remove the cached vector tiles of a plan when the plan is deleted.
+    """
+    vectortile.clear_tiles(kwargs['instance'].id)
+
+def create_unassigned_district(sender, **kwargs):
+    """
+    When a new plan is saved, all geounits must be inserted into the 
+    Unassigned districts.
+    """
+    plan = kwargs['instance']
+    created = kwargs['created']
+
+    if created and plan.create_unassigned:
+        plan.create_unassigned = False
+
+        unassigned = District(short_label=u"\u0398",long_label=_("Unassigned"), version=0, plan=plan, district_id=0)
+
+        biggest_geolevel = plan.get_biggest_geolevel()
+        all_geom = biggest_geolevel.geounit_set.collect().buffer(0)
+        if all_geom.geom_type == 'MultiPolygon':
+            all_geom = all_geom.cascaded_union
+
+        if plan.district_set.count() > 0:
+            taken = plan.district_set.all().unionagg()
+            unassigned.geom =  enforce_multi(all_geom.difference(taken))
+            unassigned.simplify() # implicit save
+            geounit_ids = map(str, biggest_geolevel.geounit_set.filter(geom__bboverlaps=unassigned.geom).values_list('id', flat=True))
+            geounits = Geounit.get_mixed_geounits(geounit_ids, plan.legislative_body, biggest_geolevel.id, unassigned.geom, True)
+        else:
+            unassigned.geom = enforce_multi(all_geom)
+            unassigned.simplify() #implicit save
+            geounits = biggest_geolevel.geounit_set.all()
+
+        unassigned.delta_stats(geounits, True)
+
+        
+# Connect the post_save signal from a User object to the update_profile
+# helper method
+post_save.connect(update_profile, sender=User, dispatch_uid="publicmapping.redistricting.User")
+# Connect the pre_save signal to the set_district_id helper method
+pre_save.connect(set_district_id, sender=District)
+# Connect the post_save signal to the update_plan_edited_time helper method
+post_save.connect(update_plan_edited_time, sender=District)
+# Connect the post_save signal to the clear_district_tiles helper method
+post_save.connect(clear_district_tiles, sender=District)
+# Connect the post_delete signal to the clear_plan_tiles helper method
+post_delete.connect(clear_plan_tiles, sender=Plan)
+# Connect the post_save signal from a Plan object to the 
+# create_unassigned_district helper method (don't remove the dispatch_uid or 
+# this signal is sent twice)
+post_save.connect(create_unassigned_district, sender=Plan, dispatch_uid="publicmapping.redistricting.Plan")
+
+def can_edit(user, plan):
+    """
+    Can a user edit a plan?
+    
+    In order to edit a plan, Users must own it or be a staff member.  
+    Templates cannot be edited, only copied.
+
+    Parameters:
+        user -- A User
+        plan -- A Plan
+
+    Returns:
+        True if the User has permissions to edit the Plan.
+
+    """
+    return (plan.owner == user or user.is_staff) and not plan.is_template and not plan.is_shared
+
+def can_view(user, plan):
+    """
+    Can a user view a plan?
+
+    In order to view a plan, the plan must have the shared flag set.
+
+    Parameters:
+        user -- A User
+        plan -- A Plan
+
+    Returns:
+        True if the User has permissions to view the Plan.
+    """
+    return plan.owner == user or plan.is_shared or plan.is_template
+
+
+def can_copy(user, plan):
+    """
+    Can a user copy a plan?
+
+    In order to copy a plan, the user must be the owner, or a staff 
+    member to copy a plan they own.  Any registered user can copy a 
+    template.
+
+    Parameters:
+        user -- A User
+        plan -- A Plan
+
+    Returns:
+        True if the User has permission to copy the Plan.
+    """
+    return plan.is_template or plan.is_shared or plan.owner == user or user.is_staff
+
+def empty_geom(srid):
+    """
+    Create an empty MultiPolygon.
+
+    Parameters:
+        srid -- The spatial reference for this empty geometry.
+
+    Returns:
+        An empty geometry.
+    """
+    return MultiPolygon([], srid=srid)
+
+def enforce_multi(geom, collapse=False):
+    """
+    Make a geometry a multi-polygon geometry.
+
+    This method wraps Polygons in MultiPolygons. If geometry exists, but is
+    neither polygon or multipolygon, an empty geometry is returned. If no
+    geometry is provided, no geometry (None) is returned.
+
+    Parameters:
+        geom -- The geometry to check/enforce.
+        collapse -- A flag indicating that this method should collapse 
+                    the resulting multipolygon via cascaded_union. With
+                    this flag, the method still returns a multipolygon.
+    Returns:
+        A multi-polygon from any geometry type.
+    """
+    mpoly = MultiPolygon([])
+    if not geom is None:
+        mpoly.srid = geom.srid
+
+    if geom.empty:
+        pass
+    elif geom.geom_type == 'MultiPolygon':
+        if collapse:
+            mpoly = enforce_multi( geom.cascaded_union )
+        else:
+            mpoly = geom
+    elif geom.geom_type == 'Polygon':
+        # Collapse has no meaning if this is a single polygon
+        mpoly.append(geom)
+    elif geom.geom_type == 'GeometryCollection':
+        components = []
+        for item in geom:
+            for component in enforce_multi(item):
+                mpoly.append(component)
+
+        if collapse:
+            # Collapse the multipolygon group
+            mpoly = enforce_multi( mpoly, collapse )
+
+    return mpoly
+
+def safe_union(collection):
+    """
+    Attempt to safely union a set of geometries. Sometimes, the default
+    union() method on a geometry collection and/or geoqueryset results
+    in a TopologyException. This method attempts to create a safe union
+    of geometries by buffering the collection to 0, then performing a
+    cascaded union on the remainder (if the result of the buffer is a
+    multipolygon).
+    """
+    if isinstance(collection, GeoQuerySet):
+        # collection is a GeoQuerySet
+        thegeom = collection.collect()
+        if collection.count() == 0:
+            return thegeom
+    elif isinstance(collection, GeometryCollection):
+        # collection is a GeometryCollection
+        thegeom = collection
+
+    thegeom = thegeom.buffer(0)
+
+    if thegeom.geom_type == 'MultiPolygon':
+        thegeom = thegeom.cascaded_union
+
+    return thegeom
+
+class ScoreFunction(BaseModel):
+    """
+    Score calculation definition
+    """
+
+    # Namepace of the calculator module to use for scoring
+    calculator = models.CharField(max_length=500)
+
+    # Name of this score function
+    name = models.CharField(max_length=50)
+
+    # Whether or not this score function is for a plan
+    is_planscore = models.BooleanField(default=False)
+
+    # Whether a user can select this function for use in a 
+    # statistics set, per legislative levelqq
+    selectable_bodies = models.ManyToManyField(LegislativeBody)
+    
+    class Meta:
+        """
+        Additional information about the Subject model.
+        """
+
+        # The default method of sorting Subjects should be by 'sort_key'
+        ordering = ['name']
+
+        # A unique constraint on the name
+        unique_together = ('name',)
+
+    def get_calculator(self):
+        """
+        Retrieve a calculator instance by name.
+
+        Parameters:
+            name -- The fully qualified name of the calculator class.
+
+        Returns:
+            An instance of the requested calculator.
+        """
+        parts = self.calculator.split('.')
+        module = ".".join(parts[:-1])
+        m = __import__( module )
+        for comp in parts[1:]:
+            m = getattr(m, comp)            
+        return m()
+
+    def score(self, districts_or_plans, format='raw', version=None, score_arguments=None):
+        """
+        Calculate the score for the object or list of objects passed in.
+
+        Parameters:
+            districts_or_plans -- Either a single district, a single plan,
+                a list of districts, or a list of plans. Whether or not 
+                this deals with districts or plans must be in sync with 
+                the value of is_planscore.
+            format -- One of 'raw', 'html', or 'json'.
+                Determines how the results should be returned.
+            score_arguments -- a list of ScoreArguments to override the entries
+                linked through the database
+
+        Returns:
+            A score for each district or plan contained within 
+            districts_or_plans. If districts_or_plans is a single 
+            district or plan, a single result will be returned. If it 
+            is a list, a list of results in the same order as
+            districts_or_plans will be returned.
+        """
+        # Raises an ImportError if there is no calculator with the given name
+        calc = self.get_calculator()
+
+        # Is districts_or_plans a list, or a single district/plan?
+        is_list = isinstance(districts_or_plans, list)
+
+        # Calculate results for every item in the list
+        results = []
+        for dp in (districts_or_plans if is_list else [districts_or_plans]):
+            # Add all arguments that are defined for this score function
+            if score_arguments is not None:
+                args = score_arguments
+            else:
+                args = ScoreArgument.objects.filter(function=self)
+            arg_lst = []
+            for arg in args:
+                # For 'score' types, calculate the score, and then pass the result on
+                if (arg.type != 'score'):
+                    calc.arg_dict[arg.argument] = (arg.type, arg.value)
+                else:
+                    score_fn = ScoreFunction.objects.get(name=arg.value)
+
+                    # If this is a plan score and the argument is a 
+                    # district score, extract the districts from the 
+                    # plan, score each individually, # and pass into the 
+                    # score function as a list
+                    if not (self.is_planscore and not score_fn.is_planscore):
+                        calc.arg_dict[arg.argument] = ('literal', score_fn.score(dp, format=format, version=version))
+                    else:
+                        version = dp.version if version is None else version
+                        for d in dp.get_districts_at_version(version):
+                            res = score_fn.score(d, format=format, version=version)
+                            if isinstance(res,dict) and 'value' in res:
+                                res = res['value']
+                            arg_lst.append(res)
+
+            # Build the keyword arguments based on whether this is for districts, plans, or list
+            if len(arg_lst) > 0:
+                kwargs = { 'list': arg_lst }
+            elif self.is_planscore:
+                kwargs = { 'plan': dp, 'version': version if version is not None else dp.version }
+            else:
+                kwargs = { 'district': dp }
+
+            # Ask the calculator instance to compute the result
+            calc.compute(**kwargs)
+
+            # Format the result
+            fl = format.lower()
+            r = calc.html() if fl == 'html' else (calc.json() if fl == 'json' else calc.result)
+            results.append(r)
+
+        return results if is_list else results[0]
+
+    def score_districts(self, districts):
+        """
+        Calculate the raw scores of a list of districts at once, letting
+        the calculator share work between the districts. Score functions
+        that take other scores as arguments score each district in turn.
+
+        Parameters:
+            districts -- A list of Districts.
+
+        Returns:
+            A list of raw scores, in the same order as districts.
+        """
+        args = list(ScoreArgument.objects.filter(function=self))
+        if self.is_planscore or any(arg.type == 'score' for arg in args):
+            return [self.score(district, format='raw') for district in districts]
+
+        calc = self.get_calculator()
+        for arg in args:
+            calc.arg_dict[arg.argument] = (arg.type, arg.value)
+
+        return calc.compute_districts(districts)
+
+    def __unicode__(self):
+        """
+        Get a unicode representation of this object. This is the 
+        ScoreFunction's name.
+        """
+        return self.get_label()
+
+
+class ScoreArgument(models.Model):
+    """
+    Defines the arguments passed into a score function
+    """
+
+    # The score function this argument is for
+    function = models.ForeignKey(ScoreFunction)
+
+    # The name of the argument of the score function
+    argument = models.CharField(max_length=50)
+
+    # The value of the argument to be passed
+    value = models.CharField(max_length=50)
+
+    # The type of the argument (literal, score, subject)
+    type = models.CharField(max_length=10)
+
+    def __unicode__(self):
+        """
+        Get a unicode representation of this object. This is the Argument's
+        arg/value/type.
+        """
+        return "%s / %s / %s" % (self.argument, self.type, self.value)
+
+# Marks the threads that are rendering scores for _threaded_map
+_score_threads = threading.local()
+
+def _can_thread():
+    """
+    Can _threaded_map split items across threads from this thread? It
+    can if the SCORE_RENDER_THREADS setting is greater than one, this
+    thread is not one of the workers, and this thread has no changes
+    that are not committed, since the other connections could not see
+    them.
+    """
+    return getattr(settings, 'SCORE_RENDER_THREADS', 1) > 1 and \
+        not getattr(_score_threads, 'worker', False) and not transaction.is_dirty()
+
+def _threaded_map(function, items):
+    """
+    Apply a function to each item in a list. If the SCORE_RENDER_THREADS
+    setting is greater than one, the items are split across that many
+    threads, each with its own database connection.
+
+    The items are processed in order, in this thread, if this thread is
+    already one of the workers, or if this thread has changes that are
+    not committed, since the other connections could not see them.
+
+    Parameters:
+        function -- The function to apply to each item.
+        items -- A list of items.
+
+    Returns:
+        A list of the results, in the order of the items.
+    """
+    threads = min(getattr(settings, 'SCORE_RENDER_THREADS', 1), len(items))
+    if threads <= 1 or not _can_thread():
+        return map(function, items)
+
+    # Translations are activated per thread
+    language = translation.get_language()
+
+    def work(chunk):
+        _score_threads.worker = True
+        translation.activate(language)
+        try:
+            return map(function, chunk)
+        finally:
+            _score_threads.worker = False
+            connection.close()
+
+    pool = ThreadPool(threads)
+    try:
+        chunks = pool.map(work, [items[i::threads] for i in range(threads)])
+    finally:
+        pool.close()
+        pool.join()
+
+    # Interleave the chunks back into the order of the items
+    results = [None] * len(items)
+    for (i, chunk,) in enumerate(chunks):
+        results[i::threads] = chunk
+    return results
+
+
+class ScoreDisplay(BaseModel):
+    """
+    Container for displaying score panels
+    """
+
+    # The name of the score display
+    name = models.CharField(max_length=50)
+
+    # The title of the score display, user-specifiable
+    title = models.CharField(max_length=50)
+
+    # The legislative body that this score display is for
+    legislative_body = models.ForeignKey(LegislativeBody)
+
+    # Whether or not this score display belongs on the leaderboard page
+    is_page = models.BooleanField(default=False)
+
+    # The style to be assigned to this score display
+    cssclass = models.CharField(max_length=50, blank=True)
+
+    # The owner of this ScoreDisplay
+    owner = models.ForeignKey(User)
+
+    class Meta:
+        """
+        Define a unique constraint on 2 fields of this model.
+        """
+        unique_together = ('name','title','owner','legislative_body')
+
+    def __unicode__(self):
+        """
+        Get a unicode representation of this object. This is the Display's
+        title.
+        """
+        if not self.title is None and self.title != '':
+            return self.title
+        else:
+            return self.get_short_label()
+
+    def copy_from(self, display=None, functions=[], owner=None, title=None):
+        """ 
+        Given a scoredisplay and a list of functions, this method
+        will copy the display and assign the copy to the new owner
+        
+        Parameters:
+            display -- a ScoreDisplay to copy - the current 
+               Demographics display 
+            functions -- a list of ScoreFunctions or the primary
+                keys of ScoreFunctions to replace in the display's
+                first "district" ScorePanel
+            owner -- the owner of the new ScoreDisplay - only set if we're not copying self
+            title -- the title of the new scorefunction - only set if we're not copying self
+        
+        Returns:
+            The new ScoreDisplay
+        """
+        
+        if display == None:
+            return
+
+        if self != display:
+            self = copy(display)
+            self.id = None
+            self.name = ''
+
+            self.owner = owner if owner != None else display.owner
+
+            # We can't have duplicate titles per owner so append "copy" if we must
+            if self.owner == display.owner:
+                self.title = title if not title is None else "%s copy" % display.__unicode__()
+            else:
+                self.title = title if not title is None else display.__unicode__()
+
+            self.save()
+            self.scorepanel_set = display.scorepanel_set.all()
+
+        else:
+            self = display
+
+
+        try:
+            public_demo = self.scorepanel_set.get(type='district')
+            if self != display:
+                self.scorepanel_set.remove(public_demo)
+                demo_panel = copy(public_demo)
+                demo_panel.id = None
+                demo_panel.name = '%(display_title)s Demographics' % {'display_title':self.title}
+                demo_panel.save()
+                self.scorepanel_set.add(demo_panel)
+            else:
+                demo_panel = public_demo
+
+            demo_panel.score_functions.clear()
+            if len(functions) == 0:
+                return self
+            for function in functions:
+                if isinstance(function, types.IntType):
+                    function = ScoreFunction.objects.get(pk=function) 
+                if isinstance(function, types.StringTypes):
+                    function = ScoreFunction.objects.get(pk=int(function))
+                if type(function) == ScoreFunction:
+                    demo_panel.score_functions.add(function)
+            demo_panel.save()
+            self.scorepanel_set.add(demo_panel)
+            self.save()
+        except Exception, ex:
+            logger.info('Failed to copy ScoreDisplay %s to %s', display.__unicode__(), self.__unicode__())
+            logger.debug('Reason: %s', ex)
+
+        return self
+
+    def render(self, dorp, context=None, version=None, components=None, function_ids=None):
+        """
+        Generate the markup for all the panels attached to this display.
+
+        If the is_page property is set, render expects to receive a list
+        of valid plans.
+
+        If the is_page property is not set, render expects to receive a
+        single plan, or a list of districts.
+
+        Parameters:
+            dorp -- A list of districts, plan, or list of plans.
+            context -- Optional object that can be used for advanced rendering
+            components -- Optional list of tuples that can be used to recompose
+                the elements of a ScoreDisplay at runtime.  Each tuple should 
+                consist of a ScorePanel at index 0, followed by any number of 
+                ScoreFunctions tuples - a ScoreFunction followed by its arguments.
+            version -- Optional; the version of the plan or district to render.
+            function_ids -- Optional list of ScoreFunction ids in which to restrict rendering
+
+        Returns:
+            The markup for this display.
+        """
+        is_list = isinstance(dorp, list)
+
+        if self.is_page and \
+            (is_list and \
+                any(not isinstance(item,Plan) for item in dorp)):
+            # If this display is a page, it should receive a list of plans
+            return ''
+        elif not self.is_page:
+            if is_list and \
+                any(not isinstance(item,District) for item in dorp):
+                # If this display is not a page, the list should be a set
+                # of districts.
+                return ''
+            elif not is_list and \
+                not isinstance(dorp,Plan):
+                # If this display is not a page, the item should be a plan.
+                return ''
+
+        if components is not None:
+            panels = [(component[0], list(component[1:]) if len(component) > 1 else None,) for component in components]
+        else:
+            panels = [(panel, None,) for panel in self.scorepanel_set.all().order_by('position')]
+
+        # The panels do not depend on each other, so they may be rendered 
+        # at once, and the markup is joined in order
+        def render_panel(item):
+            (panel, panel_components,) = item
+            return panel.render(dorp, context=context, version=version, components=panel_components, function_ids=function_ids)
+
+        return ''.join(_threaded_map(render_panel, panels))
+
+    def render_leaderboard(self, owner=None, context=None, limit=None):
+        """
+        Generate the markup for all the panels attached to this display,
+        from the scores stored in the leaderboard.
+
+        Parameters:
+            owner -- Optional; only render the plans of this user.
+            context -- Optional object that can be used for advanced rendering
+            limit -- Optional; the maximum number of scores in each panel.
+
+        Returns:
+            The markup for this display.
+        """
+        markup = ''
+        for panel in self.scorepanel_set.filter(type='plan').order_by('position'):
+            markup += panel.render_leaderboard(owner=owner, context=context, limit=limit)
+
+        return markup
+
+
+class ScorePanel(BaseModel):
+    """
+    Container for displaying multiple scores of a given type
+    """
+
+    # The name of this score panel
+    name = models.CharField(max_length=50)
+
+    # The title of this score panel - possibly user-specified
+    title = models.CharField(max_length=50)
+
+    # The type of the score display (plan, plan summary, district)
+    type = models.CharField(max_length=20)
+
+    # The score display this panel belongs to
+    displays = models.ManyToManyField(ScoreDisplay)
+
+    # Where this panel belongs within a score display
     position = models.PositiveIntegerField(default=0)
   
     # The filename of the template to be used for formatting this panel
     template = models.CharField(max_length=500)
 
-    # The style to be assigned to this score display
-    cssclass = models.CharField(max_length=50, blank=True)
+    # The style to be assigned to this score display
+    cssclass = models.CharField(max_length=50, blank=True)
+
+    # The method of sorting the scores in this panel
+    is_ascending = models.BooleanField(default=True)
+
+    # The functions associated with this panel
+    score_functions = models.ManyToManyField(ScoreFunction)
+
+    def __unicode__(self):
+        """
+        Get a unicode representation of this object. This is the Panel's
+        title.
+        """
+        if not self.title is None and self.title != '':
+            return self.title
+        else:
+            return self.get_short_label()
+
+    def render(self,dorp,context=None,version=None,components=None,function_ids=None):
+        """
+        Generate the scores for all the functions attached to this panel,
+        and render them in the template.
+        
+        Only plan type panels are affected by the sorting order.
+
+        Parameters:
+            dorp -- A district, list of districts, plan, or list of plans.
+            context -- Optional object that can be used for advanced rendering
+            version -- Optional; version of the plan or district to render.
+            components -- Optional list of ScoreFunction tuples to render
+                 instead of any ScoreFunctions linked through the database.
+                 Each tuple should be a ScoreFunction at index 0 followed by
+                 and ScoreArguments
+            function_ids -- Optional list of ScoreFunction ids in which to restrict rendering
+
+        Returns:
+            A rendered set of scores.
+        """
+        is_list = isinstance(dorp,list)
+
+        # If this is a plan panel, it only renders plans
+        if (self.type == 'plan' or self.type == 'plan_summary') and \
+            not isinstance(dorp,Plan):
+            if is_list:
+                if any(not isinstance(item,Plan) for item in dorp):
+                    return ''
+            else:
+                return ''
+
+        # Given a plan, it will render using the districts within the plan
+        if self.type == 'district' and \
+            not isinstance(dorp,District):
+            if is_list:
+                if any(not isinstance(item,District) for item in dorp):
+                    return ''
+            elif isinstance(dorp,Plan):
+                dorp = dorp.get_districts_at_version(version if version is not None else dorp.version, include_geom=True)
+                is_list = True
+            else:
+                return ''
+
+        # Keep track of whether we're using a parameter or the DB to populate our panel
+        function_override = components is not None
+
+        # Render an item for each plan and plan score
+        if self.type == 'plan' or self.type == 'plan_summary':
+            if is_list:
+                plans = dorp
+            else:
+                plans = [dorp]
+
+            planscores = []
+
+            # Score the plans that are not cached at once, if there are
+            # threads to do it; otherwise each score is computed below
+            if not function_override and _can_thread():
+                def compute_plan(item):
+                    (plan, function,) = item
+                    return ComputedPlanScore.compute(function, plan, version=version if version is not None else plan.version)
+
+                pairs = [(plan, function,) for plan in plans for function in self.score_functions.filter(is_planscore=True) 
+                    if not function_ids or function.id in function_ids]
+                if len(pairs) > 1:
+                    _threaded_map(compute_plan, pairs)
+
+            for plan in plans:
+                plan_version = version if version is not None else plan.version
+                
+                if function_override:
+                    functions = map(lambda f: f[0], components)
+                else:
+                    functions = self.score_functions.filter(is_planscore=True).order_by('name')
+
+                for function in functions:
+                    # Don't process this function if it isn't in the inclusion list
+                    if function_ids and not function.id in function_ids:
+                        continue
+                    
+                    if function_override:
+                        if len(function) > 1:
+                            arguments = function[1:]
+                        function = function[0]
+                        score = function.score(plans,format='html',version=plan_version,score_arguments=arguments)
+                        sort = score
+
+                    else:
+                        score = ComputedPlanScore.compute(function,plan,format='html',version=plan_version)
+                        sort = ComputedPlanScore.compute(function,plan,format='sort',version=plan_version)
+
+                    planscores.append({
+                        'plan': plan,
+                        'name': function.get_short_label(),
+                        'label': function.get_label(),
+                        'description': function.get_long_description(),
+                        'score': score,
+                        'sort': sort
+                    })
+
+            if self.type == 'plan':
+                planscores.sort(key=lambda x:x['sort'],reverse=not self.is_ascending)
+
+            return "" if len(planscores) == 0 else render_to_string(self.template, {
+                'settings': settings,
+                'planscores': planscores,
+                'functions': functions,
+                'title': self.get_short_label(),
+                'cssclass': self.cssclass,
+                'position': self.position,
+                'description': self.get_long_description(),
+                'planname': '' if len(plans) == 0 else plans[0].name,
+                'context': context
+            })
+
+        # Render each district with multiple scores
+        elif self.type == 'district':
+            if is_list:
+                districts = dorp
+            else:
+                districts = [dorp]
+
+            districtscores = []
+            functions = []
+
+            # Score the districts that are not cached together
+            if not function_override and len(districts) > 1:
+                district_functions = [f for f in self.score_functions.filter(is_planscore=False) if not function_ids or f.id in function_ids]
+                _threaded_map(lambda function: ComputedDistrictScore.compute_all(function, districts), district_functions)
+
+            for district in districts:
+                districtscore = { 'district':district, 'scores':[] }
+
+                if function_override:
+                    district_functions = reduce(lambda c: not c[0].is_planscore, components)
+                    
+
+                else:
+                    district_functions = self.score_functions.filter(is_planscore=False)
+
+
+                for function in district_functions:
+                    # Don't process this function if it isn't in the inclusion list
+                    if function_ids and not function.id in function_ids:
+                        continue
+
+                    if function_override:
+                        if len(function) > 1:
+                            arguments = function[1:]
+                        function = function[0]
+                        score = function.score(district,format='html',score_arguments=arguments)
+                    else:
+                        if not function.get_label() in functions:
+                            functions.append(function.get_label())
+                        score = ComputedDistrictScore.compute(function,district,format='html')
+
+                    districtscore['scores'].append({
+                        'district': district,
+                        'name': function.get_short_label(),
+                        'label': function.get_label(),
+                        'description': function.get_long_description(),
+                        'score': score
+                    })
+
+                if len(districtscore['scores']) > 0:
+                    districtscores.append(districtscore)
+
+            return "" if len(districtscores) == 0 else render_to_string(self.template, {
+                'districtscores':districtscores,
+                'functions':functions,
+                'title': self.__unicode__(),
+                'cssclass': self.cssclass,
+                'settings':settings,
+                'position':self.position,
+                'context':context
+            })
+
+    def render_leaderboard(self, owner=None, context=None, limit=None):
+        """
+        Render the plan scores of this panel that are stored in the
+        leaderboard, in rank order.
+
+        Parameters:
+            owner -- Optional; only render the plans of this user.
+            context -- Optional object that can be used for advanced rendering
+            limit -- Optional; the maximum number of scores to render.
+
+        Returns:
+            A rendered set of scores.
+        """
+        calculators = {}
+        planscores = []
+        for leader in LeaderboardScore.get_scores(self, owner=owner, limit=limit):
+            function = leader.function
+            if not function.id in calculators:
+                calculators[function.id] = function.get_calculator()
+            calc = calculators[function.id]
+            calc.result = leader.get_score()
+
+            planscores.append({
+                'plan': leader.plan,
+                'name': function.get_short_label(),
+                'label': function.get_label(),
+                'description': function.get_long_description(),
+                'score': calc.html(),
+                'sort': leader.sort_value
+            })
+
+        return "" if len(planscores) == 0 else render_to_string(self.template, {
+            'settings': settings,
+            'planscores': planscores,
+            'functions': self.score_functions.filter(is_planscore=True).order_by('name'),
+            'title': self.get_short_label(),
+            'cssclass': self.cssclass,
+            'position': self.position,
+            'description': self.get_long_description(),
+            'planname': planscores[0]['plan'].name,
+            'context': context
+        })
+
+class ValidationCriteria(BaseModel):
+    """
+    Defines the required score functions to validate a legislative body
+    """
+
+    # The score function this criteria is for
+    function = models.ForeignKey(ScoreFunction)
+
+    # Name of this validation criteria
+    name = models.CharField(max_length=50)
+
+    # The legislative body that this validation criteria is for
+    legislative_body = models.ForeignKey(LegislativeBody)
+
+    # The average number of seconds taken to compute this criteria
+    duration = models.FloatField(default=0)
+
+    # The number of times this criteria was computed for the average
+    checks = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return self.get_label()
+
+    class Meta:
+        """
+        Additional properties about the ValidationCriteria model.
+        """
+        verbose_name_plural = "Validation criterion"
+
+        unique_together = ('name',)
+
+    def record_duration(self, seconds):
+        """
+        Add the time taken to compute this criteria to its average. The
+        average is updated in the database, so concurrent checks are all 
+        counted.
+
+        Parameters:
+            seconds -- The number of seconds the computation took.
+        """
+        ValidationCriteria.objects.filter(id=self.id).update(
+            duration=(F('duration') * F('checks') + seconds) / (F('checks') + 1),
+            checks=F('checks') + 1)
+        logger.debug('Validation criteria "%s" took %0.3f seconds.', self.name, seconds)
+
+    def check_plan(self, plan, version=None):
+        """
+        Check if a plan meets this criteria. A score that was already
+        computed for the plan version is reused; otherwise the score is
+        computed and cached, and the time it took is recorded.
+
+        Parameters:
+            plan -- The Plan to check.
+            version -- Optional; the version of the plan to check.
+
+        Returns:
+            True if the plan meets this criteria.
+        """
+        plan_version = version if version is not None else plan.version
+        started = time.time()
+        cache = None
+        computed = False
+        score = None
+        try:
+            cache, computed = ComputedPlanScore.objects.get_or_create(function=self.function, 
+                plan=plan, version=plan_version, defaults={'value':''})
+            if computed:
+                ScoreCache.record(ComputedPlanScore, misses=1)
+                score = ValidationInput.score_plan(self.function, plan, plan_version)
+                cache.set_score(score)
+                cache.save()
+            else:
+                score = ComputedPlanScore.compute(self.function, plan, version=plan_version)
+        except Exception:
+            logger.debug(format_exc())
+
+            # Don't leave an empty score in the cache for later checks
+            if computed and not cache is None:
+                try:
+                    cache.delete()
+                except Exception:
+                    logger.debug('Could not remove the empty score of plan %d.', plan.id)
+
+        if computed:
+            self.record_duration(time.time() - started)
+
+        return bool(score and score['value'])
+
+    @staticmethod
+    def validate(plan, version=None):
+        """
+        Check a plan against all the criteria of its legislative body.
+
+        The criteria are checked in order of their average duration, so
+        the cheapest criteria are checked first, and checking stops at the
+        first criteria the plan fails. If the VALIDATION_THREADS setting 
+        is greater than one, that many criteria are checked at once, each
+        in a thread with its own database connection.
+
+        Parameters:
+            plan -- The Plan to validate.
+            version -- Optional; the version of the plan to validate.
+
+        Returns:
+            The first ValidationCriteria that failed, or None if the plan
+            is valid.
+        """
+        criteria = list(ValidationCriteria.objects.filter(legislative_body=plan.legislative_body).order_by('duration', 'id'))
+
+        threads = min(getattr(settings, 'VALIDATION_THREADS', 1), len(criteria))
+        if threads <= 1:
+            for criterion in criteria:
+                if not criterion.check_plan(plan, version):
+                    return criterion
+            return None
+
+        def check(criterion):
+            try:
+                return (criterion, criterion.check_plan(plan, version),)
+            finally:
+                # Each thread opens its own connection
+                connection.close()
+
+        pool = ThreadPool(threads)
+        try:
+            for (criterion, passed,) in pool.imap_unordered(check, criteria):
+                if not passed:
+                    return criterion
+        finally:
+            # Do not start checking any remaining criteria
+            pool.terminate()
+
+        return None
+
+
+class ValidationInput(models.Model):
+    """
+    The part of a validation score that depends on a single district.
+
+    Calculators that set district_inputs compute a plan result from a
+    value for each district. A district version never changes, so after 
+    an edit only the new district versions need to be evaluated when the
+    plan is validated again.
+    """
+
+    # The score function of the validation criteria
+    function = models.ForeignKey(ScoreFunction)
+
+    # The district that was evaluated
+    district = models.ForeignKey(District)
+
+    # The value for the district, as a JSON document
+    value = models.TextField()
+
+    class Meta:
+        """
+        Define a unique constraint on 2 fields of this model.
+        """
+        unique_together = (('function','district'),)
+
+    @staticmethod
+    def get_inputs(function, calc, districts):
+        """
+        Get the inputs of a list of districts. This method will leverage
+        the cache when it is available, or it will populate the cache if 
+        it is not.
+
+        Parameters:
+            function -- The ScoreFunction of the calculator.
+            calc -- The calculator, with its arguments set.
+            districts -- A list of Districts.
+
+        Returns:
+            A list of inputs, in the same order as districts.
+        """
+        cached = dict(ValidationInput.objects.filter(function=function, 
+            district__in=[d.id for d in districts]).values_list('district_id', 'value'))
+
+        missing = [d.id for d in districts if not d.id in cached]
+        inputs = []
+        for district in District.objects.filter(id__in=missing):
+            cached[district.id] = json.dumps(calc.district_input(district))
+            inputs.append(ValidationInput(function=function, district=district, value=cached[district.id]))
+
+        if len(inputs) > 0:
+            # A savepoint keeps the transaction usable if the insert fails
+            sid = transaction.savepoint()
+            try:
+                ValidationInput.objects.bulk_create(inputs)
+                transaction.savepoint_commit(sid)
+            except IntegrityError, ex:
+                # Another process may have stored these inputs already
+                transaction.savepoint_rollback(sid)
+                logger.info('Could not store the validation inputs of %d districts.', len(inputs))
+                logger.debug('Reason: %s', ex)
+
+        return [json.loads(cached[d.id]) for d in districts]
+
+    @staticmethod
+    def score_plan(function, plan, version):
+        """
+        Compute the raw score of a plan. If the calculator of the score
+        function can, the score is computed from the cached inputs of the
+        plan's districts.
+
+        Parameters:
+            function -- A plan ScoreFunction.
+            plan -- The Plan to score.
+            version -- The version of the plan to score.
+
+        Returns:
+            The raw result of the score function.
+        """
+        calc = function.get_calculator()
+        args = list(ScoreArgument.objects.filter(function=function))
+        if not calc.district_inputs or any(arg.type == 'score' for arg in args):
+            return function.score(plan, format='raw', version=version)
+
+        for arg in args:
+            calc.arg_dict[arg.argument] = (arg.type, arg.value)
+
+        districts = list(plan.get_districts_at_version(version, include_geom=False))
+        calc.compute_inputs(plan, districts, ValidationInput.get_inputs(function, calc, districts))
+        return calc.result
+
+
+def _score_default(obj):
+    """
+    Serialize the values in a score that JSON does not support natively.
+
+    Decimals are tagged so they are restored as Decimals, and not floats,
+    when the score is read back from the cache.
+    """
+    if isinstance(obj, Decimal):
+        return { '__decimal__': str(obj) }
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def _score_object_hook(obj):
+    """
+    Restore the values tagged by _score_default.
+    """
+    if '__decimal__' in obj and len(obj) == 1:
+        return Decimal(obj['__decimal__'])
+    return obj
+
+def encode_score(score):
+    """
+    Convert a calculator result into its cached representation.
+
+    Scalar results (numbers and booleans stored under 'value') are also
+    returned as a float, so they may be sorted and filtered in SQL.
+    Structured results, such as split reports, are only stored in the
+    JSON document.
+
+    Parameters:
+        score -- The raw result of a calculator.
+
+    Returns:
+        A tuple of the numeric value (or None) and the JSON document.
+    """
+    numeric = None
+    if isinstance(score, dict) and 'value' in score:
+        value = score['value']
+        if isinstance(value, (bool, int, long, float, Decimal)):
+            numeric = float(value)
+
+    return numeric, json.dumps(score, default=_score_default, separators=(',',':'))
+
+def decode_score(value):
+    """
+    Convert a cached score document back into a calculator result.
+
+    Parameters:
+        value -- The JSON document created by encode_score.
+
+    Returns:
+        The raw result of a calculator.
+    """
+    return json.loads(value, object_hook=_score_object_hook)
+
+
+class ScoreCacheStatistic(models.Model):
+    """
+    The number of cached scores that were found (hits) and computed 
+    (misses) in one of the score cache tables, each day.
+    """
+
+    # The day the scores were looked up
+    day = models.DateField()
+
+    # The name of the score cache table
+    table = models.CharField(max_length=50)
+
+    # The number of scores found in the cache
+    hits = models.BigIntegerField(default=0)
+
+    # The number of scores that were computed
+    misses = models.BigIntegerField(default=0)
+
+    class Meta:
+        """
+        Define a unique constraint on 2 fields of this model.
+        """
+        unique_together = (('day','table'),)
+
+    def __unicode__(self):
+        return '%s %s: %d hits, %d misses' % (self.day, self.table, self.hits, self.misses)
+
+
+class ScoreCache(object):
+    """
+    Keep the computed score caches bounded.
+
+    Each cached score records when it was last read, and each process
+    counts the scores it finds and computes. The evict method removes the
+    scores that are no longer needed: scores of plan versions that were
+    purged, and scores that have not been read for a while, unless they 
+    belong to one of the latest versions of a plan.
+    """
+
+    # A cached score is marked as read at most this often
+    touch_interval = timedelta(hours=1)
+
+    # Save the counts of this process after this many lookups
+    flush_size = 100
+
+    # The hits and misses counted in this process, keyed on table name
+    _counts = {}
+
+    # Guards the counts, which are shared by the threads rendering scores
+    _lock = threading.Lock()
+
+    @staticmethod
+    def record(model, hits=0, misses=0):
+        """
+        Count the scores found and computed in a score cache.
+
+        Parameters:
+            model -- The model of the score cache.
+            hits -- The number of scores found in the cache.
+            misses -- The number of scores computed.
+        """
+        ScoreCache._lock.acquire()
+        try:
+            counts = ScoreCache._counts.setdefault(model._meta.db_table, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+            full = sum(h + m for (h, m,) in ScoreCache._counts.values()) >= ScoreCache.flush_size
+        finally:
+            ScoreCache._lock.release()
+
+        if full:
+            ScoreCache.flush()
+
+    @staticmethod
+    def flush():
+        """
+        Save the counts of this process to the ScoreCacheStatistics of
+        the day.
+        """
+        ScoreCache._lock.acquire()
+        try:
+            counts = ScoreCache._counts
+            ScoreCache._counts = {}
+        finally:
+            ScoreCache._lock.release()
+
+        today = datetime.now().date()
+        for (table, (hits, misses,),) in counts.items():
+            try:
+                stat, created = ScoreCacheStatistic.objects.get_or_create(day=today, table=table)
+                ScoreCacheStatistic.objects.filter(id=stat.id).update(hits=F('hits') + hits, misses=F('misses') + misses)
+            except Exception, ex:
+                transaction.rollback_unless_managed()
+                logger.info('Could not save the score cache statistics for %s.', table)
+                logger.debug('Reason: %s', ex)
+
+    @staticmethod
+    def touch(model, caches):
+        """
+        Mark cached scores as read. Scores that were marked recently are
+        not updated again.
+
+        Parameters:
+            model -- The model of the score cache.
+            caches -- The cached scores that were read.
+        """
+        cutoff = datetime.now() - ScoreCache.touch_interval
+        stale = [c.id for c in caches if c.accessed is None or c.accessed < cutoff]
+        if len(stale) > 0:
+            model.objects.filter(id__in=stale).update(accessed=datetime.now())
+
+    @staticmethod
+    def evict(max_age, checkpoints=1, max_rows=0):
+        """
+        Remove the cached scores that are no longer needed.
+
+        The scores of plan versions that were purged are always removed.
+        The scores of the latest versions of each plan, and of the
+        districts in them, are kept. Other scores are removed if they 
+        have not been read within max_age. If a table still has more 
+        than max_rows scores, the least recently read are removed.
+
+        Parameters:
+            max_age -- A timedelta; older scores that are not kept are
+                removed.
+            checkpoints -- Optional; the number of latest versions of 
+                each plan whose scores are kept.
+            max_rows -- Optional; the maximum number of scores in each 
+                table, or 0 for no limit.
+
+        Returns:
+            A dict of the number of scores removed from each table.
+        """
+        cutoff = datetime.now() - max_age
+        checkpoints = max(1, checkpoints)
+        removed = {}
+        cursor = connection.cursor()
+
+        # Scores of versions that were purged, or of versions older than
+        # the checkpoints that have not been read recently
+        cursor.execute("""DELETE FROM redistricting_computedplanscore AS s
+USING redistricting_plan AS p
+WHERE s.plan_id = p.id AND (s.version < p.min_version OR s.version > p.version
+    OR (s.version <= p.version - %s AND s.accessed < %s))""", [checkpoints, cutoff])
+        removed['redistricting_computedplanscore'] = cursor.rowcount
+
+        # Scores of districts that are not in the checkpoints, and have 
+        # not been read recently
+        cursor.execute("""DELETE FROM redistricting_computeddistrictscore AS s
+WHERE s.accessed < %s AND s.district_id NOT IN (
+    (SELECT DISTINCT ON (d.plan_id, d.district_id) d.id
+    FROM redistricting_district AS d JOIN redistricting_plan AS p ON d.plan_id = p.id
+    WHERE d.version <= p.version
+    ORDER BY d.plan_id, d.district_id, d.version DESC)
+    UNION
+    (SELECT d.id
+    FROM redistricting_district AS d JOIN redistricting_plan AS p ON d.plan_id = p.id
+    WHERE d.version > p.version - %s))""", [cutoff, checkpoints])
+        removed['redistricting_computeddistrictscore'] = cursor.rowcount
+
+        if max_rows > 0:
+            for model in (ComputedPlanScore, ComputedDistrictScore,):
+                table = model._meta.db_table
+                extra = model.objects.count() - max_rows
+                if extra > 0:
+                    cursor.execute("""DELETE FROM %(table)s WHERE id IN (
+    SELECT id FROM %(table)s ORDER BY accessed LIMIT %(extra)d)""" % { 'table': table, 'extra': extra })
+                    removed[table] += cursor.rowcount
+
+        transaction.commit_unless_managed()
+
+        return removed
+
+    @staticmethod
+    def clear():
+        """
+        Remove all the cached scores, and the caches that depend on the
+        score functions.
+        """
+        cursor = connection.cursor()
+        cursor.execute('TRUNCATE redistricting_computeddistrictscore, redistricting_computedplanscore, '
+            'redistricting_leaderboardscore, redistricting_validationinput')
+        transaction.commit_unless_managed()
+
+    @staticmethod
+    def report(days=7):
+        """
+        Describe the size and the hit rate of the score caches.
+
+        Parameters:
+            days -- Optional; the number of days to total the hits and
+                misses over.
+
+        Returns:
+            A list of dicts, one for each table, with the table name, the
+            number of rows, the size on disk in bytes, and the hits and 
+            misses.
+        """
+        ScoreCache.flush()
+
+        since = datetime.now().date() - timedelta(days=days - 1)
+        cursor = connection.cursor()
+        report = []
+        for model in (ComputedPlanScore, ComputedDistrictScore,):
+            table = model._meta.db_table
+            cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+            stats = ScoreCacheStatistic.objects.filter(table=table, day__gte=since).aggregate(Sum('hits'), Sum('misses'))
+            report.append({
+                'table': table,
+                'rows': model.objects.count(),
+                'bytes': cursor.fetchone()[0],
+                'hits': stats['hits__sum'] or 0,
+                'misses': stats['misses__sum'] or 0
+            })
+
+        return report
+
+
+class ComputedDistrictScore(models.Model):
+    """
+    A score generated by a score function for a district that can be 
+    saved for later.
+
+    These computed scores do not store the version number, since each
+    district has a unique version.
+    """
+
+    # The score function that computes this score
+    function = models.ForeignKey(ScoreFunction)
+
+    # The district that this score relates to
+    district = models.ForeignKey(District)
+
+    # The actual score value, as a JSON document
+    value = models.TextField()
+
+    # The scalar score value, if the score has one
+    numeric_value = models.FloatField(null=True, blank=True, db_index=True)
+
+    # When this score was last read; see ScoreCache
+    accessed = models.DateTimeField(default=datetime.now, db_index=True)
+
+    def __unicode__(self):
+        name = ''
+        if not self.district is None:
+            if not self.district.plan is None:
+                name = '%s / %s' % (self.district.long_label, self.district.plan.name,)
+            else:
+                name = self.district.long_label
+
+        if not self.function is None:
+            name = '%s / %s' % (self.function.get_short_label(), name)
+        else:
+            name = 'None / %s' % name
+
+        return name
+
+
+    def get_score(self):
+        """
+        Get the raw calculator result stored in this cached score.
+
+        Returns:
+            The raw result of the score function.
+        """
+        return decode_score(self.value)
+
+    def set_score(self, score):
+        """
+        Store a raw calculator result in this cached score. This does 
+        not save the cached score.
+
+        Parameters:
+            score -- The raw result of the score function.
+        """
+        self.numeric_value, self.value = encode_score(score)
+
+    @staticmethod
+    def compute(function,district,format='raw'):
+        """
+        Get the computed value. This method will leverage the cache when
+        it is available, or it will populate the cache if it is not.
+
+        If the cached score exists, it's value is not changed.
+
+        If the cached score does not exist, this method will create it.
+
+        Parameters:
+            function -- A ScoreFunction to compute with
+            district -- A District to compute on
+
+        Returns:
+            The cached value for the district.
+        """
+        created = False
+        try:
+            defaults = {'value':''}
+            cache,created = ComputedDistrictScore.objects.get_or_create(function=function, district=district, defaults=defaults)
+
+        except Exception as ex:
+            logger.info('Could not retrieve nor create computed district score for district %d.', district.id)
+            logger.debug('Reason:', ex)
+            return None
+
+        ScoreCache.record(ComputedDistrictScore, hits=int(not created), misses=int(created))
+        if created == True:
+            score = function.score(district, format='raw')
+            cache.set_score(score)
+            cache.save()
+        else:
+            ScoreCache.touch(ComputedDistrictScore, [cache])
+            try:
+                score = cache.get_score()
+            except:
+                score = function.score(district, format='raw')
+
+        if format != 'raw':
+            calc = function.get_calculator()
+            calc.result = score
+            if format == 'html':
+                return calc.html()
+            elif format == 'json':
+                return calc.json()
+            elif format == 'sort':
+                return calc.sortkey()
+            else:
+                # Unrecognized format!
+                return None
+
+        return score
+
+    @staticmethod
+    def compute_all(function, districts):
+        """
+        Populate the cache for many districts at once. The districts 
+        that are not cached are scored together, and their scores are
+        saved in bulk.
+
+        If a cached score exists, it's value is not changed.
+
+        Parameters:
+            function -- A ScoreFunction to compute with
+            districts -- A list of Districts to compute on
+
+        Returns:
+            A dict of the raw scores, keyed on District ID.
+        """
+        scores = {}
+        caches = list(ComputedDistrictScore.objects.filter(function=function, district__in=[d.id for d in districts]))
+        for cache in caches:
+            try:
+                scores[cache.district_id] = cache.get_score()
+            except:
+                # An unreadable score is replaced below
+                cache.delete()
+        ScoreCache.touch(ComputedDistrictScore, caches)
+
+        missing = [d for d in districts if not d.id in scores]
+        ScoreCache.record(ComputedDistrictScore, hits=len(districts) - len(missing), misses=len(missing))
+        if len(missing) == 0:
+            return scores
+
+        caches = []
+        for (district, score,) in zip(missing, function.score_districts(missing)):
+            scores[district.id] = score
+            cache = ComputedDistrictScore(function=function, district=district)
+            cache.set_score(score)
+            caches.append(cache)
+
+        # A savepoint keeps the transaction usable if the insert fails
+        sid = transaction.savepoint()
+        try:
+            ComputedDistrictScore.objects.bulk_create(caches)
+            transaction.savepoint_commit(sid)
+        except IntegrityError as ex:
+            # Another process may have stored some of these scores already,
+            # so store the others one at a time
+            transaction.savepoint_rollback(sid)
+            logger.info('Could not store computed district scores for function %d in bulk.', function.id)
+            logger.debug('Reason: %s', ex)
+            for cache in caches:
+                ComputedDistrictScore.objects.get_or_create(function=function, district=cache.district,
+                    defaults={'value': cache.value, 'numeric_value': cache.numeric_value})
+
+        return scores
+
+    class Meta:
+        unique_together = (('function','district'),)
+
+
+class ComputedPlanScore(models.Model):
+    """
+    A score generated by a score function for a plan that can be saved
+    for later.
+
+    These computed scores contain version numbers, since a plan's version
+    number is incremented each time, but scores need to exist for different
+    plan version numbers, for history, etc.
+    """
+
+    # The score function that computes this score
+    function = models.ForeignKey(ScoreFunction)
+
+    # The plan that this score relates to
+    plan = models.ForeignKey(Plan)
+
+    # The version of the plan that this relates to
+    version = models.PositiveIntegerField(default=0)
+
+    # The actual score value, as a JSON document
+    value = models.TextField()
+
+    # The scalar score value, if the score has one
+    numeric_value = models.FloatField(null=True, blank=True, db_index=True)
+
+    # When this score was last read; see ScoreCache
+    accessed = models.DateTimeField(default=datetime.now, db_index=True)
+
+    def get_score(self):
+        """
+        Get the raw calculator result stored in this cached score.
+
+        Returns:
+            The raw result of the score function.
+        """
+        return decode_score(self.value)
+
+    def set_score(self, score):
+        """
+        Store a raw calculator result in this cached score. This does 
+        not save the cached score.
+
+        Parameters:
+            score -- The raw result of the score function.
+        """
+        self.numeric_value, self.value = encode_score(score)
+
+    @staticmethod
+    def compute(function, plan, version=None, format='raw'):
+        """
+        Get the computed value. This method will leverage the cache when
+        it is available, or it will populate the cache if it is not.
+
+        If the cached score exists, its value is not changed.
 
-    # The method of sorting the scores in this panel
-    is_ascending = models.BooleanField(default=True)
+        If the cached score does not exist, this method will create it.
 
-    # The functions associated with this panel
-    score_functions = models.ManyToManyField(ScoreFunction)
+        Parameters:
+            function -- A ScoreFunction to compute with
+            plan -- A Plan to compute on
+            version -- Optional; the version of the plan to compute.
+
+        Returns:
+            The cached value for the plan.
+        """
+        created = False
+        plan_version = version if version is not None else plan.version
+        try:
+            defaults = {'value':''}
+            cache,created = ComputedPlanScore.objects.get_or_create(function=function, plan=plan, version=plan_version, defaults=defaults)
+
+        except Exception,ex:
+            logger.info('Could not retrieve nor create ComputedPlanScore for plan %d', plan.id)
+            logger.debug('Reason:', ex)
+            return None
+
+        ScoreCache.record(ComputedPlanScore, hits=int(not created), misses=int(created))
+        if created:
+            score = function.score(plan, format='raw', version=plan_version)
+            cache.set_score(score)
+            cache.save()
+        else:
+            ScoreCache.touch(ComputedPlanScore, [cache])
+            try:
+                score = cache.get_score()
+            except:
+                score = function.score(plan, format='raw', version=plan_version)
+                cache.set_score(score)
+                cache.save()
+
+        if format != 'raw':
+            calc = function.get_calculator()
+            calc.result = score
+            if format == 'html':
+                return calc.html()
+            elif format == 'json':
+                return calc.json()
+            elif format == 'sort':
+                return calc.sortkey()
+            else:
+                # Unrecognized format!
+                return None
+
+        return score
 
     def __unicode__(self):
+        name = ''
+        if not self.plan is None:
+            name = self.plan.name
+
+        if not self.function is None:
+            name = '%s / %s' % (self.function.get_short_label(), name)
+        else:
+            name = 'None / %s' % name
+
+        return name
+
+
+class LeaderboardScore(models.Model):
+    """
+    A plan score in a leaderboard panel, with the rank of the score
+    within the panel.
+
+    The leaderboard panels belong to the leaderboard displays of each
+    legislative body, one for each owner filter. Each valid plan of a
+    legislative body has a score in each leaderboard panel. The scores
+    are refreshed when a plan is validated, and removed when an edit
+    invalidates the plan, so the leaderboard may be read in rank order
+    without scoring every valid plan. A panel is filled with the scores
+    of the plans that were valid before it was read once, in the 
+    background; see L{LeaderboardBuild}.
+    """
+
+    # The leaderboard panel this score is displayed in
+    panel = models.ForeignKey(ScorePanel)
+
+    # The score function that computed this score
+    function = models.ForeignKey(ScoreFunction)
+
+    # The plan that this score relates to
+    plan = models.ForeignKey(Plan)
+
+    # The version of the plan that was scored
+    version = models.PositiveIntegerField(default=0)
+
+    # The score value, as a JSON document
+    value = models.TextField()
+
+    # The scalar score value, if the score has one
+    numeric_value = models.FloatField(null=True, blank=True)
+
+    # The key the scores in the panel are sorted by, if it is numeric
+    sort_value = models.FloatField(null=True, blank=True)
+
+    # The rank of this score within the panel
+    rank = models.PositiveIntegerField(default=0, db_index=True)
+
+    class Meta:
         """
-        Get a unicode representation of this object. This is the Panel's
-        title.
+        Define a unique constraint on 3 fields of this model.
         """
-        if not self.title is None and self.title != '':
-            return self.title
-        else:
-            return self.get_short_label()
+        unique_together = (('panel','function','plan'),)
 
-    def render(self,dorp,context=None,version=None,components=None,function_ids=None):
+    def get_score(self):
         """
-        Generate the scores for all the functions attached to this panel,
-        and render them in the template.
-        
-        Only plan type panels are affected by the sorting order.
+        Get the raw calculator result stored in this score.
+
+        Returns:
+            The raw result of the score function.
+        """
+        return decode_score(self.value)
+
+    @staticmethod
+    def get_panels(legislative_body):
+        """
+        Get the leaderboard panels of a legislative body.
 
         Parameters:
-            dorp -- A district, list of districts, plan, or list of plans.
-            context -- Optional object that can be used for advanced rendering
-            version -- Optional; version of the plan or district to render.
-            components -- Optional list of ScoreFunction tuples to render
-                 instead of any ScoreFunctions linked through the database.
-                 Each tuple should be a ScoreFunction at index 0 followed by
-                 and ScoreArguments
-            function_ids -- Optional list of ScoreFunction ids in which to restrict rendering
+            legislative_body -- The LegislativeBody of the leaderboard.
 
         Returns:
-            A rendered set of scores.
+            A queryset of ScorePanels.
         """
-        is_list = isinstance(dorp,list)
+        return ScorePanel.objects.filter(type='plan', displays__is_page=True,
+            displays__legislative_body=legislative_body).distinct()
 
-        # If this is a plan panel, it only renders plans
-        if (self.type == 'plan' or self.type == 'plan_summary') and \
-            not isinstance(dorp,Plan):
-            if is_list:
-                if any(not isinstance(item,Plan) for item in dorp):
-                    return ''
-            else:
-                return ''
+    @staticmethod
+    def score_plan(panel, plan):
+        """
+        Create the scores of a plan in a leaderboard panel. This does not
+        save the scores.
 
-        # Given a plan, it will render using the districts within the plan
-        if self.type == 'district' and \
-            not isinstance(dorp,District):
-            if is_list:
-                if any(not isinstance(item,District) for item in dorp):
-                    return ''
-            elif isinstance(dorp,Plan):
-                dorp = dorp.get_districts_at_version(version if version is not None else dorp.version, include_geom=True)
-                is_list = True
-            else:
-                return ''
+        Parameters:
+            panel -- The leaderboard ScorePanel.
+            plan -- The valid Plan to score.
 
-        # Keep track of whether we're using a parameter or the DB to populate our panel
-        function_override = components is not None
+        Returns:
+            A list of new LeaderboardScores.
+        """
+        scores = []
+        for function in panel.score_functions.filter(is_planscore=True):
+            score = ComputedPlanScore.compute(function, plan)
+            if score is None:
+                continue
 
-        # Render an item for each plan and plan score
-        if self.type == 'plan' or self.type == 'plan_summary':
-            if is_list:
-                plans = dorp
-            else:
-                plans = [dorp]
+            calc = function.get_calculator()
+            calc.result = score
+            sort = calc.sortkey()
+            if not isinstance(sort, (bool, int, long, float, Decimal)):
+                sort = None
 
-            planscores = []
+            leader = LeaderboardScore(panel=panel, function=function, plan=plan, version=plan.version,
+                sort_value=None if sort is None else float(sort))
+            leader.numeric_value, leader.value = encode_score(score)
+            scores.append(leader)
 
-            for plan in plans:
-                plan_version = version if version is not None else plan.version
-                
-                if function_override:
-                    functions = map(lambda f: f[0], components)
-                else:
-                    functions = self.score_functions.filter(is_planscore=True).order_by('name')
+        return scores
 
-                for function in functions:
-                    # Don't process this function if it isn't in the inclusion list
-                    if function_ids and not function.id in function_ids:
-                        continue
-                    
-                    if function_override:
-                        if len(function) > 1:
-                            arguments = function[1:]
-                        function = function[0]
-                        score = function.score(plans,format='html',version=plan_version,score_arguments=arguments)
-                        sort = score
+    @staticmethod
+    def rank(panel):
+        """
+        Number the scores in a leaderboard panel in the panel's sort
+        order. Scores that sort equally are ranked by plan.
 
-                    else:
-                        score = ComputedPlanScore.compute(function,plan,format='html',version=plan_version)
-                        sort = ComputedPlanScore.compute(function,plan,format='sort',version=plan_version)
+        Parameters:
+            panel -- The leaderboard ScorePanel.
+        """
+        order = 'ASC NULLS FIRST' if panel.is_ascending else 'DESC NULLS LAST'
+        query = """UPDATE redistricting_leaderboardscore AS l SET rank = r.rank
+FROM (SELECT id, row_number() OVER (ORDER BY sort_value %(order)s, plan_id) AS rank
+    FROM redistricting_leaderboardscore WHERE panel_id = %(panel)d) AS r
+WHERE l.id = r.id AND l.rank <> r.rank""" % { 'order': order, 'panel': panel.id }
 
-                    planscores.append({
-                        'plan': plan,
-                        'name': function.get_short_label(),
-                        'label': function.get_label(),
-                        'description': function.get_long_description(),
-                        'score': score,
-                        'sort': sort
-                    })
+        cursor = connection.cursor()
+        cursor.execute(query)
+        transaction.commit_unless_managed()
 
-            if self.type == 'plan':
-                planscores.sort(key=lambda x:x['sort'],reverse=not self.is_ascending)
+    @staticmethod
+    def build(panel):
+        """
+        Score every valid plan of the panel's legislative body in a
+        leaderboard panel, replacing their previous scores.
 
-            return "" if len(planscores) == 0 else render_to_string(self.template, {
-                'settings': settings,
-                'planscores': planscores,
-                'functions': functions,
-                'title': self.get_short_label(),
-                'cssclass': self.cssclass,
-                'position': self.position,
-                'description': self.get_long_description(),
-                'planname': '' if len(plans) == 0 else plans[0].name,
-                'context': context
-            })
+        The plans are scored before the scores table is locked, so a 
+        plan may be refreshed or invalidated while the panel is scored.
+        The scores of a plan that was saved in the meantime are not 
+        stored, and the scores its refresh stored are kept.
 
-        # Render each district with multiple scores
-        elif self.type == 'district':
-            if is_list:
-                districts = dorp
-            else:
-                districts = [dorp]
+        Parameters:
+            panel -- The leaderboard ScorePanel.
 
-            districtscores = []
-            functions = []
-            for district in districts:
-                districtscore = { 'district':district, 'scores':[] }
+        Returns:
+            The number of plans whose scores were stored.
+        """
+        bodies = panel.displays.filter(is_page=True).values_list('legislative_body', flat=True)
+        edited = {}
+        scores = []
+        for plan in Plan.objects.filter(legislative_body__in=bodies, is_valid=True):
+            edited[plan.id] = plan.edited
+            scores += LeaderboardScore.score_plan(panel, plan)
 
-                if function_override:
-                    district_functions = reduce(lambda c: not c[0].is_planscore, components)
-                    
+        @transaction.commit_on_success
+        def store():
+            # Refreshes wait until the scores are stored and ranked
+            cursor = connection.cursor()
+            cursor.execute('LOCK TABLE redistricting_leaderboardscore IN SHARE ROW EXCLUSIVE MODE')
 
-                else:
-                    district_functions = self.score_functions.filter(is_planscore=False)
+            current = Plan.objects.filter(id__in=edited.keys(), is_valid=True).values_list('id', 'edited')
+            unchanged = set(plan_id for (plan_id, plan_edited,) in current if plan_edited == edited[plan_id])
 
+            LeaderboardScore.objects.filter(panel=panel, plan__in=list(unchanged)).delete()
+            LeaderboardScore.objects.bulk_create([score for score in scores if score.plan_id in unchanged])
+            LeaderboardScore.rank(panel)
+            return len(unchanged)
 
-                for function in district_functions:
-                    # Don't process this function if it isn't in the inclusion list
-                    if function_ids and not function.id in function_ids:
-                        continue
+        return store()
 
-                    if function_override:
-                        if len(function) > 1:
-                            arguments = function[1:]
-                        function = function[0]
-                        score = function.score(district,format='html',score_arguments=arguments)
-                    else:
-                        if not function.get_label() in functions:
-                            functions.append(function.get_label())
-                        score = ComputedDistrictScore.compute(function,district,format='html')
+    @staticmethod
+    def refresh(plan):
+        """
+        Replace the scores of a plan in the leaderboard panels of its
+        legislative body. If the plan is not valid, its scores are 
+        removed.
 
-                    districtscore['scores'].append({
-                        'district': district,
-                        'name': function.get_short_label(),
-                        'label': function.get_label(),
-                        'description': function.get_long_description(),
-                        'score': score
-                    })
+        Parameters:
+            plan -- The Plan to refresh.
+        """
+        LeaderboardScore.objects.filter(plan=plan).delete()
+        if not plan.is_valid:
+            return
 
-                if len(districtscore['scores']) > 0:
-                    districtscores.append(districtscore)
+        for panel in LeaderboardScore.get_panels(plan.legislative_body):
+            LeaderboardScore.objects.bulk_create(LeaderboardScore.score_plan(panel, plan))
+            LeaderboardScore.rank(panel)
 
-            return "" if len(districtscores) == 0 else render_to_string(self.template, {
-                'districtscores':districtscores,
-                'functions':functions,
-                'title': self.__unicode__(),
-                'cssclass': self.cssclass,
-                'settings':settings,
-                'position':self.position,
-                'context':context
-            })
+    @staticmethod
+    def get_scores(panel, owner=None, limit=None):
+        """
+        Get the scores of a leaderboard panel, in rank order. A panel 
+        that has not been built yet only has the scores of the plans
+        validated since.
 
-class ValidationCriteria(BaseModel):
-    """
-    Defines the required score functions to validate a legislative body
-    """
+        Parameters:
+            panel -- The leaderboard ScorePanel.
+            owner -- Optional; only get the scores of this user's plans.
+            limit -- Optional; the maximum number of scores to get.
 
-    # The score function this criteria is for
-    function = models.ForeignKey(ScoreFunction)
+        Returns:
+            A queryset of LeaderboardScores.
+        """
+        scores = LeaderboardScore.objects.filter(panel=panel)
+        if owner is not None:
+            scores = scores.filter(plan__owner=owner)
 
-    # Name of this validation criteria
-    name = models.CharField(max_length=50)
+        scores = scores.select_related('function', 'plan', 'plan__owner').order_by('rank')
+        if limit is not None:
+            scores = scores[:limit]
 
-    # The legislative body that this validation criteria is for
-    legislative_body = models.ForeignKey(LegislativeBody)
+        return scores
 
     def __unicode__(self):
-        return self.get_label()
+        return u'%d. %s / %s' % (self.rank, self.function.get_short_label(), self.plan.name)
 
-    class Meta:
-        """
-        Additional properties about the ValidationCriteria model.
-        """
-        verbose_name_plural = "Validation criterion"
+def remove_invalid_leaders(sender, **kwargs):
+    """
+    Remove a plan from the leaderboard when an edit invalidates it.
+    """
+    plan = kwargs['instance']
+    if not plan.is_valid:
+        LeaderboardScore.objects.filter(plan=plan).delete()
 
-        unique_together = ('name',)
+# Connect the post_save signal from a Plan object to the
+# remove_invalid_leaders helper method
+post_save.connect(remove_invalid_leaders, sender=Plan, dispatch_uid="publicmapping.redistricting.LeaderboardScore")
 
 
-class ComputedDistrictScore(models.Model):
+class LeaderboardBuild(models.Model):
     """
-    A score generated by a score function for a district that can be 
-    saved for later.
+    A record that a leaderboard panel was filled with the scores of every
+    valid plan.
 
-    These computed scores do not store the version number, since each
-    district has a unique version.
+    Once a panel is built, the scores of each plan are kept current as
+    plans are validated and edited, so the panel is only built once, in
+    the background, the first time it is read. A build that started
+    longer ago than the timeout is assumed to have failed.
     """
 
-    # The score function that computes this score
-    function = models.ForeignKey(ScoreFunction)
-
-    # The district that this score relates to
-    district = models.ForeignKey(District)
-
-    # The actual score value
-    value = models.TextField()
+    # The leaderboard panel that was built
+    panel = models.OneToOneField(ScorePanel)
 
-    def __unicode__(self):
-        name = ''
-        if not self.district is None:
-            if not self.district.plan is None:
-                name = '%s / %s' % (self.district.long_label, self.district.plan.name,)
-            else:
-                name = self.district.long_label
+    # The time the build started
+    started = models.DateTimeField()
 
-        if not self.function is None:
-            name = '%s / %s' % (self.function.get_short_label(), name)
-        else:
-            name = 'None / %s' % name
+    # The time the build finished, if it did
+    built = models.DateTimeField(null=True, blank=True)
 
-        return name
+    # A build that started longer ago than this may be started again
+    timeout = timedelta(minutes=10)
 
+    def __unicode__(self):
+        return 'Leaderboard build for %s' % self.panel
 
     @staticmethod
-    def compute(function,district,format='raw'):
+    def request(panel):
         """
-        Get the computed value. This method will leverage the cache when
-        it is available, or it will populate the cache if it is not.
-
-        If the cached score exists, it's value is not changed.
-
-        If the cached score does not exist, this method will create it.
+        Request that a leaderboard panel be built, unless it was built
+        already or is being built.
 
         Parameters:
-            function -- A ScoreFunction to compute with
-            district -- A District to compute on
+            panel -- The leaderboard ScorePanel.
 
         Returns:
-            The cached value for the district.
+            True if a task should be started to build the panel.
         """
-        created = False
-        try:
-            defaults = {'value':''}
-            cache,created = ComputedDistrictScore.objects.get_or_create(function=function, district=district, defaults=defaults)
+        now = datetime.now()
+        stale = LeaderboardBuild.objects.filter(panel=panel, built__isnull=True, 
+            started__lt=now - LeaderboardBuild.timeout)
+        if stale.update(started=now) > 0:
+            transaction.commit_unless_managed()
+            return True
 
-        except Exception as ex:
-            logger.info('Could not retrieve nor create computed district score for district %d.', district.id)
-            logger.debug('Reason:', ex)
-            return None
+        if LeaderboardBuild.objects.filter(panel=panel).exists():
+            return False
 
-        if created == True:
-            score = function.score(district, format='raw')
-            cache.value = cPickle.dumps(score)
-            cache.save()
-        else:
-            try:
-                score = cPickle.loads(str(cache.value))
-            except:
-                score = function.score(district, format='raw')
+        # A savepoint keeps the transaction usable if the insert fails
+        sid = transaction.savepoint()
+        try:
+            LeaderboardBuild(panel=panel, started=now).save(force_insert=True)
+            transaction.savepoint_commit(sid)
+            transaction.commit_unless_managed()
+            return True
+        except IntegrityError, ex:
+            # Another request started the build already
+            transaction.savepoint_rollback(sid)
+            logger.debug('Reason: %s', ex)
+            return False
 
-        if format != 'raw':
-            calc = function.get_calculator()
-            calc.result = score
-            if format == 'html':
-                return calc.html()
-            elif format == 'json':
-                return calc.json()
-            elif format == 'sort':
-                return calc.sortkey()
-            else:
-                # Unrecognized format!
-                return None
+    @staticmethod
+    def finish(panel):
+        """
+        Record that a leaderboard panel was built.
 
-        return score
+        Parameters:
+            panel -- The leaderboard ScorePanel.
+        """
+        LeaderboardBuild.objects.filter(panel=panel).update(built=datetime.now())
+        transaction.commit_unless_managed()
 
-    class Meta:
-        unique_together = (('function','district'),)
 
 
-class ComputedPlanScore(models.Model):
+class ScoreWarmup(models.Model):
     """
-    A score generated by a score function for a plan that can be saved
-    for later.
+    A pending computation of the scores displayed for a plan, after the
+    plan was edited.
 
-    These computed scores contain version numbers, since a plan's version
-    number is incremented each time, but scores need to exist for different
-    plan version numbers, for history, etc.
+    Each plan has at most one warm-up. It exists from the first edit 
+    until the scores are computed, so later edits only move the time it
+    was requested. The warm-ups that have started are the ones running.
     """
 
-    # The score function that computes this score
-    function = models.ForeignKey(ScoreFunction)
+    # The plan whose scores should be computed
+    plan = models.OneToOneField(Plan)
 
-    # The plan that this score relates to
-    plan = models.ForeignKey(Plan)
+    # The time of the latest edit to the plan
+    requested = models.DateTimeField()
 
-    # The version of the plan that this relates to
-    version = models.PositiveIntegerField(default=0)
+    # The time the scores started being computed
+    started = models.DateTimeField(null=True, blank=True)
 
-    # The actual score value
-    value = models.TextField()
+    # A warm-up that started longer ago than this is assumed to have 
+    # failed, and no longer counts as running
+    timeout = timedelta(minutes=10)
+
+    def __unicode__(self):
+        return 'Warm-up for %s' % self.plan.name
 
     @staticmethod
-    def compute(function, plan, version=None, format='raw'):
+    def request(plan):
         """
-        Get the computed value. This method will leverage the cache when
-        it is available, or it will populate the cache if it is not.
-
-        If the cached score exists, its value is not changed.
-
-        If the cached score does not exist, this method will create it.
+        Request that the scores of a plan be computed.
 
         Parameters:
-            function -- A ScoreFunction to compute with
-            plan -- A Plan to compute on
-            version -- Optional; the version of the plan to compute.
+            plan -- The Plan that was edited.
 
         Returns:
-            The cached value for the plan.
+            True if the plan had no warm-up pending, so a task should be
+            started for it.
         """
-        created = False
-        plan_version = version if version is not None else plan.version
+        now = datetime.now()
+        if ScoreWarmup.objects.filter(plan=plan).update(requested=now) > 0:
+            return False
+
+        # A savepoint keeps the transaction usable if the insert fails
+        sid = transaction.savepoint()
         try:
-            defaults = {'value':''}
-            cache,created = ComputedPlanScore.objects.get_or_create(function=function, plan=plan, version=plan_version, defaults=defaults)
+            ScoreWarmup(plan=plan, requested=now).save(force_insert=True)
+            transaction.savepoint_commit(sid)
+            return True
+        except IntegrityError, ex:
+            # Another edit created the warm-up already
+            transaction.savepoint_rollback(sid)
+            logger.debug('Reason: %s', ex)
+            ScoreWarmup.objects.filter(plan=plan).update(requested=now)
+            return False
 
-        except Exception,ex:
-            logger.info('Could not retrieve nor create ComputedPlanScore for plan %d', plan.id)
-            logger.debug('Reason:', ex)
-            return None
+    def start(self, limit):
+        """
+        Start computing the scores, if fewer than a number of warm-ups
+        are running.
 
-        if created:
-            score = function.score(plan, format='raw', version=plan_version)
-            cache.value = cPickle.dumps(score)
-            cache.save()
-        else:
-            try:
-                score = cPickle.loads(str(cache.value))
-            except:
-                score = function.score(plan, format='raw', version=plan_version)
-                cache.value = cPickle.dumps(score)
-                cache.save()
+        Parameters:
+            limit -- The number of warm-ups that may run at once.
 
-        if format != 'raw':
-            calc = function.get_calculator()
-            calc.result = score
-            if format == 'html':
-                return calc.html()
-            elif format == 'json':
-                return calc.json()
-            elif format == 'sort':
-                return calc.sortkey()
-            else:
-                # Unrecognized format!
-                return None
+        Returns:
+            True if the warm-up was started.
+        """
+        now = datetime.now()
+        running = ScoreWarmup.objects.filter(started__gt=now - ScoreWarmup.timeout).exclude(id=self.id).count()
+        if running >= limit:
+            return False
 
-        return score
+        self.started = now
+        ScoreWarmup.objects.filter(id=self.id).update(started=now)
+        return True
 
-    def __unicode__(self):
-        name = ''
-        if not self.plan is None:
-            name = self.plan.name
+    def finish(self):
+        """
+        Remove this warm-up, unless the plan was edited after it started.
 
-        if not self.function is None:
-            name = '%s / %s' % (self.function.get_short_label(), name)
-        else:
-            name = 'None / %s' % name
+        Returns:
+            True if the plan was edited, and the warm-up must run again.
+        """
+        ScoreWarmup.objects.filter(id=self.id, requested__lte=self.started).delete()
+        if ScoreWarmup.objects.filter(id=self.id).update(started=None) > 0:
+            return True
 
-        return name
+        return False
 
 
 class ContiguityOverride(models.Model):
@@ -3947,8 +6185,169 @@ class ContiguityOverride(models.Model):
         return '%s / %s' % (self.override_geounit.portable_id, self.connect_to_geounit.portable_id)
 
 
+class GeounitNeighbor(models.Model):
+    """
+    Defines a pair of geounits in the same geolevel that touch each other.
+
+    Geounits that share a boundary segment are rook neighbors. Geounits
+    that only share one or more points are queen neighbors. Each pair is
+    stored once, with the lower geounit id first.
+    """
+
+    # The geolevel of the geounits
+    geolevel = models.ForeignKey(Geolevel)
+
+    # The geounit with the lower id
+    geounit = models.ForeignKey(Geounit, related_name="neighbor_geounit")
+
+    # The geounit with the higher id
+    neighbor = models.ForeignKey(Geounit, related_name="neighbor_of_geounit")
+
+    # Whether the geounits share a boundary segment, and not only points
+    rook = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = (('geounit','neighbor'),)
+
+    def __unicode__(self):
+        return '%s / %s' % (self.geounit.portable_id, self.neighbor.portable_id)
+
+    @staticmethod
+    @transaction.commit_manually
+    def build(geolevel):
+        """
+        Compute the neighbors of all the geounits in a geolevel. Any 
+        previously computed neighbors in the geolevel are replaced.
+
+        Parameters:
+            geolevel -- The Geolevel whose geounits should be related.
+
+        Returns:
+            The number of neighbor pairs found.
+        """
+        query = """INSERT INTO redistricting_geounitneighbor (geolevel_id, geounit_id, neighbor_id, rook)
+SELECT %(geolevel)d, a.id, b.id, ST_Relate(a.geom, b.geom, '****1****')
+FROM redistricting_geounit AS a
+JOIN redistricting_geounit_geolevel AS agl ON a.id = agl.geounit_id
+JOIN redistricting_geounit AS b ON a.geom && b.geom AND a.id < b.id
+JOIN redistricting_geounit_geolevel AS bgl ON b.id = bgl.geounit_id
+WHERE agl.geolevel_id = %(geolevel)d AND bgl.geolevel_id = %(geolevel)d
+AND ST_Intersects(a.geom, b.geom)""" % { 'geolevel': geolevel.id }
+
+        try:
+            GeounitNeighbor.objects.filter(geolevel=geolevel).delete()
+
+            cursor = connection.cursor()
+            cursor.execute(query)
+            count = cursor.rowcount
+            transaction.commit()
+        except Exception as ex:
+            transaction.rollback()
+            logger.info('Could not compute the neighbors of geolevel %s.', geolevel.name)
+            logger.debug('Reason: %s', ex)
+            return 0
+
+        return count
+
+    @staticmethod
+    def is_built(geolevel_id):
+        """
+        Have the neighbors of a geolevel been computed?
+
+        Parameters:
+            geolevel_id -- The id of the Geolevel.
+
+        Returns:
+            True if any neighbors exist for the geolevel.
+        """
+        return GeounitNeighbor.objects.filter(geolevel__id=geolevel_id).exists()
+
+
+def count_components(nodes, edges):
+    """
+    Count the connected components of a graph, using a union-find
+    structure with path compression.
+
+    Parameters:
+        nodes -- The nodes of the graph.
+        edges -- A list of node pairs. Pairs that refer to nodes that 
+            are not in the graph are ignored.
+
+    Returns:
+        The number of connected components.
+    """
+    parent = dict((node, node,) for node in nodes)
+    components = len(parent)
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for (a, b,) in edges:
+        if not a in parent or not b in parent:
+            continue
+        ra = find(a)
+        rb = find(b)
+        if ra != rb:
+            parent[ra] = rb
+            components -= 1
+
+    return components
+
+
+def get_relation_kind(cursor, name):
+    """
+    Get the kind of a relation in the database search path.
+
+    Parameters:
+        cursor - A database cursor.
+        name - The name of the relation.
+
+    Returns:
+        'v' for a view, 'r' for a table, or None if there is no relation
+        with that name.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND pg_table_is_visible(oid);", [name])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def create_map_relation(cursor, name, select, params=None, materialize=False):
+    """
+    Create a relation that is mapped by the map server, either as a view
+    or as a table with a spatial index. A relation of the other kind with
+    the same name is dropped first.
+
+    Parameters:
+        cursor - A database cursor.
+        name - The name of the relation.
+        select - The query that defines the relation. It must have an
+            'id' and a 'geom' column.
+        params - Optional. The parameters of the query.
+        materialize - Optional. Create a table instead of a view.
+    """
+    kind = get_relation_kind(cursor, name)
+    if kind == 'v' and materialize:
+        cursor.execute('DROP VIEW %s;' % name)
+    elif kind == 'r':
+        cursor.execute('DROP TABLE %s;' % name)
+
+    if not materialize:
+        cursor.execute('CREATE OR REPLACE VIEW %s AS %s' % (name, select), params)
+        return
+
+    cursor.execute('CREATE TABLE %s AS %s' % (name, select), params)
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id);' % name)
+    cursor.execute('CREATE INDEX %s_geom_gist ON %s USING gist(geom);' % (name, name))
+    cursor.execute('ANALYZE %s;' % name)
+
 @transaction.commit_manually
-def configure_views():
+def configure_views(subjects=None, materialize=None):
     """
     Create the spatial views for all the regions, geolevels and subjects.
 
@@ -3956,47 +6355,72 @@ def configure_views():
     at different geographic levels, and for different choropleth map
     visualizations. All parameters for creating the views are saved
     in the database at this point.
+
+    If the CHOROPLETH_TABLES setting is on, the choropleth and simple
+    geounit layers are created as tables with spatial indexes instead,
+    so the map server does not join the geounits and characteristics
+    for every tile. The tables are rebuilt each time this is called.
+    The simple district layers change with every edit, and are always
+    views.
+
+    Parameters:
+        subjects - Optional. Only create the choropleth views of these
+            subjects, and leave the other views as they are.
+        materialize - Optional. Create tables instead of views. Defaults
+            to the CHOROPLETH_TABLES setting.
     """
+    if materialize is None:
+        materialize = getattr(settings, 'CHOROPLETH_TABLES', False)
+
     cursor = connection.cursor()
     
-    sql = "CREATE OR REPLACE VIEW identify_geounit AS SELECT rg.id, rg.name, rgg.geolevel_id, rg.geom, rc.number, rc.percentage, rc.subject_id FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id JOIN redistricting_characteristic rc ON rg.id = rc.geounit_id;"
-    cursor.execute(sql)
+    if subjects is None:
+        sql = "CREATE OR REPLACE VIEW identify_geounit AS SELECT rg.id, rg.name, rgg.geolevel_id, rg.geom, rc.number, rc.percentage, rc.subject_id FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id JOIN redistricting_characteristic rc ON rg.id = rc.geounit_id;"
+        cursor.execute(sql)
+
+        logger.debug('Created identify_geounit view ...')
 
-    logger.debug('Created identify_geounit view ...')
+        subjects = Subject.objects.all()
+        all_views = True
+    else:
+        all_views = False
 
     for geolevel in Geolevel.objects.all():
         if geolevel.legislativelevel_set.all().count() == 0:
             # Skip 'abstract' geolevels if regions are configured
             continue
 
-        lbset = ','.join(map( lambda x:str(x.legislative_body_id), geolevel.legislativelevel_set.all()))
-        sql = "CREATE OR REPLACE VIEW simple_district_%s AS SELECT rd.id, rd.district_id, rd.plan_id, st_geometryn(rd.simple, %d) AS geom, rp.legislative_body_id FROM publicmapping.redistricting_district as rd JOIN publicmapping.redistricting_plan as rp ON rd.plan_id = rp.id WHERE rp.legislative_body_id IN (%s);" % (geolevel.name, geolevel.id, lbset)
-        cursor.execute(sql)
-        try:
-            transaction.commit()
-        except:
-            transaction.rollback()
-            logger.error('Failed to create simple_district_%s view',
-                geolevel.name)
-            logger.error(format_exc())
+        if all_views:
+            lbset = ','.join(map( lambda x:str(x.legislative_body_id), geolevel.legislativelevel_set.all()))
+            sql = "SELECT rd.id, rd.district_id, rd.plan_id, rs.geom, rp.legislative_body_id FROM publicmapping.redistricting_district as rd JOIN publicmapping.redistricting_simpledistrict as rs ON rs.district_id = rd.id JOIN publicmapping.redistricting_plan as rp ON rd.plan_id = rp.id WHERE rs.geolevel_id = %d AND rp.legislative_body_id IN (%s);" % (geolevel.id, lbset)
+            try:
+                create_map_relation(cursor, 'simple_district_%s' % geolevel.name, sql)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                logger.error('Failed to create simple_district_%s view',
+                    geolevel.name)
+                logger.error(format_exc())
 
-        logger.debug('Created simple_district_%s view ...', geolevel.name)
+            logger.debug('Created simple_district_%s view ...', geolevel.name)
 
-        sql = "CREATE OR REPLACE VIEW simple_%s AS SELECT rg.id, rg.name, rgg.geolevel_id, rg.simple as geom FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id WHERE rgg.geolevel_id = %%(geolevel_id)s;" % geolevel.name
-        cursor.execute(sql, {'geolevel_id':geolevel.id})
-        try:
-            transaction.commit()
-        except:
-            transaction.rollback()
-            logger.error('Failed to create simple_%s view', geolevel.name)
-            logger.error(format_exc())
+            sql = "SELECT rg.id, rg.name, rgg.geolevel_id, rg.simple as geom FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id WHERE rgg.geolevel_id = %(geolevel_id)s;"
+            try:
+                create_map_relation(cursor, 'simple_%s' % geolevel.name, sql,
+                    {'geolevel_id':geolevel.id}, materialize)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                logger.error('Failed to create simple_%s view', geolevel.name)
+                logger.error(format_exc())
 
-        logger.debug('Created simple_%s view ...', geolevel.name)
+            logger.debug('Created simple_%s view ...', geolevel.name)
         
-        for subject in Subject.objects.all():
-            sql = "CREATE OR REPLACE VIEW %s AS SELECT rg.id, rg.name, rgg.geolevel_id, rg.geom, rc.number, rc.percentage FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id JOIN redistricting_characteristic rc ON rg.id = rc.geounit_id WHERE rc.subject_id = %%(subject_id)s AND rgg.geolevel_id = %%(geolevel_id)s;" % get_featuretype_name(geolevel.name, subject.name)
-            cursor.execute(sql, {'subject_id':subject.id, 'geolevel_id':geolevel.id})
+        for subject in subjects:
+            sql = "SELECT rg.id, rg.name, rgg.geolevel_id, rg.geom, rc.number, rc.percentage FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id JOIN redistricting_characteristic rc ON rg.id = rc.geounit_id WHERE rc.subject_id = %(subject_id)s AND rgg.geolevel_id = %(geolevel_id)s;"
             try:
+                create_map_relation(cursor, get_featuretype_name(geolevel.name, subject.name), sql,
+                    {'subject_id':subject.id, 'geolevel_id':geolevel.id}, materialize)
                 transaction.commit()
             except:
                 transaction.rollback()
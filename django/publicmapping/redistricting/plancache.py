@@ -0,0 +1,65 @@
+"""
+A local memory cache that is limited by the size of its values.
+
+Django's local memory cache only limits the number of entries it holds,
+which says little about its memory use when the entries are whole plan
+responses. This cache also removes entries when the pickled values it
+holds add up to more than MAX_BYTES, and never stores a value larger
+than that.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+Author:
+    Andrew Jennings, David Zwarg
+"""
+
+from django.core.cache.backends.locmem import LocMemCache
+
+class SizedLocMemCache(LocMemCache):
+    """
+    A local memory cache with a MAX_BYTES option, in addition to the
+    MAX_ENTRIES and CULL_FREQUENCY options of LocMemCache. A MAX_BYTES
+    of 0 does not limit the size of the cache.
+    """
+    def __init__(self, name, params):
+        LocMemCache.__init__(self, name, params)
+        options = params.get('OPTIONS', {})
+        self._max_bytes = int(options.get('MAX_BYTES', 0))
+
+    def _size(self):
+        """
+        Get the number of bytes of the pickled values in the cache.
+        """
+        return sum(len(value) for value in self._cache.values())
+
+    def _set(self, key, value, timeout=None):
+        """
+        Store a pickled value, culling the cache until the value fits.
+        The caller holds the write lock.
+        """
+        if self._max_bytes > 0:
+            if len(value) > self._max_bytes:
+                self._delete(key)
+                return
+
+            self._delete(key)
+            while len(self._cache) > 0 and self._size() + len(value) > self._max_bytes:
+                self._cull()
+
+        LocMemCache._set(self, key, value, timeout)
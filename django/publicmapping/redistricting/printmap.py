@@ -0,0 +1,544 @@
+"""
+Draw the map layers of a printed plan.
+
+The tiles of every layer are fetched at once, from a pool of threads,
+instead of drawing one layer after another. Tiles of layers that do not
+change between prints, such as the basemap and the geography, may be
+kept in a disk cache, which is trimmed to a maximum size by removing
+the tiles that were used least recently.
+
+The districts may also be drawn here, from their simplified geometries
+and the styles the map sends for printing, instead of by the map server.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+Author:
+    Andrew Jennings, David Zwarg, Kenny Shepard
+"""
+
+from django.conf import settings
+from multiprocessing.pool import ThreadPool
+from ModestMaps.Core import Coordinate, Point
+from PIL import Image, ImageDraw, ImageFont
+from lxml import etree
+from StringIO import StringIO
+from redistricting.vectortile import ORIGIN_SHIFT
+import hashlib, math, os, tempfile, threading, urllib2, logging
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# The number of times a tile is requested before it is left blank
+ATTEMPTS = 2
+
+# The number of bytes in each cache directory, as last measured and
+# counted since, so the caches are only walked when they are too large
+_cache_sizes = {}
+_cache_sizes_lock = threading.Lock()
+
+
+class TileCache(object):
+    """
+    A disk cache of tile images, keyed on the tile URL.
+
+    The size of the cache is measured the first time it is trimmed, and
+    the tiles written since are counted, so the cache directory is only
+    walked when it may have grown larger than its maximum size.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        Create a tile cache.
+
+        @param directory: The directory that holds the cached tiles.
+        @param max_size: The most bytes of tiles to keep, or 0 for no
+            limit.
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, url):
+        """
+        Get the path of the cached copy of a tile.
+
+        @param url: The URL of the tile.
+        @return: The path of the tile in the cache.
+        """
+        key = hashlib.md5(url).hexdigest()
+        return os.path.join(self.directory, key[0:2], key)
+
+    def get(self, url):
+        """
+        Read a cached tile. Reading a tile marks it as recently used.
+
+        @param url: The URL of the tile.
+        @return: The tile image data, or None if it is not cached.
+        """
+        path = self.path(url)
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            return None
+
+    def put(self, url, data):
+        """
+        Save a tile in the cache. The tile is written to a temporary file
+        first, so a partial tile is never read.
+
+        @param url: The URL of the tile.
+        @param data: The tile image data.
+        """
+        path = self.path(url)
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            replaced = os.path.exists(path)
+            (handle, temp,) = tempfile.mkstemp(dir=directory)
+            os.write(handle, data)
+            os.close(handle)
+            os.rename(temp, path)
+        except (IOError, OSError), ex:
+            logger.debug('Could not cache the tile %s: %s', url, ex)
+            return
+
+        if not replaced:
+            _cache_sizes_lock.acquire()
+            try:
+                if self.directory in _cache_sizes:
+                    _cache_sizes[self.directory] += len(data)
+            finally:
+                _cache_sizes_lock.release()
+
+    def trim(self):
+        """
+        Remove the least recently used tiles, until the cache is no
+        larger than its maximum size.
+
+        @return: The number of tiles removed.
+        """
+        if self.max_size <= 0 or not os.path.isdir(self.directory):
+            return 0
+
+        size = _cache_sizes.get(self.directory)
+        if not size is None and size <= self.max_size:
+            return 0
+
+        tiles = []
+        total = 0
+        for (root, dirs, files,) in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                tiles.append((stat.st_mtime, stat.st_size, path,))
+                total += stat.st_size
+
+        removed = 0
+        tiles.sort()
+        for (used, size, path,) in tiles:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+
+        _cache_sizes_lock.acquire()
+        try:
+            _cache_sizes[self.directory] = total
+        finally:
+            _cache_sizes_lock.release()
+
+        return removed
+
+
+def get_tile_cache():
+    """
+    Get the tile cache configured in the settings.
+
+    @return: A L{TileCache}, or None if tiles are not cached.
+    """
+    size = getattr(settings, 'PRINT_TILE_CACHE_SIZE', 0)
+    if size < 0:
+        return None
+    directory = getattr(settings, 'PRINT_TILE_CACHE', os.path.join(settings.WEB_TEMP, 'printtiles'))
+    return TileCache(directory, size)
+
+
+def fetch_tiles(urls, cache=None, threads=None, timeout=None):
+    """
+    Fetch tile images concurrently.
+
+    @param urls: The URLs of the tiles, or a dict of the L{TileCache} of
+        each URL, or None for the URLs that are not cached.
+    @keyword cache: Optional. A L{TileCache} to read the tiles from, and
+        save fetched tiles to, if urls is not a dict.
+    @keyword threads: Optional. The number of tiles fetched at once.
+        Defaults to the PRINT_THREADS setting.
+    @keyword timeout: Optional. The number of seconds to wait for each
+        tile. Defaults to the PRINT_TILE_TIMEOUT setting.
+    @return: A dict of the image data of each URL, or None for the tiles
+        that could not be fetched.
+    """
+    if threads is None:
+        threads = getattr(settings, 'PRINT_THREADS', 8)
+    if timeout is None:
+        timeout = getattr(settings, 'PRINT_TILE_TIMEOUT', 30)
+
+    if isinstance(urls, dict):
+        caches = urls
+    else:
+        caches = dict((url, cache,) for url in urls)
+
+    tiles = {}
+    missing = []
+    for (url, url_cache,) in caches.items():
+        data = None if url_cache is None else url_cache.get(url)
+        if data is None:
+            missing.append(url)
+        else:
+            tiles[url] = data
+
+    def fetch(url):
+        for attempt in range(ATTEMPTS):
+            try:
+                response = urllib2.urlopen(url, timeout=timeout)
+                try:
+                    return (url, response.read(),)
+                finally:
+                    response.close()
+            except Exception, ex:
+                logger.debug('Could not fetch the tile %s: %s', url, ex)
+        logger.warning('Could not fetch a tile after %d attempts; it is left blank.', ATTEMPTS)
+        return (url, None,)
+
+    if len(missing) > 0:
+        pool = ThreadPool(max(1, min(threads, len(missing))))
+        try:
+            for (url, data,) in pool.imap_unordered(fetch, missing):
+                tiles[url] = data
+                if not data is None and not caches[url] is None:
+                    caches[url].put(url, data)
+        finally:
+            pool.close()
+            pool.join()
+
+        trimmed = []
+        for url_cache in caches.values():
+            if not url_cache is None and not url_cache in trimmed:
+                url_cache.trim()
+                trimmed.append(url_cache)
+
+    return tiles
+
+
+def tile_layout(mmap):
+    """
+    Get the tiles that cover a map, and where each is drawn.
+
+    @param mmap: A ModestMaps Map.
+    @return: A list of tuples of the URLs of each tile, and the pixel
+        offset of its upper left corner in the map.
+    """
+    provider = mmap.provider
+    width = provider.tileWidth()
+    height = provider.tileHeight()
+
+    # The tile under the upper left corner of the map
+    origin = mmap.pointCoordinate(Point(0, 0))
+    corner = origin.container()
+    left = int(round((corner.column - origin.column) * width))
+    top = int(round((corner.row - origin.row) * height))
+
+    layout = []
+    (y, row,) = (top, corner.row,)
+    while y < mmap.dimensions.y:
+        (x, column,) = (left, corner.column,)
+        while x < mmap.dimensions.x:
+            source = provider.sourceCoordinate(Coordinate(row, column, corner.zoom))
+            urls = () if source is None else provider.getTileUrls(source)
+            layout.append((tuple(urls or ()), (x, y,),))
+            (x, column,) = (x + width, column + 1,)
+        (y, row,) = (y + height, row + 1,)
+
+    return layout
+
+
+def draw_maps(maps, threads=None):
+    """
+    Draw map layers, fetching the tiles of all the layers at once.
+
+    @param maps: A list of tuples of a ModestMaps Map, and the
+        L{TileCache} for its tiles, or None if its tiles are not cached.
+    @keyword threads: Optional. The number of tiles fetched at once.
+    @return: A list of the RGB image of each map.
+    """
+    layouts = [tile_layout(mmap) for (mmap, cache,) in maps]
+
+    # Fetch the tiles of all the layers in one pool, each with the cache
+    # of its layer
+    caches = {}
+    for ((mmap, cache,), layout,) in zip(maps, layouts):
+        for (tile_urls, offset,) in layout:
+            for url in tile_urls:
+                if caches.get(url) is None:
+                    caches[url] = cache
+    tiles = fetch_tiles(caches, threads=threads)
+
+    images = {}
+    def open_tile(url):
+        if not url in images:
+            images[url] = None
+            if not tiles.get(url) is None:
+                try:
+                    images[url] = Image.open(StringIO(tiles[url])).convert('RGBA')
+                except IOError, ex:
+                    logger.debug('Could not read the tile %s: %s', url, ex)
+        return images[url]
+
+    drawn = []
+    for ((mmap, cache,), layout,) in zip(maps, layouts):
+        img = Image.new('RGB', (mmap.dimensions.x, mmap.dimensions.y))
+        size = (mmap.provider.tileWidth(), mmap.provider.tileHeight(),)
+        for (tile_urls, offset,) in layout:
+            tile = Image.new('RGBA', size)
+            for url in tile_urls:
+                part = open_tile(url)
+                if not part is None:
+                    tile.paste(part, (0, 0,), part)
+            img.paste(tile, offset, tile)
+        drawn.append(img)
+
+    return drawn
+
+
+def map_bounds(mmap):
+    """
+    Get the spherical mercator extent of a drawn map. The map may cover
+    more than the extent it was made for, since its zoom level is fixed
+    to that of the tiles.
+
+    @param mmap: A ModestMaps Map.
+    @return: A tuple of (xmin, ymin, xmax, ymax).
+    """
+    def mercator(location):
+        x = location.lon * ORIGIN_SHIFT / 180.0
+        y = math.log(math.tan((90 + location.lat) * math.pi / 360.0)) / (math.pi / 180.0)
+        return (x, y * ORIGIN_SHIFT / 180.0,)
+
+    (xmin, ymax,) = mercator(mmap.pointLocation(Point(0, 0)))
+    (xmax, ymin,) = mercator(mmap.pointLocation(Point(mmap.dimensions.x, mmap.dimensions.y)))
+    return (xmin, ymin, xmax, ymax,)
+
+
+def parse_color(value, default=None):
+    """
+    Read a color in the #rrggbb or #rgb notation.
+
+    @param value: The color.
+    @keyword default: Optional. The color used if the value cannot be
+        read.
+    @return: A tuple of (red, green, blue).
+    """
+    value = (value or '').strip().lstrip('#')
+    if len(value) == 3:
+        value = ''.join(c * 2 for c in value)
+    try:
+        return (int(value[0:2], 16), int(value[2:4], 16), int(value[4:6], 16),)
+    except ValueError:
+        return default
+
+
+def parse_sld(sld):
+    """
+    Read the district styles from a styled layer descriptor, as written
+    for printing by the map. Each rule styles the districts whose ids
+    are listed in its filter.
+
+    @param sld: The styled layer descriptor, as a string.
+    @return: A list of dicts of the 'ids' of the districts each rule
+        applies to, and the 'fill', 'fill_opacity', 'stroke',
+        'stroke_width', 'label', 'font_size', and 'font_color' styles.
+        Styles that are not in the rule are None.
+    """
+    def local(element):
+        return etree.QName(element).localname
+
+    def params(element, name):
+        found = {}
+        for child in element:
+            if local(child) == name:
+                for param in child:
+                    if local(param) == 'CssParameter':
+                        found[param.get('name')] = (param.text or '').strip()
+        return found
+
+    rules = []
+    root = etree.fromstring(sld.encode('utf-8') if isinstance(sld, unicode) else sld)
+    for rule in root.xpath('//*[local-name()="Rule"]'):
+        style = { 'ids': set(), 'fill': None, 'fill_opacity': 1.0, 'stroke': None,
+            'stroke_width': 1, 'label': None, 'font_size': 12, 'font_color': (0, 0, 0,) }
+
+        for literal in rule.xpath('.//*[local-name()="PropertyIsEqualTo"]/*[local-name()="Literal"]'):
+            fid = (literal.text or '').strip().split('.')[-1]
+            if fid.isdigit():
+                style['ids'].add(int(fid))
+
+        for symbolizer in rule:
+            kind = local(symbolizer)
+            if kind in ('PolygonSymbolizer', 'LineSymbolizer',):
+                fill = params(symbolizer, 'Fill')
+                if kind == 'PolygonSymbolizer' and 'fill' in fill:
+                    style['fill'] = parse_color(fill['fill'])
+                    style['fill_opacity'] = float(fill.get('fill-opacity', 1))
+                stroke = params(symbolizer, 'Stroke')
+                if 'stroke' in stroke:
+                    style['stroke'] = parse_color(stroke['stroke'])
+                    style['stroke_width'] = max(1, int(round(float(stroke.get('stroke-width', 1)))))
+            elif kind == 'TextSymbolizer':
+                for child in symbolizer:
+                    if local(child) == 'Label':
+                        style['label'] = ''.join(child.itertext()).strip()
+                font = params(symbolizer, 'Font')
+                style['font_size'] = int(round(float(font.get('font-size', 12))))
+                fill = params(symbolizer, 'Fill')
+                style['font_color'] = parse_color(fill.get('fill'), (0, 0, 0,))
+
+        rules.append(style)
+
+    return rules
+
+
+def _pixel_rings(geometry, bounds, size):
+    """
+    Convert the rings of the polygons in a geometry to pixel coordinates,
+    transforming all the coordinates at once.
+
+    @return: A list of the rings of each polygon, exterior ring first,
+        as numpy arrays of pixel coordinates.
+    """
+    if geometry.geom_type == 'Polygon':
+        polygons = [geometry]
+    else:
+        polygons = [part for part in geometry if part.geom_type == 'Polygon']
+
+    rings = [[numpy.asarray(ring.coords, dtype=numpy.float64) for ring in polygon] for polygon in polygons]
+    counts = [len(ring) for polygon in rings for ring in polygon]
+    if sum(counts) == 0:
+        return []
+
+    (xmin, ymin, xmax, ymax,) = bounds
+    scale = numpy.array([size[0] / float(xmax - xmin), size[1] / float(ymin - ymax)])
+    points = (numpy.concatenate([ring for polygon in rings for ring in polygon])[:, 0:2] -
+        numpy.array([xmin, ymax])) * scale
+    pixels = numpy.split(points, numpy.cumsum(counts)[:-1])
+
+    pixels = iter(pixels)
+    return [[pixels.next() for ring in polygon] for polygon in rings]
+
+
+def _font(size):
+    """
+    Load the font of the district labels.
+    """
+    try:
+        return ImageFont.truetype(getattr(settings, 'PRINT_FONT', 'DejaVuSans.ttf'), size)
+    except IOError:
+        return ImageFont.load_default()
+
+
+def draw_districts(districts, rules, bounds, size, background=(255, 255, 255,)):
+    """
+    Draw the districts of a printed plan, without a map server.
+
+    @param districts: A list of tuples of the id of each district, its
+        simplified GEOS geometry in spherical mercator, and the point
+        where its label is drawn.
+    @param rules: The styles of the districts, as read by L{parse_sld}.
+    @param bounds: The spherical mercator extent of the map.
+    @param size: The size of the map, in pixels, as (width, height).
+    @keyword background: Optional. The color behind the districts.
+    @return: An RGB image of the districts.
+    """
+    img = Image.new('RGB', size, background)
+    draw = ImageDraw.Draw(img)
+
+    pixels = {}
+    for (district_id, geometry, point,) in districts:
+        pixels[district_id] = _pixel_rings(geometry, bounds, size)
+
+    (xmin, ymin, xmax, ymax,) = bounds
+    fonts = {}
+    for rule in rules:
+        ids = [d for d in rule['ids'] if d in pixels]
+
+        if not rule['fill'] is None:
+            alpha = int(round(255 * rule['fill_opacity']))
+            for district_id in ids:
+                if len(pixels[district_id]) == 0:
+                    continue
+
+                # Draw each district into a mask the size of the district,
+                # so the holes are cut out
+                points = numpy.concatenate([ring for polygon in pixels[district_id] for ring in polygon])
+                (left, top,) = [int(v) for v in numpy.maximum(numpy.floor(points.min(axis=0)), 0)]
+                (right, bottom,) = [int(v) for v in numpy.minimum(numpy.ceil(points.max(axis=0)) + 1, size)]
+                if right <= left or bottom <= top:
+                    continue
+
+                origin = numpy.array([left, top])
+                mask = Image.new('L', (right - left, bottom - top))
+                mask_draw = ImageDraw.Draw(mask)
+                for polygon in pixels[district_id]:
+                    mask_draw.polygon((polygon[0] - origin).ravel().tolist(), fill=alpha)
+                    for hole in polygon[1:]:
+                        mask_draw.polygon((hole - origin).ravel().tolist(), fill=0)
+                img.paste(rule['fill'], (left, top, right, bottom,), mask)
+
+        if not rule['stroke'] is None:
+            for district_id in ids:
+                for polygon in pixels[district_id]:
+                    for ring in polygon:
+                        draw.line(ring.ravel().tolist(), fill=rule['stroke'], width=rule['stroke_width'])
+
+        if not rule['label'] is None:
+            if not rule['font_size'] in fonts:
+                fonts[rule['font_size']] = _font(rule['font_size'])
+            font = fonts[rule['font_size']]
+            for (district_id, geometry, point,) in districts:
+                if not district_id in rule['ids'] or point is None:
+                    continue
+                x = (point.x - xmin) * size[0] / float(xmax - xmin)
+                y = (ymax - point.y) * size[1] / float(ymax - ymin)
+                (width, height,) = draw.textsize(rule['label'], font=font)
+                draw.text((x - width / 2, y - height / 2,), rule['label'], fill=rule['font_color'], font=font)
+
+    return img
@@ -40,7 +40,10 @@ printplan = function(options) {
             height: 500,
             width: 1024
         }, options),
-        _styleCache = {};
+        _styleCache = {},
+        // The window that shows the print, opened by the click so it
+        // isn't stopped by popup blockers
+        _printWindow = null;
 
     /**
      * Initialize the print button. Setup the click event for the target to
@@ -316,28 +319,88 @@ printplan = function(options) {
             sz.right = cen.lon + new_w / 2.0;
         }
 
-        // POST all these items to the printing endpoint
-        $(document.body).append('<form id="printForm" method="POST" action="../print/" target="_blank">' +
-            '<input type="hidden" name="csrfmiddlewaretoken" value="' + $('input[name=csrfmiddlewaretoken]').val() + '"/>' +
-            '<input type="hidden" name="plan_id" value="' + PLAN_ID + '"/>' +
-            '<input type="hidden" name="height" value="' + _options.height + '"/>' +
-            '<input type="hidden" name="width" value="' + _options.width + '"/>' +
-            '<input type="hidden" name="geography_url" value="' + geogurl + '"/>' +
-            '<input type="hidden" name="geography_lyr" value="' + geolyr + '"/>' +
-            '<input type="hidden" name="district_url" value="' + disturl + '"/>' +
-            '<input type="hidden" name="district_lyr" value="' + distlyr + '"/>' +
-            '<input type="hidden" name="bbox" value="' + sz.toBBOX() + '"/>' +
-            '<input type="hidden" name="opacity" value="' + _options.districtLayer.opacity + '"/>' +
-            '<textarea name="legend" style="display:none;">' + legendfmt.write(legend) + '</textarea>' +
-            '<textarea name="district_sld" style="display:none;">' + district_sld + '</textarea>' +
-            '<textarea name="label_sld" style="display:none;">' + label_sld + '</textarea>' +
-            '</form>');
-
-        // submit the form
-        $('#printForm').submit();
-
-        // remove the form from the document, so you can print more than once
-        $('#printForm').remove();
+        // POST all these items to the printing endpoint, which renders
+        // the print in the background
+        $.ajax({
+            url: '../printjob/',
+            type: 'POST',
+            dataType: 'json',
+            data: {
+                csrfmiddlewaretoken: $('input[name=csrfmiddlewaretoken]').val(),
+                plan_id: PLAN_ID,
+                height: _options.height,
+                width: _options.width,
+                geography_url: geogurl,
+                geography_lyr: geolyr,
+                district_url: disturl,
+                district_lyr: distlyr,
+                bbox: sz.toBBOX(),
+                opacity: _options.districtLayer.opacity,
+                legend: legendfmt.write(legend),
+                district_sld: district_sld,
+                label_sld: label_sld
+            },
+            success: _self.printstatus,
+            error: function() { _self.printstatus(null); }
+        });
+        $(_options.target).button('option', 'disabled', true);
+
+        _printWindow = window.open('', '_blank');
+    };
+
+    /**
+     * Check the status of a print job, until the print is ready.
+     */
+    _self.printstatus = function(data) {
+        if (data === null || !data.success) {
+            $(_options.target).button('option', 'disabled', false);
+            _self.closeprint();
+            if (data !== null && 'redirect' in data) {
+                window.location.href = data.redirect;
+            }
+            else if (data !== null) {
+                alert(data.message);
+            }
+            return;
+        }
+
+        if (data.status == 'busy') {
+            setTimeout(function() {
+                $.ajax({
+                    url: '../printstatus/',
+                    data: { job: data.job },
+                    dataType: 'json',
+                    success: _self.printstatus,
+                    error: function() { _self.printstatus(null); }
+                });
+            }, data.retry * 1000);
+            return;
+        }
+
+        $(_options.target).button('option', 'disabled', false);
+        if (data.status == 'ready') {
+            if (_printWindow !== null && !_printWindow.closed) {
+                _printWindow.location.href = data.url;
+                _printWindow = null;
+            }
+            else {
+                window.open(data.url);
+            }
+        }
+        else {
+            _self.closeprint();
+            alert(data.message);
+        }
+    };
+
+    /**
+     * Close the window that was opened for a print that failed.
+     */
+    _self.closeprint = function() {
+        if (_printWindow !== null && !_printWindow.closed) {
+            _printWindow.close();
+        }
+        _printWindow = null;
     };
 
     var convertPtToPx = function(str) {
@@ -41,11 +41,15 @@ from redistricting.models import *
 from redistricting.config import *
 from tagging.utils import parse_tag_input
 from tagging.models import Tag, TaggedItem
-from datetime import datetime
+from datetime import datetime, timedelta
 from lxml import etree, objectify
 from djsld import generator
+from redistricting.printmap import draw_maps, get_tile_cache, map_bounds, parse_sld, draw_districts
+from xhtml2pdf.pisa import CreatePDF
+from PIL import Image, ImageChops
 import csv, time, zipfile, tempfile, os, sys, traceback, time
-import socket, urllib2, logging, re
+import socket, urllib2, logging, re, hashlib, StringIO
+import ModestMaps
 
 # all for shapefile exports
 from glob import glob
@@ -922,6 +926,37 @@ def cleanup():
     management.call_command('cleanup') 
 
 
+@task
+def cleanup_prints():
+    """
+    Remove the printed plans that are older than the PRINT_MAX_AGE 
+    setting, in hours.
+
+    @return: The number of files removed
+    """
+    removed = PlanPrint.cleanup(getattr(settings, 'PRINT_MAX_AGE', 24) * 3600)
+    logger.info('Removed %d printed plan files.', removed)
+    return removed
+
+
+@task
+def evict_scores():
+    """
+    Remove the cached scores that are no longer needed. The retention
+    policy is read from the SCORE_CACHE_MAX_AGE, SCORE_CACHE_CHECKPOINTS,
+    and SCORE_CACHE_MAX_ROWS settings.
+
+    @return: A dict of the number of scores removed from each table
+    """
+    removed = ScoreCache.evict(timedelta(days=getattr(settings, 'SCORE_CACHE_MAX_AGE', 30)),
+        checkpoints=getattr(settings, 'SCORE_CACHE_CHECKPOINTS', 5),
+        max_rows=getattr(settings, 'SCORE_CACHE_MAX_ROWS', 0))
+    for (table, count,) in removed.items():
+        logger.info('Removed %d cached scores from %s.', count, table)
+
+    return removed
+
+
 class PlanReport:
     """
     A collection of static methods that assist in asynchronous report
@@ -1212,6 +1247,376 @@ class CalculatorReport:
         return '/reports/%s.html' % filename
 
 
+class PlanPrint:
+    """
+    A collection of static methods that render printable PDFs of plans,
+    in the background or during a request.
+
+    Each print is identified by a job id, which is a hash of the plan,
+    its version, the time it was last saved, and the parameters that
+    change the printed page, so a print that was already rendered is
+    served from the PDF on disk. Version numbers are reused after an
+    undo, and renames and locks don't change the version, so the saved
+    time is needed to tell the prints apart.
+    """
+
+    # The request parameters that change the printed page
+    PARAMETERS = ('bbox', 'geography_url', 'geography_lyr', 'district_url',
+        'district_lyr', 'district_sld', 'label_sld', 'legend', 'opacity',
+        'height', 'width',)
+
+    @staticmethod
+    def get_params(request):
+        """
+        Get the print parameters of a request.
+
+        Parameters:
+            request - A dict-like of the request parameters.
+
+        Returns:
+            A dict of the print parameters, or None if a required 
+            parameter is missing.
+        """
+        for key in ('bbox', 'geography_url', 'geography_lyr', 'district_url', 'district_lyr',):
+            if not key in request:
+                return None
+        return dict((key, request[key],) for key in PlanPrint.PARAMETERS if key in request)
+
+    @staticmethod
+    def get_job_id(plan, params, language=None):
+        """
+        Get the id of a print of a plan.
+
+        Parameters:
+            plan - The Plan to print.
+            params - The print parameters.
+            language - Optional. The language the page is printed in.
+
+        Returns:
+            A string that identifies the print.
+        """
+        sha = hashlib.sha1()
+        sha.update('%d:%d:%s:%s' % (plan.id, plan.version, plan.edited.isoformat(), language or ''))
+        for key in PlanPrint.PARAMETERS:
+            sha.update('\0%s=%s' % (key, unicode(params.get(key, '')).encode('utf-8'),))
+        return 'p%d_v%d_%s' % (plan.id, plan.version, sha.hexdigest())
+
+    @staticmethod
+    def get_file_name(job_id):
+        """
+        Get the path of a printed PDF, without the extension.
+        """
+        return '%s/print-%s' % (settings.WEB_TEMP, job_id)
+
+    @staticmethod
+    def checkprint(job_id):
+        """
+        Check on the status of a print. A print that has been pending
+        longer than the PRINT_JOB_TIMEOUT setting is assumed to have 
+        failed, and may be started again.
+
+        Returns:
+            'ready' if the PDF exists, 'busy' if it is being rendered, or
+            'free' if it has not been started.
+        """
+        basename = PlanPrint.get_file_name(job_id)
+        if os.path.exists(basename + '.pdf'):
+            return 'ready'
+
+        pending = basename + '.pending'
+        try:
+            age = time.time() - os.path.getmtime(pending)
+        except OSError:
+            return 'free'
+
+        if age > getattr(settings, 'PRINT_JOB_TIMEOUT', 600):
+            return 'free'
+        return 'busy'
+
+    @staticmethod
+    def waitprint(job_id, interval=1):
+        """
+        Wait for a print that is being rendered in the background to 
+        finish, or to fail.
+
+        Parameters:
+            job_id - The id of the print.
+            interval - Optional. The number of seconds between checks.
+
+        Returns:
+            The status of the print, which is never 'busy'.
+        """
+        status = PlanPrint.checkprint(job_id)
+        while status == 'busy':
+            time.sleep(interval)
+            status = PlanPrint.checkprint(job_id)
+        return status
+
+    @staticmethod
+    def cleanup(max_age):
+        """
+        Remove the printed PDFs and maps that are older than a number of
+        seconds. A print that is still pending is kept.
+
+        Parameters:
+            max_age - The number of seconds a print is kept.
+
+        Returns:
+            The number of files removed.
+        """
+        removed = 0
+        expired = time.time() - max_age
+        for path in glob('%s/print-*' % settings.WEB_TEMP):
+            if path.endswith('.pending'):
+                continue
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                # Another process removed it already
+                pass
+        return removed
+
+    @staticmethod
+    def markpending(job_id):
+        """
+        Create a pending file, to indicate that a print is in the works.
+        """
+        pending = open(PlanPrint.get_file_name(job_id) + '.pending', 'w')
+        pending.close()
+
+    @staticmethod
+    def getprint(job_id):
+        """
+        Get the web address of a printed PDF.
+        """
+        return '/reports/print-%s.pdf' % job_id
+
+    @staticmethod
+    def render(plan, params, prefix, job_id):
+        """
+        Render the page of a printed plan. The map is drawn into an image
+        next to the PDF, and read by the page from the web server.
+
+        Parameters:
+            plan - The Plan to print.
+            params - The print parameters.
+            prefix - The address of the web server.
+            job_id - The id of the print.
+
+        Returns:
+            The PDF, as a string of bytes.
+        """
+        height = 500*2
+        if 'height' in params:
+            height = int(params['height'])*2
+        width = 1024*2
+        if 'width' in params:
+            width = int(params['width'])*2
+        opacity = 0.8
+        if 'opacity' in params:
+            opacity = float(params['opacity'])
+
+        full_legend = json.loads(params['legend'])
+
+        cfg = {
+            'plan': plan,
+            'printed': datetime.now(),
+            'prefix': prefix,
+            'composite': '/reports/print-%s.jpg' % job_id,
+            'geo_legend': full_legend['geo'],
+            'geo_legend_title': full_legend['geotitle'],
+            'dist_legend': full_legend['dist'],
+            'dist_legend_title': full_legend['disttitle']
+        }
+
+        # use modestmaps to get the basemap
+        bbox = params['bbox'].split(',')
+
+        pt1 = Point(float(bbox[0]), float(bbox[1]), srid=3785)
+        pt1.transform(SpatialReference('EPSG:4326'))
+        ll = ModestMaps.Geo.Location(pt1.y, pt1.x)
+
+        pt2 = Point(float(bbox[2]), float(bbox[3]), srid=3785)
+        pt2.transform(SpatialReference('EPSG:4326'))
+        ur = ModestMaps.Geo.Location(pt2.y, pt2.x)
+
+        dims = ModestMaps.Core.Point(width, height)
+        provider = ModestMaps.OpenStreetMap.Provider()
+        basemap = ModestMaps.mapByExtent(provider, ll, ur, dims)
+
+        # geography layer
+        provider = ModestMaps.WMS.Provider(params['geography_url'], {
+            'LAYERS':params['geography_lyr'],
+            'TRANSPARENT':'true',
+            'SRS': 'EPSG:3785',
+            'HEIGHT': 512,
+            'WIDTH': 512
+        })
+        geography = ModestMaps.mapByExtent(provider, ll, ur, dims)
+
+        # the basemap and geography do not change between prints, so 
+        # their tiles are cached
+        cache = get_tile_cache()
+
+        if getattr(settings, 'PRINT_DRAW_DISTRICTS', True):
+            (fullImg, overlayImg,) = draw_maps([(basemap, cache,), (geography, cache,)])
+
+            # draw the district fills, lines & labels from the district
+            # geometries, in the styles of the map
+            bounds = map_bounds(basemap)
+            fill_rules = parse_sld(params['district_sld']) if params.get('district_sld') else []
+            label_rules = parse_sld(params['label_sld']) if params.get('label_sld') else []
+            districts = PlanPrint.get_districts(plan, fill_rules + label_rules, bounds, width)
+            districtImg = draw_districts(districts, fill_rules, bounds, (width, height,))
+            labelImg = draw_districts(districts, label_rules, bounds, (width, height,), background=(0, 0, 0,))
+        else:
+            # district fill layer
+            provider = ModestMaps.WMS.Provider(params['district_url'], {
+                'LAYERS':params['district_lyr'],
+                'TRANSPARENT':'false',
+                'SRS': 'EPSG:3785',
+                'SLD_BODY': params['district_sld'],
+                'HEIGHT': 512,
+                'WIDTH': 512
+            })
+            districts = ModestMaps.mapByExtent(provider, ll, ur, dims)
+
+            # district line & label layer
+            provider = ModestMaps.WMS.Provider(params['district_url'], {
+                'LAYERS':params['district_lyr'],
+                'TRANSPARENT':'true',
+                'SRS': 'EPSG:3785',
+                'SLD_BODY': params['label_sld'],
+                'HEIGHT': 512,
+                'WIDTH': 512
+            })
+            labels = ModestMaps.mapByExtent(provider, ll, ur, dims)
+
+            # fetch the tiles of all the layers at once
+            (fullImg, overlayImg, districtImg, labelImg,) = draw_maps([(basemap, cache,),
+                (geography, cache,), (districts, None,), (labels, None,)])
+
+        # create an invert mask of the geography
+        maskImg = ImageChops.invert(overlayImg)
+
+        overlayImg = Image.blend(overlayImg, districtImg, 0.5)
+
+        # composite the overlay onto the base, using the mask (from geography)
+        fullImg = Image.composite(fullImg, Image.blend(fullImg, overlayImg, opacity), maskImg)
+
+        # create an invert mask of the labels & lines
+        maskImg = ImageChops.invert(labelImg)
+
+        # composite the district labels on top of the composited basemap, geography & district areas
+        fullImg = Image.composite(fullImg, Image.blend(fullImg, labelImg, opacity), maskImg)
+
+        # save
+        fullImg.save(PlanPrint.get_file_name(job_id) + '.jpg', 'jpeg', quality=100)
+
+        # render pg to a string
+        t = loader.get_template('printplan.html')
+        page = t.render(DjangoContext(cfg))
+        result = StringIO.StringIO()
+
+        # setting encoding='UTF-8' causes an exception. removing this for now,
+        # as allowing the method to set an encoding itself fixes the problem.
+        # we may need to find an alternate strategy if it finds encodings that
+        # it isn't able to decipher.
+        CreatePDF(page, result, show_error_as_pdf=True)
+
+        return result.getvalue()
+
+    @staticmethod
+    def get_districts(plan, rules, bounds, width):
+        """
+        Get the districts to draw on a printed plan. The districts are 
+        the ones the print styles apply to, simplified at the geolevel 
+        that suits the scale of the print.
+
+        Parameters:
+            plan - The printed Plan.
+            rules - The styles of the districts, as read by parse_sld.
+            bounds - The spherical mercator extent of the print.
+            width - The width of the print, in pixels.
+
+        Returns:
+            A list of tuples of the id of each district, its simplified
+            geometry, and the point where its label is drawn.
+        """
+        ids = set()
+        for rule in rules:
+            ids.update(rule['ids'])
+        if len(ids) == 0:
+            ids = set(d.id for d in plan.get_districts_at_version(plan.version))
+
+        # The coarsest geolevel whose simplification is not visible at 
+        # the scale of the print
+        resolution = (bounds[2] - bounds[0]) / width
+        levels = plan.legislative_body.get_geolevels()
+        geolevel = levels[-1]
+        for level in levels:
+            if level.tolerance <= resolution:
+                geolevel = level
+                break
+
+        extent = Polygon.from_bbox(bounds)
+        extent.srid = 3785
+        simples = SimpleDistrict.objects.filter(district__in=ids, geolevel=geolevel, 
+            district__plan=plan, geom__bboverlaps=extent)
+
+        districts = []
+        for simple in simples:
+            if simple.geom.empty:
+                continue
+            districts.append((simple.district_id, simple.geom, simple.geom.point_on_surface,))
+        return districts
+
+    @staticmethod
+    @task
+    def createprint(planid, params, prefix, job_id, language=None):
+        """
+        Render a printed plan, and save the PDF.
+
+        Parameters:
+            planid - The plan ID.
+            params - The print parameters.
+            prefix - The address of the web server.
+            job_id - The id of the print.
+            language - Optional. If provided, translate the page into the
+                specified language (if message files are complete).
+        """
+        basename = PlanPrint.get_file_name(job_id)
+
+        prev_lang = None
+        if not language is None:
+            prev_lang = get_language()
+            activate(language)
+
+        try:
+            plan = Plan.objects.get(pk=planid)
+            pdf = PlanPrint.render(plan, params, prefix, job_id)
+
+            # Write the PDF under another name first, so a partial PDF
+            # is never served
+            (handle, temp,) = tempfile.mkstemp(dir=settings.WEB_TEMP)
+            os.write(handle, pdf)
+            os.close(handle)
+            os.chmod(temp, 0644)
+            os.rename(temp, basename + '.pdf')
+        except Exception as ex:
+            logger.warn('Error printing plan %s', planid)
+            logger.debug('Reason: %s', ex)
+        finally:
+            if os.path.exists(basename + '.pending'):
+                os.unlink(basename + '.pending')
+
+            # reset the language back to default
+            if not prev_lang is None:
+                activate(prev_lang)
+
+
 #
 # Reaggregation tasks
 #
@@ -1246,6 +1651,112 @@ def reaggregate_plan(plan_id):
 
         return None
 
+#
+# Score warm-up tasks
+#
+def schedule_score_warmup(plan):
+    """
+    Compute the scores displayed for a plan in the background, after it
+    is edited. The scores are computed once the plan has not been edited
+    for SCORE_WARMUP_DELAY seconds, and at most SCORE_WARMUP_LIMIT plans
+    are scored at once. A limit of 0 turns off the warm-up.
+
+    @param plan: The plan that was edited.
+    """
+    if getattr(settings, 'SCORE_WARMUP_LIMIT', 0) <= 0:
+        return
+
+    try:
+        if ScoreWarmup.request(plan):
+            warm_scores.apply_async(args=[plan.id], countdown=getattr(settings, 'SCORE_WARMUP_DELAY', 10))
+    except Exception, ex:
+        logger.warn('Could not schedule the score warm-up for plan %d.', plan.id)
+        logger.debug('Reason: %s', ex)
+
+@task
+def warm_scores(plan_id):
+    """
+    Asynchronously compute the scores displayed for the latest version 
+    of a plan. If the plan was edited recently, or too many plans are 
+    being scored, the task is run again later.
+
+    @param plan_id: The plan to score
+    @return: The number of score functions computed, or None if the 
+        scores were not computed
+    """
+    delay = getattr(settings, 'SCORE_WARMUP_DELAY', 10)
+    try:
+        warmup = ScoreWarmup.objects.get(plan__id=plan_id)
+    except ScoreWarmup.DoesNotExist:
+        return None
+
+    # Wait until the plan has not been edited for the delay
+    quiet = datetime.now() - warmup.requested
+    if quiet < timedelta(seconds=delay):
+        warm_scores.apply_async(args=[plan_id], countdown=max(1, delay - quiet.seconds))
+        return None
+
+    if not warmup.start(getattr(settings, 'SCORE_WARMUP_LIMIT', 0)):
+        warm_scores.apply_async(args=[plan_id], countdown=delay)
+        return None
+
+    count = None
+    try:
+        count = warmup.plan.warm_scores()
+        logger.debug('Computed %d score functions for plan %d.', count, plan_id)
+    except Exception, ex:
+        logger.warn('Could not compute the scores of plan %d.', plan_id)
+        logger.debug('Reason: %s', ex)
+
+    if warmup.finish():
+        warm_scores.apply_async(args=[plan_id], countdown=delay)
+
+    return count
+
+def schedule_leaderboard_build(panel):
+    """
+    Fill a leaderboard panel with the scores of every valid plan in the
+    background, if it has not been filled yet.
+
+    @param panel: The leaderboard ScorePanel that is being read.
+    """
+    try:
+        if LeaderboardBuild.request(panel):
+            build_leaderboard.delay(panel.id)
+    except Exception, ex:
+        logger.warn('Could not schedule the leaderboard build of panel %d.', panel.id)
+        logger.debug('Reason: %s', ex)
+
+@task
+def build_leaderboard(panel_id):
+    """
+    Asynchronously score every valid plan in a leaderboard panel.
+
+    @param panel_id: The leaderboard panel to build
+    @return: True if the panel was built
+    """
+    try:
+        panel = ScorePanel.objects.get(id=panel_id)
+    except ScorePanel.DoesNotExist:
+        return False
+
+    built = False
+    try:
+        count = LeaderboardScore.build(panel)
+        logger.debug('Scored %d plans in leaderboard panel %d.', count, panel_id)
+        built = True
+    except Exception, ex:
+        logger.warn('Could not build the leaderboard panel %d.', panel_id)
+        logger.debug('Reason: %s', ex)
+
+    if built:
+        LeaderboardBuild.finish(panel)
+    else:
+        # Build the panel again the next time it is read
+        LeaderboardBuild.objects.filter(panel=panel).delete()
+
+    return built
+
 #
 # Validation tasks
 #
@@ -1264,21 +1775,11 @@ def validate_plan(plan_id):
         logger.debug('Reason:', ex)
         return False
 
-    criterion = ValidationCriteria.objects.filter(legislative_body=plan.legislative_body)
-    is_valid = True 
-    for criteria in criterion:
-        score = None
-        try: 
-            score = ComputedPlanScore.compute(criteria.function, plan)
-        except Exception, ex:
-            logger.debug(traceback.format_exc())
-
-        if not score or not score['value']:
-            is_valid = False
-            break
+    is_valid = ValidationCriteria.validate(plan) is None
 
     plan.is_valid = is_valid
     plan.save()
+    LeaderboardScore.refresh(plan)
 
     return is_valid
 
@@ -1720,9 +2221,13 @@ def create_views_and_styles(upload_id, language=None):
             into the specified language (if message files are complete).
     """
 
-    # Configure ALL views. This will replace view definitions with identical
-    # view defintions as well as create the new view definitions.
-    configure_views()
+    upload = SubjectUpload.objects.get(id=upload_id)
+    subject = Subject.objects.get(name=upload.subject_name)
+
+    # Configure the views of the uploaded subject. This creates the new
+    # view definitions, or rebuilds the choropleth tables with the
+    # uploaded values.
+    configure_views(subjects=[subject])
 
     logger.debug('Created spatial views for subject data values.')
 
@@ -1736,9 +2241,6 @@ def create_views_and_styles(upload_id, language=None):
         'styles':settings.SLD_ROOT
     })
 
-    upload = SubjectUpload.objects.get(id=upload_id)
-    subject = Subject.objects.get(name=upload.subject_name)
-
     for geolevel in Geolevel.objects.all():
         if geolevel.legislativelevel_set.all().count() == 0:
             # Skip 'abstract' geolevels if regions are configured
@@ -1806,6 +2308,7 @@ def clean_quarantined(upload_id, language=None):
 
     try:
         Plan.objects.all().update(is_valid=False)
+        LeaderboardScore.objects.all().delete()
     except Exception, ex:
         logger.warn('Could not reset the is_valid flag on all plans.')
 
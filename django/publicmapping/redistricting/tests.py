@@ -27,10 +27,11 @@ Author:
 """
 
 import os, zipfile
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 import unittest
 from math import sin,cos
 from django.contrib.gis.db.models import Union
+from django.db import transaction
 from django.db.models import Sum, Min, Max
 from django.test.client import Client
 from django.contrib.gis.geos import *
@@ -38,21 +39,31 @@ from django.contrib.auth.models import User
 from django.utils import simplejson as json
 from lxml import etree
 from models import *
+from models import _threaded_map
 from tasks import *
 from calculators import *
 from reportcalculators import *
+from adjacency import SparseCostStore, RedisCostStore
+from vectortile import TileEncoder, tile_bounds, tile_path, read_tile, write_tile, clear_tiles, _zigzag
+from geojsonstream import WKBReader, stream_features
+from plancache import SizedLocMemCache
+from printmap import TileCache, fetch_tiles, parse_sld, draw_districts
 from config import *
 from redisutils import key_gen
+import redis
 from django.conf import settings
-from datetime import datetime
+from datetime import datetime, timedelta
 from tagging.models import Tag, TaggedItem
 import itertools
 import tempfile
+import shutil
+import threading
+import BaseHTTPServer
 
 from django.conf import settings
 
 
-class BaseTestCase(TestCase):
+class BaseTestSetup(object):
     """
     Only contains setUp and tearDown, which are shared among all other TestCases
     """
@@ -92,6 +103,12 @@ class BaseTestCase(TestCase):
         self.password = None
         self.user = None
 
+class BaseTestCase(BaseTestSetup, TestCase):
+    """
+    The base of the TestCases that run each test in a transaction.
+    """
+    pass
+
 @unittest.skipIf(settings.KEY_VALUE_STORE == '', 'Redis is not configured in settings.')
 class AdjacencyTestCase(BaseTestCase):
     """
@@ -159,6 +176,327 @@ class AdjacencyTestCase(BaseTestCase):
         self.assertAlmostEqual(0.29712390062, adj.result['value'], 9,
                                'Adjacency score for plan was incorrect %f' % adj.result['value'])
 
+    def testAdjacencyCarried(self):
+        store = RedisCostStore(db=15)
+        self.district1.get_adjacency(store)
+        self.district2.get_adjacency(store)
+
+        adjacency = settings.ADJACENCY
+        redis_db = settings.KEY_VALUE_STORE['DB']
+        settings.ADJACENCY = True
+        settings.KEY_VALUE_STORE['DB'] = 15
+        try:
+            # Move part of district 2 into district 1
+            geolevel = Geolevel.objects.get(name='middle level')
+            geounits = list(Geounit.objects.filter(geolevel = geolevel).order_by('id'))
+            moved = map(lambda x: str(x.id), geounits[18:21])
+            self.plan.add_geounits(self.district1.district_id, moved, geolevel.id, self.plan.version)
+        finally:
+            settings.ADJACENCY = adjacency
+            settings.KEY_VALUE_STORE['DB'] = redis_db
+
+        for district in (self.district1, self.district2,):
+            latest = max(District.objects.filter(plan=self.plan,district_id=district.district_id),
+                         key=lambda d: d.version)
+            carried = DistrictAdjacency.objects.get(district=latest)
+            (total, count,) = store.pair_sum([pid for (gid, pid) in latest.get_base_geounits()])
+            self.assertAlmostEqual(total, carried.cost_sum, 9, 
+                'Carried cost sum was incorrect. (e:%f,a:%f)' % (total, carried.cost_sum))
+            self.assertEqual(count, carried.pair_count,
+                'Carried pair count was incorrect. (e:%d,a:%d)' % (count, carried.pair_count))
+
+
+class SparseCostStoreTestCase(unittest.TestCase):
+    """
+    Unit tests for the sparse cost store used by the adjacency calculator
+    """
+    def setUp(self):
+        self.costs = {}
+        self.ids = ['%03d' % i for i in range(20)]
+        self.adjfile = tempfile.NamedTemporaryFile(delete=False)
+        for (i, (a, b,),) in enumerate(itertools.combinations(self.ids, 2)):
+            if i % 3 == 0:
+                continue
+            cost = float(i % 7)
+            self.costs[(a, b,)] = cost
+            # Write some of the pairs in reverse order
+            if i % 2 == 0:
+                self.adjfile.write('%s\t%s\t%f\n' % (a, b, cost))
+            else:
+                self.adjfile.write('%s\t%s\t%f\n' % (b, a, cost))
+        self.adjfile.close()
+        self.storedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.remove(self.adjfile.name)
+        for name in os.listdir(self.storedir):
+            os.remove(os.path.join(self.storedir, name))
+        os.rmdir(self.storedir)
+
+    def test_pair_sum(self):
+        store = SparseCostStore.build([(self.adjfile.name, 'default',)])
+        store.save(self.storedir)
+        store = SparseCostStore.load(self.storedir)
+
+        subset = self.ids[2:9] + self.ids[14:17] + ['unknown']
+        expected = sum([self.costs.get(pair, 0) for pair in itertools.combinations(sorted(subset), 2)])
+        (total, count,) = store.pair_sum(subset)
+
+        self.assertAlmostEqual(expected, total, 9, 'Sum of costs was incorrect. (e:%f,a:%f)' % (expected, total))
+        self.assertEqual(55, count, 'Number of pairs was incorrect. (e:55,a:%d)' % count)
+
+        others = self.ids[10:13]
+        expected = sum([self.costs.get(tuple(sorted(pair)), 0) for pair in itertools.product(subset, others)])
+        total = store.cross_sum(subset, others)
+        self.assertAlmostEqual(expected, total, 9, 'Sum of cross costs was incorrect. (e:%f,a:%f)' % (expected, total))
+
+        expected = sum(self.costs.values()) / len(self.costs)
+        self.assertAlmostEqual(expected, store.region_cost('default'), 9, 'Region cost was incorrect.')
+        self.assertEqual(None, store.region_cost('nowhere'), 'Unknown region should not have a cost.')
+
+
+class CalculatorRenderTestCase(unittest.TestCase):
+    """
+    Unit tests for the rendering helpers shared by the calculators
+    """
+    def test_render_value(self):
+        values = [0, 1, -1, 0.125, -1.005, 1234567.891, Decimal('2.5'), Decimal('-0.004'), 
+            1e20, float('nan'), 'n/a', '<b>', None, True]
+        for value in values:
+            c = Context({'value': value})
+            expected = Template('{{ value }}').render(c)
+            self.assertEqual(expected, render_value(value), 'Value rendered incorrectly. e:%s, a:%s' % (expected, render_value(value)))
+            for places in (0, 2, -1):
+                expected = Template('{{ value|floatformat:%d }}' % places).render(c)
+                actual = render_value(value, places)
+                self.assertEqual(expected, actual, 'Formatted value rendered incorrectly. e:%s, a:%s' % (expected, actual))
+
+    def test_get_template(self):
+        self.assertTrue(get_template('{{ result.value }}') is get_template('{{ result.value }}'), 'Template was compiled twice.')
+
+
+class VectorTileTestCase(unittest.TestCase):
+    """
+    Unit tests for the vector tile encoder and tile cache
+    """
+    def test_tile_bounds(self):
+        shift = 20037508.342789244
+        self.assertEqual((-shift, -shift, shift, shift,), tile_bounds(0, 0, 0), 'The bounds of the world tile were incorrect.')
+        (xmin, ymin, xmax, ymax,) = tile_bounds(1, 1, 0)
+        self.assertEqual((0, 0, shift, shift,), (xmin, ymin, xmax, ymax,), 'The bounds of the northeast tile were incorrect.')
+        self.assertEqual(None, tile_bounds(1, 2, 0), 'A tile outside the world had bounds.')
+
+    def test_encode_polygons(self):
+        encoder = TileEncoder((0, 0, 4096, 4096,))
+
+        # A counterclockwise square with a counterclockwise hole, in map coordinates
+        square = Polygon(((0, 0), (100, 0), (100, 100), (0, 100), (0, 0)), ((10, 10), (20, 10), (20, 20), (10, 20), (10, 10)))
+        commands = encoder.encode_polygons(MultiPolygon(square))
+
+        # MoveTo, LineTo x3, ClosePath for each ring
+        self.assertEqual(2 * (1 + 2 + 1 + 6 + 1), len(commands), 'The number of commands was incorrect: %s' % commands)
+        self.assertEqual([9, 0, 7992, 26], commands[0:4], 'The exterior ring did not start correctly: %s' % commands)
+        self.assertEqual(15, commands[10], 'The exterior ring was not closed: %s' % commands)
+
+        # Exterior rings are clockwise in tile coordinates, and holes are not
+        def decode_ring(start, cursor):
+            points = []
+            (x, y,) = cursor
+            for i in (start + 1, start + 4, start + 6, start + 8,):
+                x += (commands[i] >> 1) ^ -(commands[i] & 1)
+                y += (commands[i + 1] >> 1) ^ -(commands[i + 1] & 1)
+                points.append((x, y,))
+            area = sum(points[i - 1][0] * points[i][1] - points[i][0] * points[i - 1][1] for i in range(len(points)))
+            return (points, area,)
+
+        (exterior, area,) = decode_ring(0, (0, 0,))
+        self.assertTrue(area > 0, 'The exterior ring was not clockwise: %s' % exterior)
+        (interior, area,) = decode_ring(11, exterior[-1])
+        self.assertTrue(area < 0, 'The interior ring was not counterclockwise: %s' % interior)
+
+        # A polygon too small to see is left out
+        self.assertEqual([], encoder.encode_polygons(Polygon(((0, 0), (0.1, 0), (0.1, 0.1), (0, 0)))), 'An empty polygon was encoded.')
+        encoder.add_layer('districts', [(1, square, {'name': u'District 1', 'number': '10', 'is_locked': False, 'skip': None})])
+        self.assertTrue(len(encoder.tile) > 0, 'The tile was empty.')
+
+    def test_zigzag(self):
+        # Small numbers of either sign encode small
+        self.assertEqual([0, 1, 2, 3, 4], [_zigzag(v) for v in (0, -1, 1, -2, 2,)], 'The small numbers were not interleaved.')
+
+        # Numbers beyond 32 bits keep their sign
+        self.assertEqual(2 ** 34 - 1, _zigzag(-2 ** 33), 'The large negative number was not encoded as a sint64.')
+        self.assertEqual(2 ** 34, _zigzag(2 ** 33), 'The large positive number was not encoded as a sint64.')
+
+    def test_tile_cache(self):
+        cachedir = tempfile.mkdtemp()
+        cache = getattr(settings, 'TILE_CACHE', None)
+        settings.TILE_CACHE = cachedir
+        try:
+            path = tile_path(1, 3, 2, 1, 0, 0, 0)
+            self.assertEqual(None, read_tile(path), 'A tile was read before it was cached.')
+            write_tile(path, 'tile')
+            self.assertEqual('tile', read_tile(path), 'The cached tile was incorrect.')
+            write_tile(tile_path(1, 2, 2, 1, 0, 0, 0), 'older')
+
+            # Later versions are cleared, earlier versions are kept
+            clear_tiles(1, 3)
+            self.assertEqual(None, read_tile(path), 'The tile of the version was not cleared.')
+            self.assertEqual('older', read_tile(tile_path(1, 2, 2, 1, 0, 0, 0)), 'The tile of an earlier version was cleared.')
+
+            # All the tiles of a deleted plan are cleared
+            clear_tiles(1)
+            self.assertFalse(os.path.exists(os.path.join(cachedir, '1')), 'The tiles of the plan were not cleared.')
+        finally:
+            if cache is None:
+                del settings.TILE_CACHE
+            else:
+                settings.TILE_CACHE = cache
+            shutil.rmtree(cachedir)
+
+
+class GeoJSONStreamTestCase(unittest.TestCase):
+    """
+    Unit tests for the streaming GeoJSON writer
+    """
+    def test_geometry(self):
+        square = Polygon(((0, 0), (100.25, 0), (100.25, 100), (0, 100), (0, 0)), ((10, 10), (20, 10), (20, 20), (10, 20), (10, 10)))
+        geometries = [square, MultiPolygon(square, Polygon(((200, 200), (300, 200), (300, 300), (200, 200)))),
+            Point(1.5, -2.5), LineString((0, 0), (1, 1)), GeometryCollection(Point(0, 0), square)]
+
+        reader = WKBReader()
+        for geometry in geometries:
+            expected = json.loads(geometry.json)
+            self.assertEqual(expected, json.loads(reader.geometry(geometry.wkb)), 'The %s was written incorrectly.' % geometry.geom_type)
+            self.assertEqual(expected, json.loads(reader.geometry(geometry.hexewkb)), 'The hex encoded %s was written incorrectly.' % geometry.geom_type)
+
+        # Rounding keeps the rings closed, and removes repeated points
+        geometry = json.loads(WKBReader(-2).geometry(square.wkb))
+        self.assertEqual([[0, 0], [100, 0], [100, 100], [0, 100], [0, 0]], geometry['coordinates'][0], 'The exterior was rounded incorrectly.')
+        self.assertEqual(5, len(geometry['coordinates'][1]), 'The rounded hole was not kept as a ring.')
+
+    def test_stream_features(self):
+        features = [(1, Point(1, 2).wkb, {'name': 'one'},), ('_2', None, {},)]
+        collection = json.loads(''.join(stream_features(features, members={'message': 'ok'})))
+
+        self.assertEqual('FeatureCollection', collection['type'], 'The feature collection type was incorrect.')
+        self.assertEqual('ok', collection['message'], 'The feature collection message was incorrect.')
+        self.assertEqual([1, '_2'], [f['id'] for f in collection['features']], 'The feature ids were incorrect.')
+        self.assertEqual({'type': 'Point', 'coordinates': [1, 2]}, collection['features'][0]['geometry'], 'The geometry was incorrect.')
+        self.assertEqual(None, collection['features'][1]['geometry'], 'The missing geometry was not null.')
+
+
+class PrintTileTestCase(unittest.TestCase):
+    """
+    Unit tests for fetching and caching the tiles of printed maps, from a
+    local stand-in tile server
+    """
+    def setUp(self):
+        self.requests = []
+        requests = self.requests
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                if self.path.startswith('/missing'):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.end_headers()
+                self.wfile.write('tile %s' % self.path)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_fetch_tiles(self):
+        cache = TileCache(self.directory, 0)
+        urls = ['%s/1/%d/0.png' % (self.url, x) for x in range(6)] + ['%s/missing.png' % self.url]
+
+        tiles = fetch_tiles(urls, cache, threads=3)
+        self.assertEqual(len(urls), len(tiles), 'Not every tile was fetched.')
+        self.assertEqual('tile /1/2/0.png', tiles[urls[2]], 'The tile data was incorrect.')
+        self.assertEqual(None, tiles[urls[-1]], 'The missing tile was not left blank.')
+
+        # The second print is drawn from the cache; missing tiles are requested again
+        count = len(self.requests)
+        tiles = fetch_tiles(urls, cache, threads=3)
+        self.assertEqual('tile /1/2/0.png', tiles[urls[2]], 'The cached tile data was incorrect.')
+        self.assertEqual(['/missing.png'] * 2, self.requests[count:], 'Cached tiles were requested again.')
+
+        # Tiles may be fetched together with a cache for each URL
+        other = '%s/2/0/0.png' % self.url
+        count = len(self.requests)
+        tiles = fetch_tiles({ urls[2]: cache, other: None }, threads=3)
+        self.assertEqual('tile /2/0/0.png', tiles[other], 'The uncached tile data was incorrect.')
+        self.assertEqual(['/2/0/0.png'], self.requests[count:], 'The cached tile was requested again.')
+
+    def test_trim_cache(self):
+        cache = TileCache(self.directory, 20)
+        for i in range(3):
+            cache.put('tile%d' % i, '0123456789')
+            os.utime(cache.path('tile%d' % i), (1000 + i, 1000 + i,))
+
+        # Reading a tile makes it the most recently used
+        self.assertEqual('0123456789', cache.get('tile0'), 'The tile was not cached.')
+        self.assertEqual(1, cache.trim(), 'The cache was not trimmed to its size.')
+        self.assertEqual(None, cache.get('tile1'), 'The least recently used tile was kept.')
+        self.assertNotEqual(None, cache.get('tile0'), 'A recently used tile was removed.')
+        self.assertNotEqual(None, cache.get('tile2'), 'A recently used tile was removed.')
+
+        # The size is counted as tiles are cached, so the cache is only
+        # walked again once it is too large
+        extra = os.path.join(self.directory, 'extra')
+        f = open(extra, 'wb')
+        f.write('0123456789')
+        f.close()
+        os.utime(extra, (500, 500,))
+        self.assertEqual(0, cache.trim(), 'The cache was walked before it was too large.')
+        cache.put('tile3', '0123456789')
+        self.assertNotEqual(0, cache.trim(), 'The cache was not trimmed to its size.')
+        self.assertFalse(os.path.exists(extra), 'The least recently used tile was kept.')
+
+    def test_draw_districts(self):
+        sld = """<sld:StyledLayerDescriptor xmlns:sld="http://www.opengis.net/sld" xmlns:ogc="http://www.opengis.net/ogc">
+<sld:NamedLayer><sld:Name>simple_district</sld:Name><sld:UserStyle><sld:FeatureTypeStyle>
+<sld:Rule><ogc:Filter><ogc:Or>
+<ogc:PropertyIsEqualTo><ogc:PropertyName>id</ogc:PropertyName><ogc:Literal>7</ogc:Literal></ogc:PropertyIsEqualTo>
+<ogc:PropertyIsEqualTo><ogc:PropertyName>id</ogc:PropertyName><ogc:Literal>8</ogc:Literal></ogc:PropertyIsEqualTo>
+</ogc:Or></ogc:Filter>
+<sld:PolygonSymbolizer><sld:Fill><sld:CssParameter name="fill">#ff0000</sld:CssParameter></sld:Fill>
+<sld:Stroke><sld:CssParameter name="stroke">#00f</sld:CssParameter><sld:CssParameter name="stroke-width">2</sld:CssParameter></sld:Stroke></sld:PolygonSymbolizer>
+</sld:Rule>
+<sld:Rule><ogc:Filter><ogc:PropertyIsEqualTo><ogc:PropertyName>id</ogc:PropertyName><ogc:Literal>7</ogc:Literal></ogc:PropertyIsEqualTo></ogc:Filter>
+<sld:TextSymbolizer><sld:Label>1</sld:Label><sld:Font><sld:CssParameter name="font-size">10</sld:CssParameter></sld:Font></sld:TextSymbolizer>
+</sld:Rule>
+</sld:FeatureTypeStyle></sld:UserStyle></sld:NamedLayer></sld:StyledLayerDescriptor>"""
+        rules = parse_sld(sld)
+        self.assertEqual(2, len(rules), 'The rules were not read.')
+        self.assertEqual(set([7, 8]), rules[0]['ids'], 'The districts of the rule were not read.')
+        self.assertEqual((255, 0, 0,), rules[0]['fill'], 'The fill color was not read.')
+        self.assertEqual((0, 0, 255,), rules[0]['stroke'], 'The stroke color was not read.')
+        self.assertEqual('1', rules[1]['label'], 'The label was not read.')
+
+        # A square with a hole, drawn on a 100 pixel map
+        square = Polygon(((0, 0), (100, 0), (100, 100), (0, 100), (0, 0)), ((40, 40), (60, 40), (60, 60), (40, 60), (40, 40)))
+        img = draw_districts([(7, MultiPolygon(square), None,)], rules[0:1], (0, 0, 200, 200,), (100, 100,))
+        self.assertEqual((100, 100,), img.size, 'The image was the wrong size.')
+        self.assertEqual((255, 0, 0,), img.getpixel((10, 60)), 'The district was not filled.')
+        self.assertEqual((255, 255, 255,), img.getpixel((25, 75)), 'The hole was filled.')
+        self.assertEqual((255, 255, 255,), img.getpixel((80, 20)), 'Outside the district was filled.')
+        self.assertEqual((0, 0, 255,), img.getpixel((50, 75)), 'The district was not outlined.')
+
 
 class ScoringTestCase(BaseTestCase):
     """
@@ -476,6 +814,43 @@ class ScoringTestCase(BaseTestCase):
         score = planSumFunction2.score(self.plan)
         self.assertEqual(36, score['value'], 'planSumFunction was incorrect: %d' % score['value'])
         
+    def testValidationCriteria(self):
+        """
+        Test validating a plan, reusing the district inputs of districts
+        that did not change.
+        """
+        contiguousFunction = ScoreFunction(calculator='redistricting.calculators.AllContiguous', name='AllContiguousFn', is_planscore=True)
+        contiguousFunction.save()
+        countFunction = ScoreFunction(calculator='redistricting.calculators.CountDistricts', name='CountDistrictsFn', is_planscore=True)
+        countFunction.save()
+        ScoreArgument(function=countFunction, argument='target', value='3', type='literal').save()
+
+        contiguous = ValidationCriteria(name='AllContiguousCriteria', function=contiguousFunction, legislative_body=self.legbod)
+        contiguous.save()
+        count = ValidationCriteria(name='CountDistrictsCriteria', function=countFunction, legislative_body=self.legbod)
+        count.save()
+
+        # The plan has two districts, so the count criteria fails
+        failed = ValidationCriteria.validate(self.plan)
+        self.assertEqual(count.id, failed.id, 'The wrong criteria failed: %s' % failed)
+        self.assertTrue(ComputedPlanScore.compute(contiguousFunction, self.plan)['value'], 'The plan was not contiguous.')
+
+        contiguous = ValidationCriteria.objects.get(id=contiguous.id)
+        self.assertEqual(1, contiguous.checks, 'The duration of the criteria was not recorded.')
+
+        districts = self.plan.get_districts_at_version(self.plan.version, include_geom=False)
+        inputs = ValidationInput.objects.filter(function=contiguousFunction)
+        self.assertEqual(len(districts), inputs.count(), 'The district inputs were not stored.')
+
+        # Only the changed districts are evaluated again
+        geolevel = Geolevel.objects.get(name='middle level')
+        geounit = Geounit.objects.filter(geolevel=geolevel).order_by('id')[3]
+        self.plan.add_geounits(self.district1.district_id, [str(geounit.id)], geolevel.id, self.plan.version)
+
+        ScoreArgument.objects.filter(function=countFunction).update(value='2')
+        self.assertEqual(None, ValidationCriteria.validate(self.plan), 'The plan was not valid.')
+        self.assertEqual(len(districts) + 2, inputs.count(), 'The unchanged district inputs were not reused.')
+
 
 class PlanTestCase(BaseTestCase):
     """
@@ -588,6 +963,197 @@ class PlanTestCase(BaseTestCase):
         numunitscopy = len(Plan.objects.get(pk=copyplan.id).get_base_geounits(0.1))
         self.assertEqual(numunits, numunitscopy, 'Geounits between original and copy are different')
         
+    def test_plan_response_cache(self):
+        """
+        Test the caching of the responses of the views that read a plan.
+        """
+        client = Client()
+        client.login(username=self.username, password=self.password)
+        url = '/districtmapping/plan/%d/districts/' % self.plan.id
+
+        response = client.get(url, { 'version': self.plan.version })
+        self.assertEqual(200, response.status_code, 'The districts were not returned:' + str(response))
+        etag = response['ETag']
+
+        # The same version is not sent again
+        response = client.get(url, { 'version': self.plan.version }, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code, 'The unchanged districts were sent again:' + str(response))
+
+        # Editing the plan changes the response
+        geounitids = [str(self.geounits[self.geolevel.id][0].id)]
+        self.plan.add_geounits(self.district1.district_id, geounitids, self.geolevel.id, self.plan.version)
+        response = client.get(url, { 'version': self.plan.version }, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code, 'The edited districts were not returned:' + str(response))
+        self.assertNotEqual(etag, response['ETag'], 'The ETag did not change after an edit.')
+
+        # The cached responses are limited by their size
+        cache = SizedLocMemCache('test-sized', { 'OPTIONS': { 'MAX_BYTES': 1000 } })
+        for key in ('a', 'b', 'c',):
+            cache.set(key, 'x' * 400)
+        self.assertTrue(cache._size() <= 1000, 'The cache held more than its size.')
+        self.assertEqual('x' * 400, cache.get('c'), 'The newest response was not cached.')
+        cache.set('d', 'x' * 2000)
+        self.assertEqual(None, cache.get('d'), 'A response larger than the cache was cached.')
+        cache.clear()
+
+    def test_print_jobs(self):
+        """
+        Test the ids and status of background print jobs.
+        """
+        params = { 'bbox': '0,0,100,100', 'geography_url': 'http://localhost/wms', 'geography_lyr': 'demo',
+            'district_url': 'http://localhost/wms', 'district_lyr': 'simple_district', 'legend': '{}' }
+        job_id = PlanPrint.get_job_id(self.plan, params)
+        self.assertEqual(job_id, PlanPrint.get_job_id(self.plan, dict(params)), 'The same print had another id.')
+        self.assertNotEqual(job_id, PlanPrint.get_job_id(self.plan, dict(params, bbox='0,0,50,50')), 'Another extent had the same id.')
+        self.assertEqual(None, PlanPrint.get_params({'bbox': params['bbox']}), 'A print without layers was allowed.')
+
+        # Saving the plan changes the print, even at the same version
+        self.plan.name = 'Renamed plan'
+        self.plan.save()
+        self.assertNotEqual(job_id, PlanPrint.get_job_id(self.plan, params), 'A renamed plan had the same id.')
+        job_id = PlanPrint.get_job_id(self.plan, params)
+
+        basename = PlanPrint.get_file_name(job_id)
+        try:
+            self.assertEqual('free', PlanPrint.checkprint(job_id), 'A new print was not free.')
+            PlanPrint.markpending(job_id)
+            self.assertEqual('busy', PlanPrint.checkprint(job_id), 'A pending print was not busy.')
+
+            # A print that has been pending too long may be started again
+            os.utime(basename + '.pending', (0, 0,))
+            self.assertEqual('free', PlanPrint.checkprint(job_id), 'A stale print was still busy.')
+
+            pdf = open(basename + '.pdf', 'w')
+            pdf.write('%PDF')
+            pdf.close()
+
+            client = Client()
+            client.login(username=self.username, password=self.password)
+            url = '/districtmapping/plan/%d/printstatus/' % self.plan.id
+            status = json.loads(client.get(url, { 'job': job_id }).content)
+            self.assertEqual('ready', status['status'], 'The finished print was not ready.')
+            self.assertEqual(PlanPrint.getprint(job_id), status['url'], 'The address of the print was incorrect.')
+
+            # Only the prints of the plan are checked
+            status = json.loads(client.get(url, { 'job': '../%s' % job_id }).content)
+            self.assertFalse(status['success'], 'An invalid print id was checked.')
+
+            # A finished print is not waited on, and is removed when it is old
+            self.assertEqual('ready', PlanPrint.waitprint(job_id), 'The finished print was not ready.')
+            PlanPrint.cleanup(3600)
+            self.assertTrue(os.path.exists(basename + '.pdf'), 'A new print was removed.')
+            os.utime(basename + '.pdf', (0, 0,))
+            PlanPrint.cleanup(3600)
+            self.assertFalse(os.path.exists(basename + '.pdf'), 'An old print was kept.')
+        finally:
+            for extension in ('.pdf', '.pending',):
+                if os.path.exists(basename + extension):
+                    os.remove(basename + extension)
+
+    def test_unlocked_geounits(self):
+        """
+        Test selecting the geounits that are not in locked districts.
+        """
+        geounits = self.geounits[self.geolevel.id]
+        geounitids = [str(g.id) for g in geounits[0:3]]
+        self.plan.add_geounits(self.district1.district_id, geounitids, self.geolevel.id, self.plan.version)
+
+        selection = Polygon.from_bbox(self.geolevel.geounit_set.all().extent())
+        selection.srid = 3785
+        unlocked = list(self.plan.get_unlocked_geounits(self.plan.version, self.geolevel.id, selection))
+        self.assertEqual(len(geounits), len(unlocked), 'The unlocked geounits were incorrect. (e:%d, a:%d)' % (len(geounits), len(unlocked)))
+
+        district1 = max(District.objects.filter(plan=self.plan,district_id=self.district1.district_id),key=lambda d: d.version)
+        district1.is_locked = True
+        district1.save()
+
+        unlocked = [row[0] for row in self.plan.get_unlocked_geounits(self.plan.version, self.geolevel.id, selection)]
+        self.assertEqual(len(geounits) - 3, len(unlocked), 'The locked geounits were selected. (e:%d, a:%d)' % (len(geounits) - 3, len(unlocked)))
+        self.assertFalse(any(str(id) in geounitids for id in unlocked), 'A geounit in a locked district was selected.')
+
+    def test_map_relation_tables(self):
+        """
+        Test creating a map layer as a table with a spatial index, and
+        back as a view.
+        """
+        cursor = connection.cursor()
+        sql = "SELECT rg.id, rg.name, rgg.geolevel_id, rg.simple as geom FROM redistricting_geounit rg JOIN redistricting_geounit_geolevel rgg ON rg.id = rgg.geounit_id WHERE rgg.geolevel_id = %(geolevel_id)s;"
+        expected = self.geolevel.geounit_set.all().count()
+
+        create_map_relation(cursor, 'simple_testlevel', sql, {'geolevel_id':self.geolevel.id}, materialize=True)
+        self.assertEqual('r', get_relation_kind(cursor, 'simple_testlevel'), 'The layer was not created as a table.')
+        cursor.execute("SELECT count(*) FROM pg_indexes WHERE tablename = 'simple_testlevel' AND indexdef LIKE '%%gist%%';")
+        self.assertEqual(1, cursor.fetchone()[0], 'The table has no spatial index.')
+        cursor.execute('SELECT count(*) FROM simple_testlevel;')
+        self.assertEqual(expected, cursor.fetchone()[0], 'The table has the wrong number of geounits.')
+
+        # Rebuilding the table, then creating a view in its place
+        create_map_relation(cursor, 'simple_testlevel', sql, {'geolevel_id':self.geolevel.id}, materialize=True)
+        create_map_relation(cursor, 'simple_testlevel', sql, {'geolevel_id':self.geolevel.id})
+        self.assertEqual('v', get_relation_kind(cursor, 'simple_testlevel'), 'The table was not replaced with a view.')
+        cursor.execute('SELECT count(*) FROM simple_testlevel;')
+        self.assertEqual(expected, cursor.fetchone()[0], 'The view has the wrong number of geounits.')
+
+    def test_simple_districts(self):
+        """
+        Test storing the simplified geometry of each geolevel on its own.
+        """
+        geounits = self.geounits[self.geolevel.id]
+        geounitids = [str(g.id) for g in geounits[0:3]]
+        self.plan.add_geounits(self.district1.district_id, geounitids, self.geolevel.id, self.plan.version)
+        district1 = max(District.objects.filter(plan=self.plan,district_id=self.district1.district_id),key=lambda d: d.version)
+
+        levels = self.plan.legislative_body.get_geolevels()
+        simples = SimpleDistrict.objects.filter(district=district1)
+        self.assertEqual(len(levels), simples.count(), 'There should be one simplified geometry per geolevel.')
+        for simple in simples:
+            expected = district1.simple[simple.geolevel_id - 1]
+            self.assertEqual(expected.num_coords, simple.num_coords, 'The simplified geometry was not stored.')
+            self.assertEqual(expected.extent, simple.extent, 'The bounding box was not stored.')
+
+        # A copy of the district keeps the simplified geometries
+        self.plan.update_num_members(district1, 2)
+        district1_copy = District.objects.filter(plan=self.plan,district_id=self.district1.district_id).order_by('-id')[0]
+        self.assertNotEqual(district1.id, district1_copy.id, 'The district was not copied.')
+        self.assertEqual(len(levels), SimpleDistrict.objects.filter(district=district1_copy).count(), 'The simplified geometries were not copied.')
+
+        # The empty districts are left out, using the stored geometries
+        districts = self.plan.get_districts_at_version(self.plan.version)
+        self.assertTrue(district1_copy.id in [d.id for d in districts], 'The edited district was left out.')
+        self.assertTrue(all(d.district_id == 0 or not d.geom.empty for d in self.plan.get_districts_at_version(self.plan.version, include_geom=True, filter_empty=True)), 'An empty district was returned.')
+
+    def test_plan_extent(self):
+        """
+        Test storing the extent of each plan version.
+        """
+        geounits = self.geounits[self.geolevel.id]
+        geounitids = [str(g.id) for g in geounits[0:3]]
+        self.plan.add_geounits(self.district1.district_id, geounitids, self.geolevel.id, self.plan.version)
+        first = self.plan.version
+
+        def measure(version):
+            ids = self.plan.get_district_ids_at_version(version)
+            return self.plan.district_set.filter(id__in=ids).extent(field_name='simple')
+
+        stored = PlanExtent.objects.get(plan=self.plan, version=first)
+        for (expected, actual,) in zip(measure(first), stored.extent):
+            self.assertAlmostEqual(expected, actual, 3, 'The extent was not stored when the district was saved.')
+
+        # The extent follows the units to another district
+        self.plan.add_geounits(self.district2.district_id, geounitids, self.geolevel.id, self.plan.version)
+        for (expected, actual,) in zip(measure(self.plan.version), self.plan.get_extent(self.plan.version)):
+            self.assertAlmostEqual(expected, actual, 3, 'The extent was not updated.')
+
+        # Purging the later versions removes their extents
+        self.plan.purge(after=first)
+        self.assertEqual(0, self.plan.planextent_set.filter(version__gt=first).count(), 'The extents of purged versions were kept.')
+
+        # Missing extents are measured when requested
+        self.plan.planextent_set.all().delete()
+        for (expected, actual,) in zip(measure(first), self.plan.get_extent(first)):
+            self.assertAlmostEqual(expected, actual, 3, 'The extent was not measured.')
+        self.assertTrue(self.plan.planextent_set.filter(version=first).exists(), 'The measured extent was not stored.')
+
     def test_district_locking(self):
         """
         Test the logic for locking/unlocking a district.
@@ -2211,6 +2777,51 @@ class CalculatorTestCase(BaseTestCase):
         # the circle's area -- actual ratio is 0.50014
         self.assertAlmostEquals( 0.5, parea / darea, 3, 'Roeck half-circle district was incorrect. (e:%0.6f,a:%0.6f)' % (0.5, parea / darea) )
 
+    def test_roeck3(self):
+        """
+        Test that the float enclosing circle matches the GEOS minidisk.
+        """
+        dist = 30
+        coords = []
+        for i in range(-dist,dist+1):
+            coords.append( (cos(pi*i/dist/2.0), sin(pi*i/dist/2.0),) )
+
+        calc = Roeck()
+        disk = calc.minidisk(map(lambda x: Point(x[0], x[1]), coords))
+
+        (cx, cy, r,) = enclosing_circle(coords[1:])
+
+        self.assertAlmostEquals(disk.r, r, 9, 'Enclosing circle radius was incorrect. (e:%0.9f,a:%0.9f)' % (disk.r, r))
+        self.assertAlmostEquals(disk.cx, cx, 9, 'Enclosing circle center was incorrect. (e:%0.9f,a:%0.9f)' % (disk.cx, cx))
+        self.assertAlmostEquals(disk.cy, cy, 9, 'Enclosing circle center was incorrect. (e:%0.9f,a:%0.9f)' % (disk.cy, cy))
+
+        (cx, cy, r,) = enclosing_circle([(0,0,),(4,0,),(0,3,)])
+        self.assertAlmostEquals(2.5, r, 9, 'Right triangle circle radius was incorrect. (e:2.5,a:%0.9f)' % r)
+
+    def test_district_metrics(self):
+        """
+        Test the stored geometric metrics of a district.
+        """
+        dist1ids = self.geounits[0:3] + self.geounits[9:12]
+        dist1ids = map(lambda x: str(x.id), dist1ids)
+
+        self.plan.add_geounits(self.district1.district_id, dist1ids, self.geolevel.id, self.plan.version)
+        district1 = max(District.objects.filter(plan=self.plan,district_id=self.district1.district_id),key=lambda d: d.version)
+
+        self.assertEqual(0, DistrictMetrics.objects.filter(district=district1).count(), 'Metrics were stored before they were requested.')
+
+        metrics = district1.get_metrics()
+        self.assertEqual(1, DistrictMetrics.objects.filter(district=district1).count(), 'Metrics were not stored.')
+
+        self.assertAlmostEquals(district1.geom.area, metrics.area, 6, 'District area was incorrect.')
+        self.assertAlmostEquals(district1.geom.length, metrics.perimeter, 6, 'District perimeter was incorrect.')
+        self.assertAlmostEquals(district1.geom.convex_hull.area, metrics.hull_area, 6, 'District hull area was incorrect.')
+        self.assertEqual(district1.geom.extent, metrics.extent, 'District extent was incorrect.')
+        self.assertEqual(len(district1.geom.convex_hull.coords[0]), len(metrics.get_hull()), 'District hull was incorrect.')
+
+        district1.simplify()
+        self.assertEqual(0, DistrictMetrics.objects.filter(district=district1).count(), 'Metrics were not cleared when the district changed.')
+
     def test_polsbypopper(self):
         """
         Test the Polsby-Popper measure of compactness.
@@ -2452,6 +3063,41 @@ class CalculatorTestCase(BaseTestCase):
         for override in overrides:
             override.delete()
 
+    def test_contiguity_neighbors(self):
+        self.assertEqual(3, count_components([1,2,3,4,5], [(1,2),(3,4),(4,3),(5,6)]), 'Incorrect number of components.')
+
+        base = Geolevel.objects.get(id=self.plan.legislative_body.get_base_geolevel())
+        self.assertFalse(GeounitNeighbor.is_built(base.id), 'Neighbors exist before they were computed.')
+
+        dist1ids = [self.geounits[0], self.geounits[10]]
+        dist1ids = map(lambda x: str(x.id), dist1ids)
+        self.plan.add_geounits( self.district1.district_id, dist1ids, self.geolevel.id, self.plan.version)
+        district1 = self.plan.district_set.get(district_id=self.district1.district_id,version=self.plan.version)
+
+        self.assertEqual(None, district1.count_components(), 'Components were counted without neighbors.')
+
+        count = GeounitNeighbor.build(base)
+        self.assertTrue(count > 0, 'No neighbors were computed.')
+        self.assertTrue(GeounitNeighbor.is_built(base.id), 'Neighbors do not exist after they were computed.')
+
+        # 2 geounits connected by one point
+        self.assertEqual(2, district1.count_components(allow_single_point=False), 'Geounits touching at a point are not rook neighbors.')
+        self.assertEqual(1, district1.count_components(allow_single_point=True), 'Geounits touching at a point are queen neighbors.')
+
+        cntcalc = Contiguity()
+        cntcalc.arg_dict['allow_single_point'] = ('literal','1',)
+        cntcalc.compute(district=district1)
+        self.assertEqual(1, cntcalc.result['value'], 'District is contiguous at 1 point, and single-point contiguity is true.')
+        self.assertEqual(1, cntcalc.result['components'], 'District should have one contiguous part.')
+
+        # add a disjoint geounit
+        self.plan.add_geounits( self.district1.district_id, [str(self.geounits[14].id)], self.geolevel.id, self.plan.version)
+        district1 = self.plan.district_set.get(district_id=self.district1.district_id,version=self.plan.version)
+
+        cntcalc.compute(district=district1)
+        self.assertEqual(0, cntcalc.result['value'], 'District has a disjoint geometry.')
+        self.assertEqual(2, cntcalc.result['components'], 'District should have two contiguous parts.')
+
     def test_contiguity_plan1(self):
         dist1ids = self.geounits[0:4] + self.geounits[5:9]
         dist2ids = self.geounits[9:13] + self.geounits[14:18]
@@ -2889,6 +3535,12 @@ class CalculatorTestCase(BaseTestCase):
         num_plan_splits = len(calc.result['value']['splits'])
         self.assertEqual(num_plan_splits, num_dist_splits, 'Did not find expected district splits. e:%d, a:%d' % (num_plan_splits, num_dist_splits))
 
+        # Counting all the districts at once should match counting each one
+        batch = dist_calc.compute_districts(districts[0:2])
+        self.assertEqual([result1, result2], [r['value'] for r in batch], 'Batched district splits did not match.')
+        counts = p2.count_district_splits(geolevel.id)
+        self.assertEqual(num_plan_splits, sum(counts.values()), 'Did not find expected plan district splits.')
+
     def test_convexhull_l1(self):
         """
         Test the convex hull calculator for the middle geolevel
@@ -3204,6 +3856,74 @@ class ScoreRenderTestCase(BaseTestCase):
 
         os.remove(tplfile)
 
+    def test_display_render_leaderboard(self):
+        geolevelid = self.geolevel.id
+        geounits = self.geounits
+
+        dist1ids = geounits[0:3] + geounits[9:12]
+        dist2ids = geounits[6:9] + geounits[15:18]
+        dist1ids = map(lambda x: str(x.id), dist1ids)
+        dist2ids = map(lambda x: str(x.id), dist2ids)
+        
+        self.plan.add_geounits( self.district1.district_id, dist1ids, geolevelid, self.plan.version)
+        self.plan.add_geounits( self.district2.district_id, dist2ids, geolevelid, self.plan.version)
+        self.plan.is_valid = True
+        self.plan.save()
+
+        dist1ids = geounits[3:6] + geounits[12:15]
+        dist2ids = geounits[9:12] + geounits[18:21]
+        dist1ids = map(lambda x: str(x.id), dist1ids)
+        dist2ids = map(lambda x: str(x.id), dist2ids)
+        
+        self.plan2.add_geounits( 1, dist1ids, geolevelid, self.plan2.version)
+        self.plan2.add_geounits( 1, dist2ids, geolevelid, self.plan2.version)
+        self.plan2.is_valid = True
+        self.plan2.save()
+
+        display = ScoreDisplay.objects.filter(is_page=True)[0]
+        plans = list(Plan.objects.filter(is_valid=True))
+
+        panel = display.scorepanel_set.all()[0]
+        tplfile = settings.TEMPLATE_DIRS[0] + '/' + panel.template
+        template = open(tplfile,'w')
+        template.write('{% for planscore in planscores %}{{planscore.plan.name}}:{{ planscore.score|safe }}{% endfor %}')
+        template.close()
+
+        # The leaderboard is built once, in the background, when it is first read
+        for panel in display.scorepanel_set.filter(type='plan'):
+            self.assertTrue(LeaderboardBuild.request(panel), 'The leaderboard build was not requested.')
+            self.assertFalse(LeaderboardBuild.request(panel), 'The leaderboard build was requested while running.')
+            self.assertTrue(build_leaderboard(panel.id), 'The leaderboard was not built.')
+            self.assertFalse(LeaderboardBuild.request(panel), 'The built leaderboard was requested again.')
+
+        expected = display.render(plans)
+        markup = display.render_leaderboard()
+        self.assertEqual(expected, markup, 'The leaderboard markup was incorrect. (e:"%s", a:"%s")' % (expected, markup))
+
+        for panel in display.scorepanel_set.filter(type='plan'):
+            ranks = list(LeaderboardScore.get_scores(panel).values_list('rank', flat=True))
+            self.assertEqual(range(1, len(ranks) + 1), ranks, 'The leaderboard ranks were incorrect: %s' % ranks)
+
+            leaders = list(LeaderboardScore.get_scores(panel, owner=self.user))
+            top = list(LeaderboardScore.get_scores(panel, owner=self.user, limit=1))
+            self.assertEqual([leaders[0].id], [leader.id for leader in top], 'The top leader was incorrect.')
+
+        # Editing a plan removes it from the leaderboard
+        self.plan.add_geounits( self.district1.district_id, [str(geounits[21].id)], geolevelid, self.plan.version)
+        self.assertEqual(0, LeaderboardScore.objects.filter(plan=self.plan).count(), 'The invalid plan was still on the leaderboard.')
+
+        markup = display.render_leaderboard()
+        self.assertFalse('testPlan:' in markup, 'The invalid plan was rendered. (a:"%s")' % markup)
+        self.assertTrue('testPlan2:' in markup, 'The valid plan was not rendered. (a:"%s")' % markup)
+
+        # Validating the plan again puts it back
+        self.plan.is_valid = True
+        self.plan.save()
+        LeaderboardScore.refresh(self.plan)
+        self.assertEqual(LeaderboardScore.objects.filter(plan=self.plan2).count(), LeaderboardScore.objects.filter(plan=self.plan).count(), 'The validated plan was not on the leaderboard.')
+
+        os.remove(tplfile)
+
     def test_display_render_div(self):
         geolevelid = self.geolevel.id
         geounits = self.geounits
@@ -3337,6 +4057,87 @@ class ScoreRenderTestCase(BaseTestCase):
 
         os.remove(tplfile)
 
+class ScoreRenderThreadTestCase(BaseTestSetup, TransactionTestCase):
+    """
+    Render scores in worker threads. Each worker has its own database
+    connection, which only sees committed data, so these tests commit
+    instead of running in a transaction.
+    """
+    fixtures = ScoreRenderTestCase.fixtures
+
+    def setUp(self):
+        BaseTestSetup.setUp(self)
+        self.geolevel = Geolevel.objects.get(name='middle level')
+        self.geounits = list(Geounit.objects.filter(geolevel=self.geolevel).order_by('id'))
+        self.threads = getattr(settings, 'SCORE_RENDER_THREADS', 1)
+
+    def tearDown(self):
+        settings.SCORE_RENDER_THREADS = self.threads
+        self.geolevel = None
+        self.geounits = None
+        BaseTestSetup.tearDown(self)
+
+    def test_threaded_map(self):
+        main = threading.current_thread().ident
+        def work(plan_id):
+            return (threading.current_thread().ident, Plan.objects.get(id=plan_id).name,)
+
+        plan_ids = [self.plan.id, self.plan2.id] * 3
+        settings.SCORE_RENDER_THREADS = 3
+        self.assertFalse(transaction.is_dirty(), 'The test data was not committed.')
+        results = _threaded_map(work, plan_ids)
+
+        idents = set(ident for (ident, name,) in results)
+        self.assertFalse(main in idents, 'The items were mapped in the calling thread.')
+        self.assertEqual([Plan.objects.get(id=i).name for i in plan_ids], [name for (ident, name,) in results],
+            'The results were out of order: %s' % results)
+
+        # The order of the items is kept
+        self.assertEqual(range(0, 20, 2), _threaded_map(lambda x: x * 2, range(10)), 'The results were out of order.')
+
+    def test_display_render_threads(self):
+        geolevelid = self.geolevel.id
+        geounits = self.geounits
+
+        dist1ids = map(lambda x: str(x.id), geounits[0:3] + geounits[9:12])
+        dist2ids = map(lambda x: str(x.id), geounits[6:9] + geounits[15:18])
+        self.plan.add_geounits( self.district1.district_id, dist1ids, geolevelid, self.plan.version)
+        self.plan.add_geounits( self.district2.district_id, dist2ids, geolevelid, self.plan.version)
+
+        display = ScoreDisplay.objects.filter(is_page=True)[0]
+        plans = list(Plan.objects.all())
+
+        panel = display.scorepanel_set.all()[0]
+        tplfile = settings.TEMPLATE_DIRS[0] + '/' + panel.template
+        template = open(tplfile,'w')
+        template.write('{% for planscore in planscores %}{{planscore.plan.name}}:{{ planscore.score|safe }}{% endfor %}')
+        template.close()
+
+        # Record the threads the plan scores are computed in
+        computed = set()
+        compute = ComputedPlanScore.compute
+        def record(*args, **kwargs):
+            computed.add(threading.current_thread().ident)
+            return compute(*args, **kwargs)
+
+        try:
+            # The scores are computed in the threads first, then read from
+            # the cache in this thread
+            self.assertFalse(transaction.is_dirty(), 'The edits were not committed.')
+            settings.SCORE_RENDER_THREADS = 4
+            ComputedPlanScore.compute = staticmethod(record)
+            markup = display.render(plans)
+            ComputedPlanScore.compute = staticmethod(compute)
+            settings.SCORE_RENDER_THREADS = 1
+            expected = display.render(plans)
+        finally:
+            ComputedPlanScore.compute = staticmethod(compute)
+            os.remove(tplfile)
+
+        computed.discard(threading.current_thread().ident)
+        self.assertTrue(len(computed) > 0, 'No scores were computed in worker threads.')
+        self.assertEqual(expected, markup, 'The markup rendered in threads was incorrect. (e:"%s", a:"%s")' % (expected, markup))
+
 class ComputedScoresTestCase(BaseTestCase):
     def test_district1(self):
         geolevel = Geolevel.objects.get(name='middle level')
@@ -3382,6 +4183,114 @@ class ComputedScoresTestCase(BaseTestCase):
 
         self.assertEqual(2, numscores, 'The number of computed district scores is incorrect. (e:2, a:%d)' % numscores)
 
+    def test_district_bulk(self):
+        geolevel = Geolevel.objects.get(name='middle level')
+        geounits = list(Geounit.objects.filter(geolevel=geolevel).order_by('id'))
+
+        dist1ids = map(lambda x: str(x.id), geounits[0:3] + geounits[9:12])
+        dist2ids = map(lambda x: str(x.id), geounits[6:9] + geounits[15:18])
+        self.plan.add_geounits( self.district1.district_id, dist1ids, geolevel.id, self.plan.version)
+        self.plan.add_geounits( self.district2.district_id, dist2ids, geolevel.id, self.plan.version)
+
+        function = ScoreFunction.objects.get(calculator__endswith='SumValues',is_planscore=False)
+        districts = self.plan.get_districts_at_version(self.plan.version, include_geom=True)
+
+        # Cache one score beforehand; it should be reused
+        ComputedDistrictScore.compute(function, districts[0])
+
+        scores = ComputedDistrictScore.compute_all(function, districts)
+        numscores = ComputedDistrictScore.objects.filter(function=function).count()
+        self.assertEqual(len(districts), numscores, 'The number of computed district scores is incorrect. (e:%d, a:%d)' % (len(districts), numscores))
+
+        for district in districts:
+            expected = function.score(district)
+            self.assertEqual(expected, scores[district.id], 'The bulk score computed is incorrect for %s.' % district.long_label)
+            self.assertEqual(expected, ComputedDistrictScore.compute(function, district), 'The bulk score cached is incorrect for %s.' % district.long_label)
+
+    def test_warm_scores(self):
+        geolevel = Geolevel.objects.get(name='middle level')
+        geounits = list(Geounit.objects.filter(geolevel=geolevel).order_by('id'))
+
+        dist1ids = map(lambda x: str(x.id), geounits[0:3] + geounits[9:12])
+        self.plan.add_geounits( self.district1.district_id, dist1ids, geolevel.id, self.plan.version)
+
+        district_function = ScoreFunction.objects.get(calculator__endswith='SumValues',is_planscore=False)
+        plan_function = ScoreFunction.objects.get(calculator__endswith='SumValues',is_planscore=True)
+
+        display = ScoreDisplay(name='warm', title='Warm', legislative_body=self.plan.legislative_body, is_page=False, owner=self.plan.owner)
+        display.save()
+        for (panel_type, function,) in (('district', district_function,), ('plan', plan_function,),):
+            panel = ScorePanel(type=panel_type, position=0, title=panel_type, template='%s.html' % panel_type)
+            panel.save()
+            panel.displays.add(display)
+            panel.score_functions.add(function)
+
+        self.assertTrue(display in self.plan.get_sidebar_displays(), 'The display of the owner was not in the sidebar.')
+        self.plan.warm_scores()
+
+        districts = self.plan.get_districts_at_version(self.plan.version, include_geom=False)
+        numscores = ComputedDistrictScore.objects.filter(function=district_function, district__in=districts).count()
+        self.assertEqual(len(districts), numscores, 'The district scores were not computed. (e:%d, a:%d)' % (len(districts), numscores))
+        numscores = ComputedPlanScore.objects.filter(function=plan_function, plan=self.plan, version=self.plan.version).count()
+        self.assertEqual(1, numscores, 'The plan score was not computed. (e:1, a:%d)' % numscores)
+
+        # Only one warm-up is pending for a plan
+        self.assertTrue(ScoreWarmup.request(self.plan), 'The first edit did not request a warm-up.')
+        self.assertFalse(ScoreWarmup.request(self.plan), 'A second edit requested another warm-up.')
+        self.assertTrue(ScoreWarmup.request(self.plan2), 'The first edit of another plan did not request a warm-up.')
+
+        # The number of running warm-ups is limited
+        warmup = ScoreWarmup.objects.get(plan=self.plan)
+        self.assertTrue(warmup.start(1), 'The first warm-up did not start.')
+        self.assertFalse(ScoreWarmup.objects.get(plan=self.plan2).start(1), 'Too many warm-ups were started.')
+
+        # A plan edited during the warm-up is warmed again
+        ScoreWarmup.objects.filter(plan=self.plan).update(requested=warmup.started + timedelta(seconds=1))
+        self.assertTrue(warmup.finish(), 'The edited plan was not warmed again.')
+        ScoreWarmup.objects.filter(plan=self.plan).update(requested=datetime.now() - timedelta(minutes=1))
+        warmup = ScoreWarmup.objects.get(plan=self.plan)
+        self.assertTrue(warmup.start(1), 'The warm-up did not start again.')
+        self.assertFalse(warmup.finish(), 'The unedited plan was warmed again.')
+        self.assertEqual(0, ScoreWarmup.objects.filter(plan=self.plan).count(), 'The warm-up was not removed.')
+
+    def test_score_cache(self):
+        geolevel = Geolevel.objects.get(name='middle level')
+        geounits = list(Geounit.objects.filter(geolevel=geolevel).order_by('id'))
+
+        dist1ids = map(lambda x: str(x.id), geounits[0:3] + geounits[9:12])
+        dist2ids = map(lambda x: str(x.id), geounits[6:9] + geounits[15:18])
+        self.plan.add_geounits( self.district1.district_id, dist1ids, geolevel.id, self.plan.version)
+        self.plan.add_geounits( self.district2.district_id, dist2ids, geolevel.id, self.plan.version)
+        self.plan = Plan.objects.get(id=self.plan.id)
+
+        function = ScoreFunction.objects.get(calculator__endswith='SumValues',is_planscore=True)
+        for version in range(self.plan.min_version, self.plan.version + 1):
+            ComputedPlanScore.compute(function, self.plan, version=version)
+
+        # Lookups are counted, and saved when flushed
+        ScoreCache.flush()
+        ScoreCacheStatistic.objects.all().delete()
+        ComputedPlanScore.compute(function, self.plan)
+        ScoreCache.flush()
+        stat = ScoreCacheStatistic.objects.get(table=ComputedPlanScore._meta.db_table)
+        self.assertEqual(1, stat.hits, 'The score cache hit was not counted. (e:1, a:%d)' % stat.hits)
+        self.assertEqual(0, stat.misses, 'A score cache miss was counted. (e:0, a:%d)' % stat.misses)
+
+        # Reading an old score marks it as read
+        old = datetime.now() - timedelta(days=2)
+        ComputedPlanScore.objects.filter(plan=self.plan).update(accessed=old)
+        ComputedPlanScore.compute(function, self.plan)
+        cache = ComputedPlanScore.objects.get(function=function, plan=self.plan, version=self.plan.version)
+        self.assertTrue(cache.accessed > old, 'The cached score was not marked as read.')
+
+        # Old scores are evicted, but the scores of the latest version are kept
+        ComputedPlanScore.objects.filter(plan=self.plan).update(accessed=old)
+        removed = ScoreCache.evict(timedelta(days=1), checkpoints=1)
+        numscores = ComputedPlanScore.objects.filter(plan=self.plan).count()
+        self.assertEqual(1, numscores, 'The old plan scores were not evicted. (e:1, a:%d)' % numscores)
+        self.assertEqual(self.plan.version - self.plan.min_version, removed[ComputedPlanScore._meta.db_table], 'The number of evicted scores is incorrect.')
+        self.assertEqual(1, ComputedPlanScore.objects.filter(plan=self.plan, version=self.plan.version).count(), 'The latest plan score was evicted.')
+
     def test_plan1(self):
         geolevel = Geolevel.objects.get(name='middle level')
         geounits = list(Geounit.objects.filter(geolevel=geolevel).order_by('id'))
@@ -3420,6 +4329,32 @@ class ComputedScoresTestCase(BaseTestCase):
 
         self.assertEqual(2, numscores, 'The number of computed plan scores is incorrect. (e:2, a:%d)' % numscores)
 
+    def test_score_storage(self):
+        score = { 'value': Decimal('1.5'), 'only_total': False }
+        numeric, value = encode_score(score)
+
+        self.assertEqual(1.5, numeric, 'The numeric value is incorrect. (e:1.5, a:%s)' % numeric)
+        decoded = decode_score(value)
+        self.assertEqual(score, decoded, 'The decoded score is incorrect. (e:%s, a:%s)' % (score, decoded))
+        self.assertTrue(isinstance(decoded['value'], Decimal), 'The decoded value is not a Decimal.')
+
+        splits = { 'value': { 'splits': [(1, 2, u'a', u'b')], 'is_geolevel': True }, 'only_total': False }
+        numeric, value = encode_score(splits)
+
+        self.assertTrue(numeric is None, 'A structured score should not have a numeric value.')
+        self.assertEqual(1, len(decode_score(value)['value']['splits']), 'The decoded splits are incorrect.')
+
+        geolevel = Geolevel.objects.get(name='middle level')
+        geounits = list(Geounit.objects.filter(geolevel=geolevel).order_by('id'))
+        dist1ids = map(lambda x: str(x.id), geounits[0:3])
+        self.plan.add_geounits( self.district1.district_id, dist1ids, geolevel.id, self.plan.version)
+
+        function = ScoreFunction.objects.get(calculator__endswith='SumValues',is_planscore=True)
+        score = ComputedPlanScore.compute(function, self.plan)
+
+        cached = ComputedPlanScore.objects.filter(function=function, plan=self.plan, numeric_value=score['value'])
+        self.assertEqual(1, cached.count(), 'The numeric value was not stored for filtering.')
+
 
 class MultiMemberTestCase(BaseTestCase):
     """
@@ -4072,6 +5007,30 @@ class NestingTestCase(BaseTestCase):
         # Test contains -- shouldn't be any districts fully contained
         contains = p1.find_plan_components(p2)
         self.assertEqual(len(contains), 0, "Found contained districts when there should be none.")
+
+    def test_geolevel_splits_from_assignments(self):
+        gl, gs = self.geolevel, list(Geounit.objects.filter(geolevel=self.geolevel).order_by("id"))
+        p1, p1d1, p1d2 = self.plan, self.p1d1, self.p1d2
+
+        ids = map(lambda x: str(x.id), gs[0:2] + gs[9:12])
+        p1.add_geounits(p1d1.district_id, ids, gl.id, p1.version)
+        ids = map(lambda x: str(x.id), gs[19:21] + gs[28:30] + gs[40:41])
+        p1.add_geounits(p1d2.district_id, ids, gl.id, p1.version)
+
+        top = Geolevel.objects.get(name='biggest level')
+        for inverse in (False, True,):
+            splits = p1.find_geolevel_splits(top.id, inverse=inverse)
+            expected = p1.find_geolevel_relationships(top.id, inverse=inverse, de_9im='***T*****')
+            self.assertTrue(len(splits) > 0, "Didn't find any splits")
+            self.assertEqual([s[:2] for s in expected], [s[:2] for s in splits], 
+                "Splits from assignments didn't match splits from geometries")
+
+        # A district covering every geounit splits none of them
+        p2, p2d1 = self.plan2, self.p2d1
+        ids = map(lambda x: str(x.id), gs)
+        p2.add_geounits(p2d1.district_id, ids, gl.id, p2.version)
+        splits = p2.find_geolevel_splits(top.id)
+        self.assertEqual(len(splits), 0, "Found splits when the district covered every geounit")
         
 
 class CommunityTypeTestCase(BaseTestCase):
@@ -4186,6 +5145,40 @@ class CommunityTypeTestCase(BaseTestCase):
         calc.compute(district=d1, community_map_id=-1, version=c.version)
         self.assertEqual('n/a', calc.result['value'], 'Did\'t get "n/a" when incorrect map_id used. a:%s' % calc.result['value'])
 
+    def test_community_index(self):
+        gl, gs = self.geolevel, list(Geounit.objects.filter(geolevel=self.geolevel).order_by("id"))
+        p, c = self.plan, self.community
+
+        ids = map(lambda x: str(x.id), gs[21:24] + gs[30:33] + gs[39:42])
+        p.add_geounits(1, ids, gl.id, p.version)
+        ids = map(lambda x: str(x.id), gs[18:21] + gs[27:30] + gs[36:39])
+        p.add_geounits(2, ids, gl.id, p.version)
+
+        # C1 straddles both districts, C2 is only in d1
+        ids = map(lambda x: str(x.id), gs[29:31])
+        c.add_geounits(1, ids, gl.id, c.version)
+        c1 = max(District.objects.filter(plan=c,district_id=1),key=lambda d: d.version)
+        c1.tags = 'type=type_a'
+        ids = [str(gs[32].id)]
+        c.add_geounits(2, ids, gl.id, c.version)
+        c2 = max(District.objects.filter(plan=c,district_id=2),key=lambda d: d.version)
+        c2.tags = 'type=type_b type=type_a'
+
+        unions = p.get_community_type_unions(c.id)
+        unions = dict((k, sorted(t.name for t in v),) for (k, v,) in unions.items())
+        self.assertEqual({1: ['type=type_a', 'type=type_b'], 2: ['type=type_a']}, unions, 'Community type unions were incorrect: %s' % unions)
+
+        counts = sorted((t['type'], t['number'],) for t in c.count_community_types(c.version))
+        self.assertEqual([('type_a', 2,), ('type_b', 1,)], counts, 'Community type counts were incorrect: %s' % counts)
+
+        # The index is rebuilt when the community map changes
+        ids = [str(gs[31].id)]
+        c.add_geounits(3, ids, gl.id, c.version)
+        c3 = max(District.objects.filter(plan=c,district_id=3),key=lambda d: d.version)
+        c3.tags = 'type=type_c'
+        d1 = max(District.objects.filter(plan=p,district_id=1),key=lambda d: d.version)
+        self.assertEqual(3, d1.count_community_type_union(c.id), 'Community index was not rebuilt')
+
     def test_community_intersection(self):
         calc = CommunityTypeCompatible()
         gl, gs = self.geolevel, list(Geounit.objects.filter(geolevel=self.geolevel).order_by("id"))
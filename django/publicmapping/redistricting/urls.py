@@ -36,6 +36,8 @@ urlpatterns = patterns('publicmapping.redistricting.views',
     (r'^plan/(?P<planid>\d*)/view/$', 'viewplan'),
     (r'^plan/(?P<planid>\d*)/edit/$', 'editplan'),
     (r'^plan/(?P<planid>\d*)/print/$', 'printplan'),
+    (r'^plan/(?P<planid>\d*)/printjob/$', 'printplanjob'),
+    (r'^plan/(?P<planid>\d*)/printstatus/$', 'printplanstatus'),
     (r'^plan/(?P<planid>\d*)/getreport/$', 'getreport'),
     (r'^plan/(?P<planid>\d*)/getcalculatorreport/$', 'getcalculatorreport'),
     (r'^plan/(?P<planid>\d*)/attributes/$', 'editplanattributes'),
@@ -56,6 +58,7 @@ urlpatterns = patterns('publicmapping.redistricting.views',
     (r'^plan/(?P<planid>\d*)/combinedistricts/$', 'combine_districts'),
     (r'^plan/(?P<planid>\d*)/fixunassigned/$', 'fix_unassigned'),
     (r'^plan/(?P<planid>\d*)/district/versioned/$', 'simple_district_versioned'),
+    (r'^plan/(?P<planid>\d*)/district/tile/(?P<version>\d+)/(?P<geolevel>\d+)/(?P<subject_id>\d+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$', 'district_tile'),
     (r'^plan/(?P<planid>\d*)/unlockedgeometries/$', 'get_unlocked_simple_geometries'),
     (r'^plan/(?P<planid>\d*)/districtfile/$', 'getdistrictfile'),
     (r'^plan/(?P<planid>\d*)/districtindexfilesend/$', 'emaildistrictindexfile'),
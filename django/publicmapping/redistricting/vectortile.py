@@ -0,0 +1,375 @@
+"""
+Encode and cache vector tiles of the districts in a plan.
+
+The tiles follow the Mapbox Vector Tile specification (version 2), and
+are addressed with the z/x/y scheme of spherical mercator map tiles.
+The protocol buffers are written directly, since a tile only needs a
+handful of message types.
+
+Tiles are cached on disk, keyed on the plan, version, geolevel, and
+subject. The districts of a version do not change when the plan is
+edited, so a cached tile is only removed when a district of that
+version is changed in place (locked, renamed), or when the version is
+purged and its number reused.
+
+This file is part of The Public Mapping Project
+https://github.com/PublicMapping/
+
+License:
+    Copyright 2010-2012 Micah Altman, Michael McDonald
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+Author:
+    Andrew Jennings, David Zwarg, Kenny Shepard
+"""
+
+from django.conf import settings
+import os, shutil, struct, tempfile, logging
+
+logger = logging.getLogger(__name__)
+
+# Half the width of the spherical mercator world, in meters
+ORIGIN_SHIFT = 20037508.342789244
+
+# The number of units across a tile
+EXTENT = 4096
+
+# The number of units drawn beyond each edge of a tile, so the outlines
+# of districts do not show at the tile edges
+BUFFER = 64
+
+# The deepest zoom level that may be requested
+MAX_ZOOM = 24
+
+
+def tile_bounds(z, x, y, buffer=0):
+    """
+    Get the spherical mercator extent of a tile.
+
+    @param z: The zoom level of the tile.
+    @param x: The column of the tile, from the west.
+    @param y: The row of the tile, from the north.
+    @keyword buffer: Optional. The number of tile units to add to each
+        edge of the tile.
+    @return: A tuple of (xmin, ymin, xmax, ymax), or None if the tile is
+        not in the world.
+    """
+    if z < 0 or z > MAX_ZOOM or x < 0 or y < 0 or x >= 2 ** z or y >= 2 ** z:
+        return None
+
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    pad = size * buffer / EXTENT
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+
+    return (xmin - pad, ymax - size - pad, xmin + size + pad, ymax + pad,)
+
+
+def _varint(value):
+    """
+    Encode an unsigned integer as a protocol buffer varint.
+    """
+    out = []
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(chr(bits | 0x80))
+        else:
+            out.append(chr(bits))
+            return ''.join(out)
+
+
+def _zigzag(value):
+    """
+    Map a signed integer onto an unsigned integer, so small negative
+    numbers encode in few bytes. This is the sint64 encoding, which is
+    the same as the sint32 encoding for 32 bit values.
+    """
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field, wire_type):
+    """
+    Encode the key of a protocol buffer field.
+    """
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes(field, data):
+    """
+    Encode a length delimited protocol buffer field.
+    """
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _packed(field, values):
+    """
+    Encode a packed repeated field of unsigned integers.
+    """
+    return _bytes(field, ''.join(_varint(v) for v in values))
+
+
+def _value(value):
+    """
+    Encode a property value as a vector tile Value message.
+    """
+    if isinstance(value, bool):
+        return _key(7, 0) + _varint(int(value))
+    elif isinstance(value, (int, long,)):
+        if value >= 0:
+            return _key(5, 0) + _varint(value)
+        return _key(6, 0) + _varint(_zigzag(value))
+    elif isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    else:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return _bytes(1, str(value))
+
+
+def _ring_area(ring):
+    """
+    Get twice the signed area of a ring of tile coordinates. Since the
+    y axis points down, clockwise rings have a positive area.
+    """
+    area = 0
+    for i in range(len(ring)):
+        (x1, y1,) = ring[i - 1]
+        (x2, y2,) = ring[i]
+        area += x1 * y2 - x2 * y1
+    return area
+
+
+class TileEncoder(object):
+    """
+    Encode features into a vector tile. Each layer is added in turn, and
+    the encoded tile is read from the tile property.
+    """
+
+    def __init__(self, bounds, extent=EXTENT):
+        """
+        Create an encoder for one tile.
+
+        @param bounds: The spherical mercator extent of the tile, without
+            a buffer, as (xmin, ymin, xmax, ymax).
+        @keyword extent: Optional. The number of units across the tile.
+        """
+        self.xmin = bounds[0]
+        self.ymax = bounds[3]
+        self.scale = extent / float(bounds[2] - bounds[0])
+        self.extent = extent
+        self.layers = []
+
+    @property
+    def tile(self):
+        """
+        The encoded tile, as a string of bytes.
+        """
+        return ''.join(_bytes(3, layer) for layer in self.layers)
+
+    def add_layer(self, name, features):
+        """
+        Add a layer of polygon features to the tile. Features without
+        any area in the tile are left out.
+
+        @param name: The name of the layer.
+        @param features: A sequence of tuples of the feature id, a GEOS
+            geometry in spherical mercator, and a dict of properties.
+            Properties that are None are left out.
+        @return: The number of features encoded.
+        """
+        keys = {}
+        values = {}
+        encoded = []
+
+        def index(table, item):
+            if not item in table:
+                table[item] = len(table)
+            return table[item]
+
+        for (fid, geometry, properties,) in features:
+            commands = self.encode_polygons(geometry)
+            if len(commands) == 0:
+                continue
+
+            tags = []
+            for key in sorted(properties.keys()):
+                value = properties[key]
+                if value is None:
+                    continue
+                tags.append(index(keys, key))
+                tags.append(index(values, (type(value), value,)))
+
+            encoded.append(_key(1, 0) + _varint(fid) + _packed(2, tags) +
+                _key(3, 0) + _varint(3) + _packed(4, commands))
+
+        layer = [_key(15, 0) + _varint(2), _bytes(1, name.encode('utf-8'))]
+        layer.extend(_bytes(2, feature) for feature in encoded)
+        for key in sorted(keys, key=keys.get):
+            layer.append(_bytes(3, key.encode('utf-8')))
+        for value in sorted(values, key=values.get):
+            layer.append(_bytes(4, _value(value[1])))
+        layer.append(_key(5, 0) + _varint(self.extent))
+
+        self.layers.append(''.join(layer))
+        return len(encoded)
+
+    def project(self, coords):
+        """
+        Convert a ring of spherical mercator coordinates into tile
+        coordinates. Repeated points, and the closing point, are removed.
+
+        @param coords: A sequence of (x, y) coordinates.
+        @return: A list of (x, y) integer tuples.
+        """
+        ring = []
+        for coord in coords:
+            point = (int(round((coord[0] - self.xmin) * self.scale)),
+                int(round((self.ymax - coord[1]) * self.scale)),)
+            if len(ring) == 0 or ring[-1] != point:
+                ring.append(point)
+        if len(ring) > 1 and ring[0] == ring[-1]:
+            ring.pop()
+        return ring
+
+    def encode_polygons(self, geometry):
+        """
+        Encode the polygons in a geometry as vector tile commands. Any
+        lines or points in the geometry are left out.
+
+        @param geometry: A GEOS Polygon, MultiPolygon, or
+            GeometryCollection.
+        @return: A list of command integers.
+        """
+        commands = []
+        cursor = [0, 0]
+
+        def add_ring(ring):
+            commands.append(1 | (1 << 3))
+            for (i, (x, y,),) in enumerate(ring):
+                commands.append(_zigzag(x - cursor[0]))
+                commands.append(_zigzag(y - cursor[1]))
+                cursor[0], cursor[1] = x, y
+                if i == 0:
+                    commands.append(2 | ((len(ring) - 1) << 3))
+            commands.append(7 | (1 << 3))
+
+        def add_polygon(polygon):
+            exterior = self.project(polygon.exterior_ring.coords)
+            area = _ring_area(exterior)
+            if len(exterior) < 3 or area == 0:
+                return
+            # Exterior rings are clockwise, interior rings counterclockwise
+            if area < 0:
+                exterior.reverse()
+            add_ring(exterior)
+
+            for i in range(1, len(polygon)):
+                interior = self.project(polygon[i].coords)
+                area = _ring_area(interior)
+                if len(interior) < 3 or area == 0:
+                    continue
+                if area > 0:
+                    interior.reverse()
+                add_ring(interior)
+
+        def add_geometry(geometry):
+            if geometry.geom_type == 'Polygon':
+                add_polygon(geometry)
+            elif geometry.geom_type in ('MultiPolygon', 'GeometryCollection',):
+                for part in geometry:
+                    add_geometry(part)
+
+        add_geometry(geometry)
+        return commands
+
+
+def _cache_root():
+    """
+    Get the directory that holds the cached tiles.
+    """
+    return getattr(settings, 'TILE_CACHE', os.path.join(settings.WEB_TEMP, 'tiles'))
+
+
+def tile_path(plan_id, version, geolevel_id, subject_id, z, x, y):
+    """
+    Get the path of a cached tile.
+
+    @return: The path of the tile in the tile cache.
+    """
+    return os.path.join(_cache_root(), str(plan_id), str(version), str(geolevel_id),
+        str(subject_id), str(z), str(x), '%d.pbf' % y)
+
+
+def read_tile(path):
+    """
+    Read a cached tile.
+
+    @param path: The path of the tile in the tile cache.
+    @return: The encoded tile, or None if it is not cached.
+    """
+    try:
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+
+def write_tile(path, tile):
+    """
+    Save a tile in the tile cache. The tile is written to a temporary
+    file first, so a partial tile is never read.
+
+    @param path: The path of the tile in the tile cache.
+    @param tile: The encoded tile.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        (handle, temp,) = tempfile.mkstemp(dir=directory)
+        os.write(handle, tile)
+        os.close(handle)
+        os.rename(temp, path)
+    except (IOError, OSError), ex:
+        # Another process may have created the directory, or the cache
+        # may not be writable; the tile is simply not cached
+        logger.debug('Could not cache the tile %s: %s', path, ex)
+
+
+def clear_tiles(plan_id, version=None):
+    """
+    Remove cached tiles of a plan.
+
+    @param plan_id: The plan whose tiles are removed.
+    @keyword version: Optional. Only remove the tiles of this version
+        and later versions. If no version is given, the directory of the
+        plan is removed.
+    """
+    directory = os.path.join(_cache_root(), str(plan_id))
+    if not os.path.isdir(directory):
+        return
+
+    if version is None:
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+
+    for name in os.listdir(directory):
+        if name.isdigit() and int(name) >= version:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
@@ -50,6 +50,9 @@ from django.template import loader, Context as DjangoContext, RequestContext
 from django.utils import simplejson as json, translation
 from django.utils.translation import ugettext as _, ungettext as _n
 from django.template.defaultfilters import slugify, force_escape
+from django.core.cache import get_cache
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 from django.conf import settings
 from tagging.utils import parse_tag_input
 from tagging.models import Tag, TaggedItem
@@ -59,15 +62,10 @@ from functools import wraps
 from redistricting.calculators import *
 from redistricting.models import *
 from redistricting.tasks import *
+from redistricting.geojsonstream import stream_features, precision_for_resolution
 import random, string, math, types, copy, time, threading, traceback, os
 import commands, sys, tempfile, csv, hashlib, inflect, logging
 
-import ModestMaps
-from PIL import Image, ImageChops, ImageMath
-import urllib, urllib2
-from xhtml2pdf.pisa import CreatePDF
-import StringIO
-
 logger = logging.getLogger(__name__)
 
 # This constant is reused in multiple places.
@@ -145,6 +143,104 @@ def unique_session_or_json_redirect(function):
             return function(request, *args, **kwargs)
     return wraps(function)(decorator)
 
+def cache_plan_response(post=False, depends=None):
+    """
+    A decorator method for views that read one version of a plan. The
+    view must have a "planid" parameter.
+
+    The response of the view is cached, and given an ETag and a 
+    Last-Modified header, so conditional requests are answered with a
+    304. The cache key includes the time the plan was last saved, which 
+    changes whenever a district is edited, locked, or renamed, so the
+    versions of a plan are served from the cache while the user undoes
+    and redoes. Responses are stored in the cache named by the 
+    PLAN_CACHE setting, for PLAN_CACHE_TIMEOUT seconds. Streamed 
+    responses are not stored, but are still answered with a 304.
+
+    Parameters:
+        post -- Optional; also cache POST requests. Only use this for 
+            views that do not change anything.
+        depends -- Optional; a function of the request and the view 
+            arguments that returns anything else the response depends
+            on, such as another plan.
+    """
+    def wrapper(function):
+        def decorator(request, *args, **kwargs):
+            methods = ('GET', 'HEAD', 'POST',) if post else ('GET', 'HEAD',)
+            if not request.method in methods:
+                return function(request, *args, **kwargs)
+
+            try:
+                plan = Plan.objects.get(id=kwargs['planid'])
+            except (Plan.DoesNotExist, ValueError):
+                return function(request, *args, **kwargs)
+
+            parameters = [(k, request.GET.getlist(k),) for k in sorted(request.GET.keys())]
+            if request.method == 'POST':
+                parameters += [(k, request.POST.getlist(k),) for k in sorted(request.POST.keys()) if k != 'csrfmiddlewaretoken']
+
+            key = repr((function.__name__, plan.id, plan.edited.isoformat(), plan.version, plan.min_version,
+                request.user.id, translation.get_language(), sorted(kwargs.items()), parameters,
+                depends(request, kwargs) if depends else None,))
+            etag = hashlib.md5(key).hexdigest()
+            modified = int(time.mktime(plan.edited.timetuple()))
+
+            def not_modified():
+                if not request.method in ('GET', 'HEAD',):
+                    return False
+                if 'HTTP_IF_NONE_MATCH' in request.META:
+                    etags = parse_etags(request.META['HTTP_IF_NONE_MATCH'])
+                    return etag in etags or '*' in etags
+                since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+                return since is not None and modified <= since
+
+            cache = get_cache(getattr(settings, 'PLAN_CACHE', 'default'))
+            if not_modified():
+                response = HttpResponseNotModified()
+            else:
+                cached = cache.get('plan-response-%s' % etag)
+                if cached is None:
+                    response = function(request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+
+                    # Streamed responses are never read into memory, so
+                    # they only get the headers
+                    if not response._base_content_is_iter:
+                        cache.set('plan-response-%s' % etag, (response.content, response['Content-Type'],),
+                            getattr(settings, 'PLAN_CACHE_TIMEOUT', 3600))
+                else:
+                    note_session_activity(request)
+                    response = HttpResponse(cached[0], content_type=cached[1])
+
+            response['ETag'] = quote_etag(etag)
+            response['Last-Modified'] = http_date(modified)
+            patch_vary_headers(response, ('Cookie', 'Accept-Language',))
+            return response
+        return wraps(function)(decorator)
+    return wrapper
+
+def get_other_plan_edited(kwargs):
+    """
+    Get the time the other plan in a request for splits was saved, so
+    cached splits are not reused after the other plan is edited.
+    """
+    if kwargs.get('othertype') != 'plan':
+        return None
+    return list(Plan.objects.filter(id=kwargs['otherid']).values_list('edited', flat=True))
+
+def get_display_functions(request):
+    """
+    Get the panels and score functions of the display in a request for
+    statistics, so cached statistics are not reused after the display is
+    personalized.
+    """
+    try:
+        display_id = int(request.REQUEST['displayId'])
+    except (KeyError, ValueError):
+        return None
+    return list(ScorePanel.objects.filter(displays__id=display_id).values_list('id', 'score_functions').order_by('id', 'score_functions'))
+
 def is_session_available(req):
     """
     Determine if a session is available. This is similar to a user test,
@@ -313,20 +409,10 @@ def scoreplan(request, planid):
     status = { 'success': False }
     plan = Plan.objects.get(pk=planid)
 
-    criterion = ValidationCriteria.objects.filter(legislative_body=plan.legislative_body)
-    status['success'] = True
-    for criteria in criterion:
-        try:
-            score = ComputedPlanScore.compute(criteria.function, plan)
-        except:
-            logger.debug(traceback.format_exc())
-
-        if not score or not score['value']:
-            status['success'] = False
-            status['message'] = '<p>%s</p><p>%s</p>' % (criteria.get_short_label(), criteria.get_long_description() or criteria.function.get_long_description())
-            break
-
-    if status['success']:
+    criteria = ValidationCriteria.validate(plan)
+    if criteria is not None:
+        status['message'] = '<p>%s</p><p>%s</p>' % (criteria.get_short_label(), criteria.get_long_description() or criteria.function.get_long_description())
+    else:
         status['success'] = True
         status['message'] = _("Validation successful")
 
@@ -334,6 +420,9 @@ def scoreplan(request, planid):
         plan.is_valid = True
         plan.save()
 
+        # Add the plan to the leaderboard
+        LeaderboardScore.refresh(plan)
+
     return HttpResponse(json.dumps(status),mimetype='application/json')
 
 
@@ -610,6 +699,8 @@ def printplan(request, planid):
     Print a static map of a plan.
     
     This template renders a static HTML document for use with xhtml2pdf.
+    A print with the same plan version and parameters as an earlier 
+    print is served from the PDF rendered before.
     
     Parameters:
         request -- An HttpRequest, which includes the current user.
@@ -621,131 +712,122 @@ def printplan(request, planid):
     if not is_session_available(request):
         return HttpResponseRedirect('/')
         
-    cfg = commonplan(request, planid)
-
-    sha = hashlib.sha1()
-    sha.update(str(planid) + str(datetime.now()))
-    cfg['composite'] = '/reports/print-%s.jpg' % sha.hexdigest()
-    cfg['prefix'] = 'http://%s' % request.META['SERVER_NAME']
-
     if request.method == 'POST':
-        if not 'bbox' in request.REQUEST or \
-            not 'geography_url' in request.REQUEST or \
-            not 'geography_lyr' in request.REQUEST or \
-            not 'district_url' in request.REQUEST or \
-            not 'district_lyr' in request.REQUEST:
+        params = PlanPrint.get_params(request.REQUEST)
+        if params is None:
             logger.warning('Missing required "bbox", "geography_url", "geography_lyr", "district_url", or "districts_lyr" parameter.')
             return HttpResponseRedirect('../view/')
 
-        height = 500*2
-        if 'height' in request.REQUEST:
-            height = int(request.REQUEST['height'])*2
-        width = 1024*2
-        if 'width' in request.REQUEST:
-            width = int(request.REQUEST['width'])*2
-        opacity = 0.8
-        if 'opacity' in request.REQUEST:
-            opacity = float(request.REQUEST['opacity'])
-
-        full_legend = json.loads(request.REQUEST['legend'])
-
-        cfg['geography_url'] = request.REQUEST['geography_url']
-        cfg['geography_lyr'] = request.REQUEST['geography_lyr']
-        cfg['district_url'] = request.REQUEST['district_url']
-        cfg['district_lyr'] = request.REQUEST['district_lyr']
-        cfg['geo_legend'] = full_legend['geo']
-        cfg['geo_legend_title'] = full_legend['geotitle']
-        cfg['dist_legend'] = full_legend['dist']
-        cfg['dist_legend_title'] = full_legend['disttitle']
-        cfg['plan'] = Plan.objects.get(id=int(request.REQUEST['plan_id']))
-        cfg['printed'] = datetime.now()
-
-        # use modestmaps to get the basemap
-        bbox = request.REQUEST['bbox'].split(',')
-
-        pt1 = Point(float(bbox[0]), float(bbox[1]), srid=3785)
-        pt1.transform(SpatialReference('EPSG:4326'))
-        ll = ModestMaps.Geo.Location(pt1.y, pt1.x)
-
-        pt2 = Point(float(bbox[2]), float(bbox[3]), srid=3785)
-        pt2.transform(SpatialReference('EPSG:4326'))
-        ur = ModestMaps.Geo.Location(pt2.y, pt2.x)
-
-        dims = ModestMaps.Core.Point(width, height)
-        provider = ModestMaps.OpenStreetMap.Provider()
-        basemap = ModestMaps.mapByExtent(provider, ll, ur, dims)
-
-        # create basemap for compositing
-        fullImg = basemap.draw()
-
-
-        # geography layer
-        provider = ModestMaps.WMS.Provider(cfg['geography_url'], {
-            'LAYERS':cfg['geography_lyr'],
-            'TRANSPARENT':'true',
-            'SRS': 'EPSG:3785',
-            'HEIGHT': 512,
-            'WIDTH': 512
-        })
-        overlayImg = ModestMaps.mapByExtent(provider, ll, ur, dims).draw()
+        plan = Plan.objects.get(id=int(planid))
+        if not can_view(request.user, plan):
+            return HttpResponseForbidden()
 
-        # create an invert mask of the geography
-        maskImg = ImageChops.invert(overlayImg)
+        language = translation.get_language()
+        job_id = PlanPrint.get_job_id(plan, params, language)
+        status = PlanPrint.waitprint(job_id)
+        if status == 'free':
+            # Render the print during this request
+            PlanPrint.markpending(job_id)
+            PlanPrint.createprint(plan.id, params, 'http://%s' % request.META['SERVER_NAME'], job_id, language)
 
+        try:
+            pdf = open(PlanPrint.get_file_name(job_id) + '.pdf', 'rb')
+            try:
+                response = HttpResponse(pdf.read(), mimetype='application/pdf')
+            finally:
+                pdf.close()
+        except IOError:
+            return HttpResponseServerError(_('The plan could not be printed.'))
 
-        # district fill layer
-        provider = ModestMaps.WMS.Provider(cfg['district_url'], {
-            'LAYERS':cfg['district_lyr'],
-            'TRANSPARENT':'false',
-            'SRS': 'EPSG:3785',
-            'SLD_BODY': request.REQUEST['district_sld'],
-            'HEIGHT': 512,
-            'WIDTH': 512
-        })
-        overlayImg = Image.blend(overlayImg, ModestMaps.mapByExtent(provider, ll, ur, dims).draw(), 0.5)
+        response['Content-Disposition'] = 'attachment; filename=plan.pdf'
 
-        # composite the overlay onto the base, using the mask (from geography)
-        fullImg = Image.composite(fullImg, Image.blend(fullImg, overlayImg, opacity), maskImg)
+        return response
+   
+    else:
+        return HttpResponseRedirect('../view/')
 
+@unique_session_or_json_redirect
+def printplanjob(request, planid):
+    """
+    Start printing a plan in the background.
 
-        # district line & label layer
-        provider = ModestMaps.WMS.Provider(cfg['district_url'], {
-            'LAYERS':cfg['district_lyr'],
-            'TRANSPARENT':'true',
-            'SRS': 'EPSG:3785',
-            'SLD_BODY': request.REQUEST['label_sld'],
-            'HEIGHT': 512,
-            'WIDTH': 512
-        })
-        overlayImg = ModestMaps.mapByExtent(provider, ll, ur, dims).draw()
+    The print parameters are the same as those of printplan. If the plan
+    was printed with the same version and parameters, the print is ready
+    straight away.
 
-        # create an invert mask of the labels & lines
-        maskImg = ImageChops.invert(overlayImg)
+    Parameters:
+        request -- An HttpRequest, which includes the current user.
+        planid -- The plan to print.
 
-        # composite the district labels on top of the composited basemap, geography & district areas
-        fullImg = Image.composite(fullImg, Image.blend(fullImg, overlayImg, opacity), maskImg)
+    Returns:
+        A JSON HttpResponse with the id of the print job, and its status.
+    """
+    note_session_activity(request)
 
-        # save
-        fullImg.save(settings.WEB_TEMP + ('/print-%s.jpg' % sha.hexdigest()),'jpeg',quality=100)
+    status = { 'success': False }
+    if request.method != 'POST':
+        status['message'] = _("Information for printing wasn't sent via POST")
+        return HttpResponse(json.dumps(status),mimetype='application/json')
 
-        # render pg to a string
-        t = loader.get_template('printplan.html')
-        page = t.render(DjangoContext(cfg))
-        result = StringIO.StringIO()
+    try:
+        plan = Plan.objects.get(pk=planid)
+    except:
+        status['message'] = _('No plan with the given id')
+        return HttpResponse(json.dumps(status),mimetype='application/json')
 
-        # setting encoding='UTF-8' causes an exception. removing this for now,
-        # as allowing the method to set an encoding itself fixes the problem.
-        # we may need to find an alternate strategy if it finds encodings that
-        # it isn't able to decipher.
-        CreatePDF(page, result, show_error_as_pdf=True)
+    if not can_view(request.user, plan):
+        status['message'] = _("User can't view the given plan")
+        return HttpResponse(json.dumps(status),mimetype='application/json')
 
-        response = HttpResponse(result.getvalue(), mimetype='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename=plan.pdf'
+    params = PlanPrint.get_params(request.POST)
+    if params is None:
+        status['message'] = _('Missing required print parameters')
+        return HttpResponse(json.dumps(status),mimetype='application/json')
 
-        return response
-   
+    language = translation.get_language()
+    job_id = PlanPrint.get_job_id(plan, params, language)
+    if PlanPrint.checkprint(job_id) == 'free':
+        PlanPrint.markpending(job_id)
+        PlanPrint.createprint.delay(plan.id, params, 'http://%s' % request.META['SERVER_NAME'], job_id, language)
+
+    return printplanstatus(request, planid, job_id)
+
+@unique_session_or_json_redirect
+def printplanstatus(request, planid, job_id=None):
+    """
+    Get the status of a print job.
+
+    Parameters:
+        request -- An HttpRequest, with the 'job' id of the print.
+        planid -- The plan that is printed.
+
+    Returns:
+        A JSON HttpResponse with the status of the print: 'ready', 
+        'busy', or 'free' if the print failed or was not started. When
+        the print is ready, the web address of the PDF is included.
+    """
+    status = { 'success': False }
+    if job_id is None:
+        job_id = request.REQUEST.get('job', '')
+
+    # The job id starts with the plan id, and may not name any other file
+    if not re.match(r'^p%d_v\d+_[0-9a-f]{40}$' % int(planid), job_id):
+        status['message'] = _('No print job with the given id')
+        return HttpResponse(json.dumps(status),mimetype='application/json')
+
+    status['success'] = True
+    status['job'] = job_id
+    status['status'] = PlanPrint.checkprint(job_id)
+    if status['status'] == 'ready':
+        status['url'] = PlanPrint.getprint(job_id)
+        status['message'] = _('Plan print is ready.')
+    elif status['status'] == 'busy':
+        status['retry'] = 2
+        status['message'] = _('Plan print is being created.')
     else:
-        return HttpResponseRedirect('../view/')
+        status['message'] = _('Plan print failed.')
+
+    return HttpResponse(json.dumps(status),mimetype='application/json')
 
 @login_required
 @unique_session_or_json_redirect
@@ -1115,8 +1197,10 @@ def newdistrict(request, planid):
                 status['message'] = _('Created 1 new district')
                 plan = Plan.objects.get(pk=planid, owner=request.user)
                 status['edited'] = getutc(plan.edited).isoformat()
+                schedule_score_warmup(plan)
                 status['district_id'] = district_id
                 status['version'] = plan.version
+                status['extent'] = plan.get_extent(plan.version)
             except ValidationError:
                 status['message'] = _('Reached Max districts already')
             except Exception, ex:
@@ -1184,6 +1268,12 @@ def add_districts_to_plan(request, planid):
         status['success'] = True
         status['message'] = _('Merged %(num_merged_districts)d districts') % {'num_merged_districts': len(results)}
         status['version'] = plan.version
+        status['extent'] = plan.get_extent(plan.version)
+
+        # The warm-up is scheduled once the districts are committed, so
+        # it can't roll them back
+        schedule_score_warmup(plan)
+        transaction.commit()
     except Exception as ex:
         transaction.rollback()
         status['message'] = str(ex)
@@ -1258,6 +1348,12 @@ def assign_district_members(request, planid):
         status['modified'] = changed
         status['message'] = _('Modified members for %(num_districts)d '
             'districts') % {'num_districts': changed}
+
+        # The warm-up is scheduled once the members are committed, so it
+        # can't roll them back
+        if changed > 0:
+            schedule_score_warmup(plan)
+        transaction.commit()
     except Exception, ex:
         transaction.rollback()
         status['message'] = str(ex)
@@ -1313,6 +1409,8 @@ def combine_districts(request, planid):
             status['success'] = True
             status['message'] = _('Successfully combined districts')
             status['version'] = result[1]
+            status['extent'] = plan.get_extent(result[1])
+            schedule_score_warmup(plan)
     except Exception, ex:
         status['message'] = _('Could not combine districts')
         status['exception'] = traceback.format_exc()
@@ -1346,6 +1444,9 @@ def fix_unassigned(request, planid):
         status['success'] = result[0]
         status['message'] = result[1]
         status['version'] = plan.version
+        status['extent'] = plan.get_extent(plan.version)
+        if result[0]:
+            schedule_score_warmup(plan)
     except Exception, ex:
         status['message'] = _('Could not fix unassigned')
         status['exception'] = traceback.format_exc()
@@ -1355,6 +1456,7 @@ def fix_unassigned(request, planid):
 
 
 @unique_session_or_json_redirect
+@cache_plan_response(post=True, depends=lambda request, kwargs: get_other_plan_edited(kwargs))
 def get_splits(request, planid, otherid, othertype):
     """
     Find all splits between this plan and another plan
@@ -1529,6 +1631,8 @@ def addtodistrict(request, planid, districtid):
             plan = Plan.objects.get(pk=planid,owner=request.user)
             status['edited'] = getutc(plan.edited).isoformat()
             status['version'] = plan.version
+            status['extent'] = plan.get_extent(plan.version)
+            schedule_score_warmup(plan)
         except Exception, ex: 
             status['exception'] = traceback.format_exc()
             status['message'] = _('Could not add units to district.')
@@ -1589,6 +1693,7 @@ def setdistrictlock(request, planid, district_id):
         
             
 @unique_session_or_json_redirect
+@cache_plan_response(post=True)
 def getdistricts(request, planid):
     """
     Get the districts in a plan at a specific version.
@@ -1634,6 +1739,7 @@ def getdistricts(request, planid):
                 'version':district.version
             })
         status['canUndo'] = can_undo
+        status['extent'] = plan.get_extent(version)
         status['success'] = True
 
     else:
@@ -1642,6 +1748,30 @@ def getdistricts(request, planid):
     return HttpResponse(json.dumps(status), mimetype='application/json')
 
 
+def get_geojson_precision(request):
+    """
+    Get the number of decimal places to round the coordinates of GeoJSON
+    features to, from the 'precision' parameter, or from the size of a 
+    map pixel in the 'resolution' parameter.
+
+    Parameters:
+        request -- An HttpRequest.
+
+    Returns:
+        The number of decimal places, or None to write coordinates in 
+        full.
+    """
+    try:
+        if 'precision' in request.REQUEST:
+            return int(request.REQUEST['precision'])
+        if 'resolution' in request.REQUEST:
+            return precision_for_resolution(float(request.REQUEST['resolution']))
+    except ValueError:
+        pass
+    return None
+
+
+@cache_plan_response(post=True)
 def simple_district_versioned(request, planid, district_ids=None):
     """
     Emulate a WFS service for versioned districts.
@@ -1656,6 +1786,12 @@ def simple_district_versioned(request, planid, district_ids=None):
     This method accepts an optional 'district_ids__eq' parameter, which is
     a comma-separated list of district_ids to filter by
 
+    This method accepts optional 'precision' and 'resolution' parameters,
+    to round the coordinates of the districts; see get_geojson_precision.
+
+    If no 'bbox' parameter is given, the districts within the stored
+    extent of the plan version are returned.
+
     Parameters:
         request -- An HttpRequest, with the current user.
         planid -- The plan ID from which to get the districts.
@@ -1699,9 +1835,15 @@ def simple_district_versioned(request, planid, district_ids=None):
                 # convert the request string into a tuple full of floats
                 bbox = tuple( map( lambda x: float(x), bbox.split(',')))
             else:
-                bbox = plan.district_set.all().extent(field_name='simple')
+                bbox = plan.get_extent(version)
 
-            status['features'] = plan.get_wfs_districts(version, subject_id, bbox, geolevel, district_ids)
+            if bbox is None:
+                # Every district in this version of the plan is empty
+                features = []
+            else:
+                features = plan.get_district_features(version, subject_id, bbox, geolevel, district_ids)
+            features = ((district.id, district.chop, properties,) for (district, properties,) in features)
+            return HttpResponse(stream_features(features, precision=get_geojson_precision(request)), mimetype='application/json')
         else:
             status['features'] = []
             status['message'] = _('Subject for districts is required.')
@@ -1712,6 +1854,46 @@ def simple_district_versioned(request, planid, district_ids=None):
     return HttpResponse(json.dumps(status),mimetype='application/json')
 
 
+def district_tile(request, planid, version, geolevel, subject_id, z, x, y):
+    """
+    Get one version of the districts in a plan as a Mapbox Vector Tile.
+
+    The districts have the same attributes as the features returned by
+    simple_district_versioned, but only the districts within the tile are
+    encoded. Tiles are cached on disk for each version of the plan.
+
+    Parameters:
+        request -- An HttpRequest, with the current user.
+        planid -- The plan ID from which to get the districts.
+        version -- The version of the plan.
+        geolevel -- The index of the simplified geometry to use.
+        subject_id -- The Subject attributes to attach to the districts.
+        z -- The zoom level of the tile.
+        x -- The column of the tile, from the west.
+        y -- The row of the tile, from the north.
+
+    Returns:
+        An HttpResponse of the encoded tile.
+    """
+    note_session_activity(request)
+
+    try:
+        plan = Plan.objects.get(id=planid)
+    except Plan.DoesNotExist:
+        return HttpResponseNotFound()
+
+    version = int(version)
+    if version < plan.min_version or version > plan.version or \
+        not Subject.objects.filter(id=subject_id).exists():
+        return HttpResponseNotFound()
+
+    tile = plan.get_vector_tile(version, int(subject_id), int(geolevel), int(z), int(x), int(y))
+    if tile is None:
+        return HttpResponseNotFound()
+
+    return HttpResponse(tile, mimetype='application/x-protobuf')
+
+
 def get_unlocked_simple_geometries(request,planid):
     """
     Emulate a WFS service for selecting unlocked geometries.
@@ -1720,7 +1902,12 @@ def get_unlocked_simple_geometries(request,planid):
     for a given plan. This function is necessary because a traditional
     view could not be used to obtain the geometries in a versioned fashion.
 
-    This method accepts 'version__eq', 'level__eq', and 'geom__eq' URL parameters.
+    This method accepts 'version__eq', 'level__eq', and 'geom__eq' URL parameters,
+    and the optional 'precision' and 'resolution' parameters.
+
+    If the selection has more geounits than the SELECTION_MAX_FEATURES
+    setting, the geounits of a coarser geolevel are returned instead. The
+    geolevel of each feature is in its 'geolevel_id' property.
 
     Parameters:
     request -- An HttpRequest, with the current user.
@@ -1753,54 +1940,37 @@ def get_unlocked_simple_geometries(request,planid):
                     # If the line doesn't work, just don't return anything
                     geom = None
 
+            if geom is None:
+                return HttpResponse(stream_features([]), mimetype='application/json')
+
             # Selection is the geounits that intersects with the drawing tool used:
             # either a lasso, a rectangle, or a point
             selection = Q(geom__intersects=geom)
 
-            # Create a union of locked geometries
-            districts = [d.id for d in plan.get_districts_at_version(version, include_geom=True) if d.is_locked]
-            locked = District.objects.filter(id__in=districts).collect()
-
-            # Create a simplified locked boundary for fast, but not completely accurate lookups
-            # Note: the preserve topology parameter of simplify is needed here
-            locked_buffered = locked.simplify(100, True).buffer(100) if locked else None
-
-            # Filter first by geolevel, then selection
-            filtered = Geolevel.objects.get(id=geolevel).geounit_set.filter(selection)
-            # Assemble the matching features into geojson
-            features = []
-            for feature in filtered:
-                # We want to allow for the selection of a geometry that is partially split
-                # with a locked district, so subtract out all sections that are locked
-                geom = feature.simple
-
-                # Only perform additional tests if the fast, innacurate lookup passed
-                if locked and geom.intersects(locked_buffered):
-
-                    # If a geometry is fully locked, don't add it
-                    if feature.geom.within(locked):
-                        continue
-
-                    # Overlapping geometries are the ones we need to subtract pieces of
-                    if feature.geom.overlaps(locked):
-                        # Since this is just for display, do the difference on the simplified geometries
-                        geom = geom.difference(locked_buffered)
-                        
-                features.append({
+            # If the selection has too many geounits, select from coarser geolevels
+            level = Geolevel.objects.get(id=geolevel)
+            limit = getattr(settings, 'SELECTION_MAX_FEATURES', 0)
+            if limit > 0:
+                coarser = [gl for gl in plan.legislative_body.get_geolevels() if gl.min_zoom < level.min_zoom]
+                coarser.sort(key=lambda gl: gl.min_zoom, reverse=True)
+                for gl in coarser:
+                    if level.geounit_set.filter(selection).count() <= limit:
+                        break
+                    level = gl
+
+            # Write the matching features into geojson as they are found
+            def features():
+                for (id, name, wkb,) in plan.get_unlocked_geounits(version, level.id, geom):
                     # Note: OpenLayers breaks when the id is set to an integer, or even an integer string.
                     # The id ends up being treated as an array index, rather than a property list key, and
                     # there are some bizarre consequences. That's why the underscore is here.
-                    'id': '_%d' % feature.id,
-                    'geometry': json.loads(geom.json),
-                    'properties': {
-                        'name': feature.name,
-                        'geolevel_id': geolevel,
-                        'id': feature.id
-                    }
-                })
-                    
-            status['features'] = features
-            return HttpResponse(json.dumps(status),mimetype='application/json')
+                    yield ('_%d' % id, wkb, {
+                        'name': name,
+                        'geolevel_id': level.id,
+                        'id': id
+                    },)
+
+            return HttpResponse(stream_features(features(), precision=get_geojson_precision(request)), mimetype='application/json')
             
         else:
             status['features'] = []
@@ -1813,6 +1983,7 @@ def get_unlocked_simple_geometries(request,planid):
     return HttpResponse(json.dumps(status),mimetype='application/json')
 
 @unique_session_or_json_redirect
+@cache_plan_response(post=True, depends=lambda request, kwargs: get_display_functions(request))
 def get_statistics(request, planid):
     note_session_activity(request)
 
@@ -1979,10 +2150,16 @@ def getleaderboard(request):
     if display is None:
         return HttpResponse(_('No display configured'), mimetype='text/plain')
     
-    plans = getvalidplans(leg_body, request.user if owner_filter == 'mine' else None)
+    if owner_filter == 'mine':
+        owner, limit = request.user, None
+    else:
+        owner, limit = None, settings.LEADERBOARD_MAX_RANKED
+
+    for panel in display.scorepanel_set.filter(type='plan'):
+        schedule_leaderboard_build(panel)
 
     try :
-        html = display.render(plans, request)
+        html = display.render_leaderboard(owner=owner, context=request, limit=limit)
         return HttpResponse(html, mimetype='text/html; charset=utf-8')
     except Exception, ex:
         logger.warn('Leaderboard could not be fetched.')
@@ -2001,12 +2178,20 @@ def getleaderboardcsv(request):
     owner_filter = request.REQUEST['owner_filter']
     body_pk = int(request.REQUEST['legislative_body']);
     leg_body = LegislativeBody.objects.get(pk=body_pk)
-    plans = getvalidplans(leg_body, request.user if owner_filter == 'mine' else None)
+    owner = request.user if owner_filter == 'mine' else None
 
     display = getleaderboarddisplay(leg_body, owner_filter)
-    plans = getvalidplans(leg_body, request.user if owner_filter == 'mine' else None)
+    plans = getvalidplans(leg_body, owner)
 
     panels = display.scorepanel_set.all().order_by('position')
+
+    # Read the first score of each panel from the leaderboard
+    scores = {}
+    for panel in panels:
+        schedule_leaderboard_build(panel)
+        function = panel.score_functions.all()[0]
+        for leader in LeaderboardScore.get_scores(panel, owner=owner).filter(function=function):
+            scores[(panel.id, leader.plan_id,)] = leader.get_score()
     
     try :
         # mark the response as csv, and create the csv writer
@@ -2023,8 +2208,9 @@ def getleaderboardcsv(request):
 
             # add each score
             for panel in panels:
-                function = panel.score_functions.all()[0]
-                score = ComputedPlanScore.compute(function, plan)
+                score = scores.get((panel.id, plan.id,))
+                if score is None:
+                    score = ComputedPlanScore.compute(panel.score_functions.all()[0], plan)
                 row.append(score['value'])
                 
             # write the row
@@ -2482,6 +2668,7 @@ def purge_plan_clear_cache(district, version):
     cache.delete()
 
 @unique_session_or_json_redirect
+@cache_plan_response()
 def district_info(request, planid, district_id):
     """
     Get the comments that are attached to a district.
@@ -76,6 +76,9 @@ def main():
             action='store_true', default=False),
     parser.add_option('-a', '--adjacency', dest="adjacency",
             help="Load adjacency data", default=False, action='store_true')
+    parser.add_option('-N', '--neighbors', dest="neighbors",
+            help="Compute the neighbors of the base geounits, for contiguity.",
+            default=False, action='store_true')
     parser.add_option('-b', '--bard', dest="bard",
             help="Create a BARD map based on the imported spatial data.", 
             default=False, action='store_true'),
@@ -91,7 +94,7 @@ def main():
 
     (options, args) = parser.parse_args()
 
-    allops = (not options.database) and (not options.geolevels) and (not options.views) and (not options.geoserver) and (not options.templates) and (not options.nesting) and (not options.bard) and (not options.static) and (not options.languages) and (not options.bard_templates) and (not options.adjacency)
+    allops = (not options.database) and (not options.geolevels) and (not options.views) and (not options.geoserver) and (not options.templates) and (not options.nesting) and (not options.bard) and (not options.static) and (not options.languages) and (not options.bard_templates) and (not options.adjacency) and (not options.neighbors)
 
     setup_logging(options.verbosity)
 
@@ -149,6 +152,7 @@ ERROR:
         bard = False
         bard_templates = False
         adjacency = False
+        neighbors = True
     else:
         database = options.database
         geolevels = options.geolevels
@@ -161,8 +165,9 @@ ERROR:
         bard = options.bard
         bard_templates = options.bard_templates
         adjacency = options.adjacency
+        neighbors = options.neighbors
 
-    management.call_command('setup', config=args[1], verbosity=options.verbosity, database=database, geolevels=geolevels, views=views, geoserver=geoserver, templates=templates, nesting=nesting, static=static, languages=languages, bard=bard, bard_templates=bard_templates, force=options.force, adjacency=adjacency)
+    management.call_command('setup', config=args[1], verbosity=options.verbosity, database=database, geolevels=geolevels, views=views, geoserver=geoserver, templates=templates, nesting=nesting, static=static, languages=languages, bard=bard, bard_templates=bard_templates, force=options.force, adjacency=adjacency, neighbors=neighbors)
     
     # Success! Exit-code 0
     sys.exit(0)
@@ -0,0 +1,17 @@
+--
+-- Store computed scores as JSON documents, with a numeric column for
+-- scalar scores, instead of pickled strings. The pickled scores cannot be
+-- converted in SQL, so the computed score tables are truncated, and the
+-- scores will be recomputed as they are requested.
+--
+BEGIN;
+
+TRUNCATE TABLE publicmapping.redistricting_computeddistrictscore, publicmapping.redistricting_computedplanscore RESTART IDENTITY;
+
+ALTER TABLE publicmapping.redistricting_computeddistrictscore ADD COLUMN numeric_value double precision NULL;
+CREATE INDEX redistricting_computeddistrictscore_numeric_value ON publicmapping.redistricting_computeddistrictscore (numeric_value);
+
+ALTER TABLE publicmapping.redistricting_computedplanscore ADD COLUMN numeric_value double precision NULL;
+CREATE INDEX redistricting_computedplanscore_numeric_value ON publicmapping.redistricting_computedplanscore (numeric_value);
+
+COMMIT;
@@ -0,0 +1,19 @@
+--
+-- Store the geometric measurements of districts used by the compactness
+-- calculators. Rows are created as the metrics are requested.
+--
+CREATE TABLE "redistricting_districtmetrics" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "district_id" integer NOT NULL UNIQUE REFERENCES "redistricting_district" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "area" double precision NOT NULL,
+    "perimeter" double precision NOT NULL,
+    "hull_area" double precision NOT NULL,
+    "hull" text NOT NULL,
+    "minx" double precision NOT NULL,
+    "miny" double precision NOT NULL,
+    "maxx" double precision NOT NULL,
+    "maxy" double precision NOT NULL,
+    "circle_x" double precision,
+    "circle_y" double precision,
+    "circle_r" double precision
+);
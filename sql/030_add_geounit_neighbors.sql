@@ -0,0 +1,15 @@
+--
+-- Store the neighbors of each geounit, for computing contiguity. Run the
+-- setup management command with the --neighbors option to populate it.
+--
+CREATE TABLE "redistricting_geounitneighbor" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "geolevel_id" integer NOT NULL REFERENCES "redistricting_geolevel" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "geounit_id" integer NOT NULL REFERENCES "redistricting_geounit" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "neighbor_id" integer NOT NULL REFERENCES "redistricting_geounit" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "rook" boolean NOT NULL,
+    UNIQUE ("geounit_id", "neighbor_id")
+);
+CREATE INDEX "redistricting_geounitneighbor_geolevel_id" ON "redistricting_geounitneighbor" ("geolevel_id");
+CREATE INDEX "redistricting_geounitneighbor_geounit_id" ON "redistricting_geounitneighbor" ("geounit_id");
+CREATE INDEX "redistricting_geounitneighbor_neighbor_id" ON "redistricting_geounitneighbor" ("neighbor_id");
@@ -0,0 +1,11 @@
+--
+-- Store the running sums of the costs between the base geounits of
+-- districts, used by the adjacency calculator. Rows are created as the
+-- sums are requested, and carried forward as districts are edited.
+--
+CREATE TABLE "redistricting_districtadjacency" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "district_id" integer NOT NULL UNIQUE REFERENCES "redistricting_district" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "cost_sum" double precision NOT NULL,
+    "pair_count" bigint NOT NULL
+);
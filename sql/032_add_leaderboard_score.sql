@@ -0,0 +1,22 @@
+--
+-- Store the scores of valid plans in each leaderboard panel, with the
+-- rank of each score. Rows are created when a plan is validated, and
+-- removed when the plan is edited; each panel is filled with the scores
+-- of the valid plans the first time it is read.
+--
+CREATE TABLE "redistricting_leaderboardscore" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "panel_id" integer NOT NULL REFERENCES "redistricting_scorepanel" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "function_id" integer NOT NULL REFERENCES "redistricting_scorefunction" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "plan_id" integer NOT NULL REFERENCES "redistricting_plan" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "version" integer CHECK ("version" >= 0) NOT NULL,
+    "value" text NOT NULL,
+    "numeric_value" double precision NULL,
+    "sort_value" double precision NULL,
+    "rank" integer CHECK ("rank" >= 0) NOT NULL,
+    UNIQUE ("panel_id", "function_id", "plan_id")
+);
+CREATE INDEX "redistricting_leaderboardscore_panel_id" ON "redistricting_leaderboardscore" ("panel_id");
+CREATE INDEX "redistricting_leaderboardscore_function_id" ON "redistricting_leaderboardscore" ("function_id");
+CREATE INDEX "redistricting_leaderboardscore_plan_id" ON "redistricting_leaderboardscore" ("plan_id");
+CREATE INDEX "redistricting_leaderboardscore_rank" ON "redistricting_leaderboardscore" ("rank");
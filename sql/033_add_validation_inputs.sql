@@ -0,0 +1,22 @@
+--
+-- Record how long each validation criteria takes to compute, so the
+-- cheapest criteria are checked first, and store the part of each
+-- validation score that depends on a single district, so unchanged
+-- districts are not evaluated again when a plan is validated.
+--
+BEGIN;
+
+ALTER TABLE publicmapping.redistricting_validationcriteria ADD COLUMN duration double precision NOT NULL DEFAULT 0;
+ALTER TABLE publicmapping.redistricting_validationcriteria ADD COLUMN checks integer CHECK ("checks" >= 0) NOT NULL DEFAULT 0;
+
+CREATE TABLE publicmapping.redistricting_validationinput (
+    "id" serial NOT NULL PRIMARY KEY,
+    "function_id" integer NOT NULL REFERENCES publicmapping.redistricting_scorefunction ("id") DEFERRABLE INITIALLY DEFERRED,
+    "district_id" integer NOT NULL REFERENCES publicmapping.redistricting_district ("id") DEFERRABLE INITIALLY DEFERRED,
+    "value" text NOT NULL,
+    UNIQUE ("function_id", "district_id")
+);
+CREATE INDEX redistricting_validationinput_function_id ON publicmapping.redistricting_validationinput ("function_id");
+CREATE INDEX redistricting_validationinput_district_id ON publicmapping.redistricting_validationinput ("district_id");
+
+COMMIT;
@@ -0,0 +1,10 @@
+--
+-- Track the plans whose scores are waiting to be computed in the
+-- background after an edit.
+--
+CREATE TABLE publicmapping.redistricting_scorewarmup (
+    "id" serial NOT NULL PRIMARY KEY,
+    "plan_id" integer NOT NULL UNIQUE REFERENCES publicmapping.redistricting_plan ("id") DEFERRABLE INITIALLY DEFERRED,
+    "requested" timestamp with time zone NOT NULL,
+    "started" timestamp with time zone NULL
+);
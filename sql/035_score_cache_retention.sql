@@ -0,0 +1,22 @@
+--
+-- Record when each cached score was last read, and count the hits and
+-- misses of the score caches, so old scores can be evicted.
+--
+ALTER TABLE publicmapping.redistricting_computeddistrictscore
+    ADD COLUMN "accessed" timestamp with time zone NOT NULL DEFAULT now();
+CREATE INDEX "redistricting_computeddistrictscore_accessed"
+    ON publicmapping.redistricting_computeddistrictscore ("accessed");
+
+ALTER TABLE publicmapping.redistricting_computedplanscore
+    ADD COLUMN "accessed" timestamp with time zone NOT NULL DEFAULT now();
+CREATE INDEX "redistricting_computedplanscore_accessed"
+    ON publicmapping.redistricting_computedplanscore ("accessed");
+
+CREATE TABLE publicmapping.redistricting_scorecachestatistic (
+    "id" serial NOT NULL PRIMARY KEY,
+    "day" date NOT NULL,
+    "table" varchar(50) NOT NULL,
+    "hits" bigint NOT NULL,
+    "misses" bigint NOT NULL,
+    UNIQUE ("day", "table")
+);
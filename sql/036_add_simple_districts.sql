@@ -0,0 +1,41 @@
+--
+-- Store the simplified geometry of each district at each geolevel in its
+-- own row, with a spatial index, so the map reads only the geometry of
+-- the geolevel it draws. The rows are filled from the simple geometry
+-- collections of the existing districts.
+--
+BEGIN;
+
+CREATE TABLE publicmapping.redistricting_simpledistrict (
+    "id" serial NOT NULL PRIMARY KEY,
+    "district_id" integer NOT NULL REFERENCES publicmapping.redistricting_district ("id") DEFERRABLE INITIALLY DEFERRED,
+    "geolevel_id" integer NOT NULL REFERENCES publicmapping.redistricting_geolevel ("id") DEFERRABLE INITIALLY DEFERRED,
+    "num_coords" integer NOT NULL,
+    "minx" double precision NOT NULL,
+    "miny" double precision NOT NULL,
+    "maxx" double precision NOT NULL,
+    "maxy" double precision NOT NULL,
+    UNIQUE ("district_id", "geolevel_id")
+);
+SELECT AddGeometryColumn('publicmapping', 'redistricting_simpledistrict', 'geom', 3785, 'MULTIPOLYGON', 2);
+ALTER TABLE publicmapping.redistricting_simpledistrict ALTER "geom" SET NOT NULL;
+CREATE INDEX redistricting_simpledistrict_district_id ON publicmapping.redistricting_simpledistrict ("district_id");
+CREATE INDEX redistricting_simpledistrict_geolevel_id ON publicmapping.redistricting_simpledistrict ("geolevel_id");
+
+INSERT INTO publicmapping.redistricting_simpledistrict
+    (district_id, geolevel_id, geom, num_coords, minx, miny, maxx, maxy)
+SELECT s.district_id, s.geolevel_id, s.geom, st_npoints(s.geom),
+    coalesce(st_xmin(s.geom), 0), coalesce(st_ymin(s.geom), 0),
+    coalesce(st_xmax(s.geom), 0), coalesce(st_ymax(s.geom), 0)
+FROM (SELECT d.id AS district_id, l.geolevel_id, st_multi(st_geometryn(d.simple, l.geolevel_id)) AS geom
+    FROM publicmapping.redistricting_district AS d
+    JOIN publicmapping.redistricting_plan AS p ON d.plan_id = p.id
+    JOIN (SELECT DISTINCT geolevel_id, legislative_body_id FROM publicmapping.redistricting_legislativelevel) AS l
+        ON l.legislative_body_id = p.legislative_body_id
+    WHERE st_numgeometries(d.simple) >= l.geolevel_id) AS s
+WHERE geometrytype(s.geom) = 'MULTIPOLYGON';
+
+CREATE INDEX redistricting_simpledistrict_geom_id ON publicmapping.redistricting_simpledistrict USING GIST ("geom" GIST_GEOMETRY_OPS);
+ANALYZE publicmapping.redistricting_simpledistrict;
+
+COMMIT;
@@ -0,0 +1,21 @@
+--
+-- Store the bounding box of the districts in each version of a plan, so
+-- the map doesn't aggregate the geometries of every district in the
+-- plan's history to find the bounds of the plan. The extents of existing
+-- plans are measured the first time they are requested.
+--
+BEGIN;
+
+CREATE TABLE publicmapping.redistricting_planextent (
+    "id" serial NOT NULL PRIMARY KEY,
+    "plan_id" integer NOT NULL REFERENCES publicmapping.redistricting_plan ("id") DEFERRABLE INITIALLY DEFERRED,
+    "version" integer CHECK ("version" >= 0) NOT NULL,
+    "minx" double precision NOT NULL,
+    "miny" double precision NOT NULL,
+    "maxx" double precision NOT NULL,
+    "maxy" double precision NOT NULL,
+    UNIQUE ("plan_id", "version")
+);
+CREATE INDEX redistricting_planextent_plan_id ON publicmapping.redistricting_planextent ("plan_id");
+
+COMMIT;
@@ -0,0 +1,15 @@
+--
+-- Record the leaderboard panels that were filled with the scores of
+-- every valid plan, so a panel is built once, in the background, instead
+-- of whenever its scores don't cover every valid plan.
+--
+BEGIN;
+
+CREATE TABLE publicmapping.redistricting_leaderboardbuild (
+    "id" serial NOT NULL PRIMARY KEY,
+    "panel_id" integer NOT NULL UNIQUE REFERENCES publicmapping.redistricting_scorepanel ("id") DEFERRABLE INITIALLY DEFERRED,
+    "started" timestamp with time zone NOT NULL,
+    "built" timestamp with time zone NULL
+);
+
+COMMIT;